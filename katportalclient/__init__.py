@@ -8,10 +8,16 @@
 ###############################################################################
 """Root of katportalclient package."""
 
+from cache import SensorMetadataCache
 from client import (
     KATPortalClient, ScheduleBlockNotFoundError, SensorNotFoundError,
-    SensorHistoryRequestError, ScheduleBlockTargetsParsingError, create_jwt_login_token)
+    SensorHistoryRequestError, ScheduleBlockTargetsParsingError,
+    RequestTimeoutError, ConnectionClosedError, create_jwt_login_token)
+from connection import ReconnectPolicy
+from index import SensorIndex
+from manager import KATPortalClientManager, SharedKATPortalClient
 from request import JSONRPCRequest
+from transport import HTTPTransport
 
 # BEGIN VERSION CHECK
 # Get package version when locally imported from repo or via -e develop install
@@ -0,0 +1,465 @@
+###############################################################################
+# SKA South Africa (http://ska.ac.za/)                                        #
+# Author: cam@ska.ac.za                                                       #
+# Copyright @ 2013 SKA SA. All rights reserved.                               #
+#                                                                             #
+# THIS SOFTWARE MAY NOT BE COPIED OR DISTRIBUTED IN ANY FORM WITHOUT THE      #
+# WRITTEN PERMISSION OF SKA SA.                                               #
+###############################################################################
+"""Module defining local caches used by the katportal client."""
+
+import bisect
+import cPickle as pickle
+import errno
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from urllib import quote
+
+from history import SampleColumns
+
+
+# Samples more recent than this (in seconds) are not cached, as the
+# archive may still be receiving data for that period.
+HISTORY_CACHE_MIN_AGE_SEC = 300
+# Version of the sensor history cache file format
+HISTORY_CACHE_FORMAT_VERSION = 1
+# Cached sitemaps older than this (in seconds) are revalidated
+SITEMAP_CACHE_TTL_SEC = 3600
+# Version of the sitemap cache file format
+SITEMAP_CACHE_FORMAT_VERSION = 1
+# Cached sensor details older than this (in seconds) are fetched again
+SENSOR_METADATA_TTL_SEC = 3600
+# Maximum number of sensors and filters in the sensor metadata cache
+SENSOR_METADATA_MAX_SIZE = 200000
+# Version of the sensor metadata cache file format
+SENSOR_METADATA_FORMAT_VERSION = 1
+
+module_logger = logging.getLogger('kat.katportalclient')
+
+
+def _make_directory(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+
+def _save_pickle(filename, entry):
+    """Atomically replace the contents of a cache file."""
+    directory, basename = os.path.split(filename)
+    fd, temp_filename = tempfile.mkstemp(dir=directory, prefix='.' + basename)
+    try:
+        with os.fdopen(fd, 'wb') as cache_file:
+            pickle.dump(entry, cache_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_filename, filename)
+    except Exception:
+        os.remove(temp_filename)
+        raise
+
+
+def normalise_sensor_name(sensor_name):
+    """Return the normalised form of a sensor name, as used by katportal.
+
+    For example, the KATCP-style 'anc.weather.wind-speed' becomes
+    'anc_weather_wind_speed'.
+    """
+    return sensor_name.lower().replace('.', '_').replace('-', '_')
+
+
+class SensorHistoryCache(object):
+    """Persistent local cache of sensor sample histories.
+
+    Each sensor's samples are stored in a single file in the cache directory,
+    named after the normalised sensor name, in columnar form, together with
+    the list of time intervals that have been fully retrieved from
+    katportal.  Only the parts of a query that are not covered by these
+    intervals need to be requested from katportal.
+
+    A query loads the sensor's entry once with :meth:`load`, finds the
+    :meth:`gaps`, adds the samples retrieved for them with :meth:`update`,
+    takes the :meth:`samples` it needs, and finally :meth:`save`\s the entry.
+
+    Parameters
+    ----------
+    directory: str
+        Directory to store the cache files in.  It is created if it does
+        not exist.
+    min_age_sec: float
+        Samples more recent than this are not stored, since the archive
+        may still be receiving data for that period.
+    logger: logging.Logger
+        Optional logger instance (default=None).
+    """
+
+    def __init__(self, directory, min_age_sec=HISTORY_CACHE_MIN_AGE_SEC,
+                 logger=None):
+        self._logger = logger or module_logger
+        self.directory = directory
+        self.min_age_sec = min_age_sec
+        _make_directory(directory)
+
+    def _filename(self, sensor_name):
+        # quoted, so that the file stays in the cache directory
+        return os.path.join(
+            self.directory,
+            quote(normalise_sensor_name(sensor_name), safe='') + '.history')
+
+    def load(self, sensor_name):
+        """Return the cached data for a sensor, or an empty entry.
+
+        Returns
+        -------
+        dict:
+            With the 'sensor_name', the covered 'intervals', and the cached
+            'samples' as a :class:`.SampleColumns`.
+        """
+        stored = None
+        try:
+            with open(self._filename(sensor_name), 'rb') as cache_file:
+                stored = pickle.load(cache_file)
+        except IOError as exc:
+            if exc.errno != errno.ENOENT:
+                self._logger.exception(
+                    "Failed to read history cache for %s", sensor_name)
+        except Exception:
+            self._logger.exception(
+                "Ignoring corrupt history cache for %s", sensor_name)
+        entry = {'sensor_name': sensor_name, 'intervals': [],
+                 'samples': SampleColumns()}
+        if stored and stored.get('version') == HISTORY_CACHE_FORMAT_VERSION:
+            entry['intervals'] = stored['intervals']
+            entry['samples'] = SampleColumns(
+                *[stored[name] for name in SampleColumns.COLUMNS])
+        return entry
+
+    def save(self, entry):
+        """Atomically replace the cached data for a sensor."""
+        stored = {'version': HISTORY_CACHE_FORMAT_VERSION,
+                  'intervals': entry['intervals']}
+        for name in SampleColumns.COLUMNS:
+            stored[name] = getattr(entry['samples'], name)
+        _save_pickle(self._filename(entry['sensor_name']), stored)
+
+    @staticmethod
+    def _is_covered(intervals, timestamp):
+        index = bisect.bisect_right(intervals, [timestamp, float('inf')]) - 1
+        return index >= 0 and intervals[index][1] >= timestamp
+
+    @staticmethod
+    def _add_interval(intervals, start_time_sec, end_time_sec):
+        merged = []
+        for interval in sorted(intervals + [[start_time_sec, end_time_sec]]):
+            if merged and interval[0] <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], interval[1])
+            else:
+                merged.append(list(interval))
+        return merged
+
+    def gaps(self, entry, start_time_sec, end_time_sec):
+        """Return the parts of a time range that are not in the cache.
+
+        Returns
+        -------
+        list:
+            List of (start_time_sec, end_time_sec) tuples, in time order.
+            The end points of a gap may be covered by the cache.
+        """
+        intervals = entry['intervals']
+        if start_time_sec >= end_time_sec:
+            if self._is_covered(intervals, start_time_sec):
+                return []
+            return [(start_time_sec, end_time_sec)]
+        gaps = []
+        gap_start = start_time_sec
+        for interval_start, interval_end in intervals:
+            if interval_end < gap_start:
+                continue
+            if interval_start > end_time_sec:
+                break
+            if interval_start > gap_start:
+                gaps.append((gap_start, interval_start))
+            gap_start = max(gap_start, interval_end)
+        if gap_start < end_time_sec:
+            gaps.append((gap_start, end_time_sec))
+        return gaps
+
+    def samples(self, entry, start_time_sec, end_time_sec):
+        """Return the cached samples in a time range, as a :class:`.SampleColumns`."""
+        return entry['samples'].between(start_time_sec, end_time_sec)
+
+    def update(self, entry, start_time_sec, end_time_sec, samples,
+               complete=True):
+        """Add the samples retrieved for a time range to a cache entry.
+
+        Samples that are already in the cache are discarded.  If the samples
+        are `complete` for the time range, the part of the range that is old
+        enough is marked as covered, and its samples are stored.  The entry
+        is not saved.
+
+        Parameters
+        ----------
+        entry: dict
+            The sensor's entry, see :meth:`load`.
+        start_time_sec: float
+            Start of the time range that was queried.
+        end_time_sec: float
+            End of the time range that was queried.
+        samples: :class:`.SampleColumns`
+            The samples retrieved, in time order.
+        complete: bool
+            True if the samples are all the samples in the time range, i.e.
+            the query was not truncated.
+
+        Returns
+        -------
+        :class:`.SampleColumns`:
+            The samples that are neither in the cache, nor were stored.
+        """
+        intervals = entry['intervals']
+        new_indices = [index for index, timestamp in enumerate(samples.timestamp)
+                       if not self._is_covered(intervals, timestamp)]
+        cacheable_end_sec = min(end_time_sec, time.time() - self.min_age_sec)
+        if not complete or cacheable_end_sec < start_time_sec:
+            return samples.take(new_indices)
+
+        # the samples are time ordered, so the stored ones come first
+        num_stored = bisect.bisect_right(
+            [samples.timestamp[index] for index in new_indices], cacheable_end_sec)
+        entry['samples'].insert(samples.take(new_indices[:num_stored]))
+        entry['intervals'] = self._add_interval(
+            intervals, start_time_sec, cacheable_end_sec)
+        return samples.take(new_indices[num_stored:])
+
+
+class SitemapCache(object):
+    """Persistent local cache of katportal sitemaps.
+
+    Each sitemap is stored in its own file in the cache directory, with the
+    time it was fetched, and the 'ETag' and 'Last-Modified' headers of the
+    response, so that a stale sitemap can be revalidated with a conditional
+    request.
+
+    Parameters
+    ----------
+    directory: str
+        Directory to store the cache files in.  It is created if it does
+        not exist.
+    ttl_sec: float
+        Age after which a cached sitemap is stale, and should be revalidated
+        (default=SITEMAP_CACHE_TTL_SEC).
+    logger: logging.Logger
+        Optional logger instance (default=None).
+    """
+
+    def __init__(self, directory, ttl_sec=SITEMAP_CACHE_TTL_SEC, logger=None):
+        self._logger = logger or module_logger
+        self.directory = directory
+        self.ttl_sec = ttl_sec
+        _make_directory(directory)
+
+    def _filename(self, url):
+        return os.path.join(
+            self.directory, hashlib.sha1(url).hexdigest() + '.sitemap')
+
+    def get(self, url):
+        """Return the cache entry for a sitemap URL, or None.
+
+        Returns
+        -------
+        dict:
+            With the 'sitemap', the 'fetched' timestamp, and the 'etag' and
+            'last_modified' headers of the response (which may be None).
+        """
+        entry = None
+        try:
+            with open(self._filename(url), 'rb') as cache_file:
+                entry = pickle.load(cache_file)
+        except IOError as exc:
+            if exc.errno != errno.ENOENT:
+                self._logger.exception("Failed to read sitemap cache for %s", url)
+        except Exception:
+            self._logger.exception("Ignoring corrupt sitemap cache for %s", url)
+        if (not entry or entry.get('version') != SITEMAP_CACHE_FORMAT_VERSION or
+                entry.get('url') != url):
+            return None
+        return entry
+
+    def is_fresh(self, entry):
+        """Return True if a cache entry does not need to be revalidated yet."""
+        return time.time() - entry['fetched'] < self.ttl_sec
+
+    def put(self, url, sitemap, etag=None, last_modified=None):
+        """Store a sitemap that was fetched from katportal."""
+        _save_pickle(self._filename(url), {
+            'version': SITEMAP_CACHE_FORMAT_VERSION,
+            'url': url,
+            'sitemap': sitemap,
+            'fetched': time.time(),
+            'etag': etag,
+            'last_modified': last_modified
+        })
+
+    def touch(self, url):
+        """Mark a cached sitemap as fresh, after katportal confirmed it."""
+        entry = self.get(url)
+        if entry is not None:
+            self.put(url, entry['sitemap'], entry['etag'], entry['last_modified'])
+
+    def invalidate(self, url):
+        """Remove a sitemap from the cache."""
+        try:
+            os.remove(self._filename(url))
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+
+class SensorMetadataCache(object):
+    """Cache of sensor details, and of the sensor names matching filters.
+
+    Entries expire `ttl_sec` after they were fetched, and the least
+    recently used entries are evicted once there are more than `max_size`.
+    After :meth:`put_all` has stored the details of all the sensors, the
+    cache is complete until one of them expires or is evicted, and a sensor
+    that is not in it does not exist.
+
+    Parameters
+    ----------
+    ttl_sec: float
+        Time for which cached details are used, in seconds
+        (default=SENSOR_METADATA_TTL_SEC).
+    max_size: int
+        Maximum number of cached sensors, and of cached filters
+        (default=SENSOR_METADATA_MAX_SIZE).
+    bulk_load: bool
+        Load the details of all the sensors with a single request, the first
+        time a sensor's details are needed (default=True).
+    filename: str
+        Optional file to persist the cache in, which is loaded if it exists,
+        and rewritten once per client call that fetches details
+        (default=None).
+    logger: logging.Logger
+        Optional logger instance (default=None).
+    """
+
+    def __init__(self, ttl_sec=SENSOR_METADATA_TTL_SEC,
+                 max_size=SENSOR_METADATA_MAX_SIZE, bulk_load=True,
+                 filename=None, logger=None):
+        self._logger = logger or module_logger
+        self.ttl_sec = ttl_sec
+        self.max_size = max_size
+        self.bulk_load = bulk_load
+        self.filename = filename
+        # normalised sensor name -> (fetched timestamp, details)
+        self._details = OrderedDict()
+        # filter -> (fetched timestamp, list of sensor names)
+        self._filters = OrderedDict()
+        # timestamp at which all the sensors were stored, or None
+        self._complete_time = None
+        if filename:
+            self._load()
+
+    def __len__(self):
+        return len(self._details)
+
+    @property
+    def complete(self):
+        """True if the cache has the details of all the sensors."""
+        return (self._complete_time is not None and
+                time.time() - self._complete_time < self.ttl_sec)
+
+    def _lookup(self, entries, key):
+        entry = entries.pop(key, None)
+        if entry is None:
+            return None
+        if time.time() - entry[0] >= self.ttl_sec:
+            return None
+        entries[key] = entry
+        return entry[1]
+
+    def _store(self, entries, key, value, fetched):
+        entries.pop(key, None)
+        entries[key] = (fetched, value)
+        while len(entries) > self.max_size:
+            entries.popitem(last=False)
+            if entries is self._details:
+                self._complete_time = None
+
+    def get(self, sensor_name):
+        """Return a copy of the cached details of a sensor, or None."""
+        details = self._lookup(self._details, normalise_sensor_name(sensor_name))
+        return dict(details) if details is not None else None
+
+    def names(self, sensor_filter):
+        """Return the cached names of the sensors matching a filter, or None."""
+        names = self._lookup(self._filters, sensor_filter)
+        return list(names) if names is not None else None
+
+    def put(self, sensors_details, sensor_filter=None, save=True):
+        """Store sensor details fetched from katportal.
+
+        Parameters
+        ----------
+        sensors_details: list of dict
+            Details of sensors, as returned by :meth:`.sensor_detail`.
+        sensor_filter: str
+            Optional filter that the sensors are all the matches for.
+        save: bool
+            Write the cache to its file (default=True).  When storing the
+            results of many requests, only the last put needs to save.
+        """
+        fetched = time.time()
+        for details in sensors_details:
+            self._store(self._details, normalise_sensor_name(details['name']),
+                        dict(details), fetched)
+        if sensor_filter is not None:
+            self._store(self._filters, sensor_filter,
+                        [details['name'] for details in sensors_details], fetched)
+        if save:
+            self.save()
+
+    def put_all(self, sensors_details):
+        """Store the details of all the sensors, fetched from katportal."""
+        self._details.clear()
+        self._complete_time = time.time()
+        # evicting any of them leaves the cache incomplete again
+        self.put(sensors_details)
+
+    def clear(self):
+        """Remove all the entries from the cache."""
+        self._details.clear()
+        self._filters.clear()
+        self._complete_time = None
+
+    def _load(self):
+        try:
+            with open(self.filename, 'rb') as cache_file:
+                entry = pickle.load(cache_file)
+        except IOError as exc:
+            if exc.errno != errno.ENOENT:
+                self._logger.exception(
+                    "Failed to read sensor metadata cache %s", self.filename)
+            return
+        except Exception:
+            self._logger.exception(
+                "Ignoring corrupt sensor metadata cache %s", self.filename)
+            return
+        if entry.get('version') == SENSOR_METADATA_FORMAT_VERSION:
+            self._details = entry['details']
+            self._filters = entry['filters']
+            self._complete_time = entry['complete_time']
+
+    def save(self):
+        """Write the cache to its file, if it has one."""
+        if self.filename:
+            _save_pickle(self.filename, {
+                'version': SENSOR_METADATA_FORMAT_VERSION,
+                'details': self._details,
+                'filters': self._filters,
+                'complete_time': self._complete_time
+            })
@@ -12,45 +12,86 @@ Websocket client and HTTP module for access to katportal webservers.
 
 
 import base64
+import functools
 import hashlib
 import hmac
 import logging
+import math
+import re
 import uuid
 import time
-from urllib import urlencode
+from urllib import quote, urlencode
 from datetime import timedelta
-from collections import namedtuple
 
 import tornado.gen
 import tornado.ioloop
 import tornado.httpclient
 import tornado.locks
-import omnijson as json
 from tornado.websocket import websocket_connect
 from tornado.httputil import url_concat, HTTPHeaders
 from tornado.httpclient import HTTPRequest
 from tornado.ioloop import PeriodicCallback
 
-from request import JSONRPCRequest
+from cache import (
+    SITEMAP_CACHE_TTL_SEC, SensorHistoryCache, SitemapCache, normalise_sensor_name)
+from codec import JSONError, default_codec
+from connection import HeartbeatMonitor, ReconnectPolicy
+from dispatch import MessageRouter, UpdateBatcher
+from history import (
+    SAMPLE_HISTORY_REQUEST_TIME_TYPE, SAMPLE_HISTORY_REQUEST_MULTIPLIER_TO_SEC,
+    SensorSample, SensorSampleValueTs, SampleListAccumulator,
+    SampleArrayAccumulator, SampleBucketAggregator, SampleChunkQueue,
+    SampleColumnAccumulator, SampleWindowFilter, SensorSampleArrays)
+from request import JSONRPCRequest, JSONRPCRequestCache
+from state import SensorValueTable
+from transport import HTTPTransport
 
 
 # Limit for sensor history queries, in order to preserve memory on katportal.
 MAX_SAMPLES_PER_HISTORY_QUERY = 1000000
+# Maximum length of the URL of a query for the details of many sensors
+SENSOR_QUERY_MAX_URL_LENGTH = 2000
+# Default maximum number of sensor queries in flight at once
+SENSOR_QUERY_MAX_CONCURRENT = 10
 # Pick a reasonable chunk size for sample downloads.  The samples are
 # published in blocks, so many at a time.
 # 43200 = 12 hour chunks if 1 sample every second
 SAMPLE_HISTORY_CHUNK_SIZE = 43200
-# Request sample times  in milliseconds for better precision
-SAMPLE_HISTORY_REQUEST_TIME_TYPE = 'ms'
-SAMPLE_HISTORY_REQUEST_MULTIPLIER_TO_SEC = 1000.0
 
-# Websocket connect and reconnect timeouts
+# Default time to wait for the sitemap, in seconds
+SITEMAP_TIMEOUT = 10
+# Websocket connect timeout (reconnect delays are set by a ReconnectPolicy)
 WS_CONNECT_TIMEOUT = 10
-WS_RECONNECT_INTERVAL = 15
 WS_HEART_BEAT_INTERVAL = 20000  # in milliseconds
+# Number of consecutive unanswered heart beats after which the websocket
+# connection is considered dead, and reconnected
+WS_HEART_BEAT_MAX_MISSED = 3
+# Default maximum number of Pub/Sub updates delivered in a batch
+UPDATE_BATCH_SIZE = 1000
+# Default time to wait for the reply to a JSON-RPC request, in seconds
+JSONRPC_REQUEST_TIMEOUT = 60
+# Maximum number of cached requests waiting for a reply while resending
+# them after a reconnect, and how often to log progress
+RESEND_MAX_CONCURRENT = 100
+RESEND_PROGRESS_INTERVAL = 500
+# JSON-RPC methods that are resent after reconnecting the websocket
+RECONNECT_CACHED_METHODS = ('subscribe', 'unsubscribe', 'set_sampling_strategy',
+                            'set_sampling_strategies')
 
 module_logger = logging.getLogger('kat.katportalclient')
 
+# Characters with a special meaning in katportal's regular expressions
+_REGEX_SPECIAL = re.compile(r'([.^$*+?{}\[\]\\|()])')
+
+
+def _escape_regex(text):
+    """Escape the regular expression characters in text, to match it exactly.
+
+    Unlike `re.escape`, other characters such as '_' are left alone, to keep
+    query URLs short.
+    """
+    return _REGEX_SPECIAL.sub(r'\\\1', text)
+
 
 def create_jwt_login_token(email, password):
     """Creates a JWT login token. See http://jwt.io for the industry standard
@@ -86,53 +127,6 @@ def create_jwt_login_token(email, password):
     return jwt_auth_token
 
 
-class SensorSample(namedtuple('SensorSample', 'timestamp, value, status')):
-    """Class to represent all sensor samples.
-
-    Fields:
-        - timestamp:  float
-            The timestamp (UNIX epoch) the sample was received by CAM.
-            timestamp value is reported with millisecond precision.
-        - value:  str
-            The value of the sensor when sampled.  The units depend on the
-            sensor, see :meth:`.sensor_detail`.
-        - status:  str
-            The status of the sensor when the sample was taken. As defined
-            by the KATCP protocol. Examples: 'nominal', 'warn', 'failure', 'error',
-            'critical', 'unreachable', 'unknown', etc.
-    """
-
-    def csv(self):
-        """Returns sample in comma separated values format."""
-        return '{},{},{}'.format(self.timestamp, self.value, self.status)
-
-
-class SensorSampleValueTs(namedtuple(
-        'SensorSampleValueTs', 'timestamp, value_timestamp, value, status')):
-    """Class to represent sensor samples, including the value_timestamp.
-
-    Fields:
-        - timestamp:  float
-            The timestamp (UNIX epoch) the sample was received by CAM.
-            Timestamp value is reported with millisecond precision.
-        - value_timestamp:  float
-            The timestamp (UNIX epoch) the sample was read at the lowest level sensor.
-            value_timestamp value is reported with millisecond precision.
-        - value:  str
-            The value of the sensor when sampled.  The units depend on the
-            sensor, see :meth:`.sensor_detail`.
-        - status:  str
-            The status of the sensor when the sample was taken. As defined
-            by the KATCP protocol. Examples: 'nominal', 'warn', 'failure', 'error',
-            'critical', 'unreachable', 'unknown', etc.
-    """
-
-    def csv(self):
-        """Returns sample in comma separated values format."""
-        return '{},{},{},{}'.format(
-            self.timestamp, self.value_timestamp, self.value, self.status)
-
-
 class KATPortalClient(object):
     """
     Client providing simple access to katportal.
@@ -154,26 +148,152 @@ class KATPortalClient(object):
         Optional IOLoop instance (default=None).
     logger: logging.Logger
         Optional logger instance (default=None).
+    history_cache_dir: str
+        Optional directory for a persistent local cache of sensor sample
+        histories (default=None, no cache).  If specified,
+        :meth:`.sensor_history` and :meth:`.sensors_histories` only request
+        the parts of a time range that are not already in the cache.
+        See :class:`.SensorHistoryCache`.
+    json_codec: :class:`.JSONCodec`
+        Optional codec for encoding requests and decoding messages and HTTP
+        responses (default=None, the fastest JSON library installed).
+    update_batch_interval_sec: float
+        Optional batching of Pub/Sub updates (default=None, no batching).
+        If specified, updates are coalesced for up to this long, and
+        `on_update_callback` is called with a list of messages, in the order
+        they were received, instead of once per message.
+    update_batch_size: int
+        Maximum number of messages per batch, if batching is enabled
+        (default=UPDATE_BATCH_SIZE).
+    track_sensor_values: bool
+        Optionally keep the latest value of each sensor received via
+        subscriptions in :attr:`.sensor_values` (default=False).
+    request_timeout_sec: float
+        Time to wait for the reply to a websocket request before it fails
+        with a :class:`.RequestTimeoutError`
+        (default=JSONRPC_REQUEST_TIMEOUT, None to wait forever).
+    reconnect_policy: :class:`.ReconnectPolicy`
+        Optional delays between attempts to reconnect the websocket after
+        it drops (default=None, exponential backoff from 1 to 60 seconds).
+    connection_event_callback: function
+        Optional callback for changes to the websocket connection, with
+        signature `def on_connection_event(event, details)`.  `event` is one
+        of 'connected', 'resubscribed', 'connect_failed' or 'disconnected',
+        and `details` is a dict with e.g. the number of the reconnect
+        attempt, the number of resent requests that failed, and durations
+        in seconds (default=None).
+    heart_beat_interval_sec: float
+        Interval between websocket pings that check the connection and
+        measure its round-trip time (default=WS_HEART_BEAT_INTERVAL / 1000).
+    heart_beat_max_missed: int
+        Number of consecutive unanswered pings after which the connection is
+        considered dead and is reconnected (default=WS_HEART_BEAT_MAX_MISSED).
+    http_transport: :class:`.HTTPTransport`
+        Optional HTTP client configuration for the REST endpoints, e.g. the
+        maximum number of simultaneous requests and the timeouts.  Clients
+        may share a transport, and its connections, and the owner of the
+        transport closes it (default=None, tornado's shared AsyncHTTPClient,
+        with the latencies recorded).
+    sitemap_cache_dir: str
+        Optional directory for a persistent local cache of the sitemap
+        (default=None, no cache).  If specified, a cached sitemap is used
+        straight away, and revalidated in the background once it is older
+        than `sitemap_cache_ttl_sec`.  It is refreshed if an endpoint in it
+        is not found.  See :class:`.SitemapCache`.
+    sitemap_cache_ttl_sec: float
+        Age after which a cached sitemap is revalidated, in seconds
+        (default=SITEMAP_CACHE_TTL_SEC).
+    sensor_metadata_cache: :class:`.SensorMetadataCache`
+        Optional cache for :meth:`.sensor_detail` and :meth:`.sensor_names`
+        (default=None, no cache).  Clients may share a cache.
+    sensor_index: :class:`.SensorIndex`
+        Optional local index of the sensor names (default=None, no index).
+        If specified, the names of all the sensors are fetched into it once,
+        and refreshed when it is stale, and :meth:`.sensor_names` evaluates
+        filters locally.  See also :meth:`.load_sensor_index`.
     """
 
-    def __init__(self, url, on_update_callback, io_loop=None, logger=None):
+    def __init__(self, url, on_update_callback, io_loop=None, logger=None,
+                 history_cache_dir=None, json_codec=None,
+                 update_batch_interval_sec=None,
+                 update_batch_size=UPDATE_BATCH_SIZE,
+                 track_sensor_values=False,
+                 request_timeout_sec=JSONRPC_REQUEST_TIMEOUT,
+                 reconnect_policy=None, connection_event_callback=None,
+                 heart_beat_interval_sec=WS_HEART_BEAT_INTERVAL / 1000.0,
+                 heart_beat_max_missed=WS_HEART_BEAT_MAX_MISSED,
+                 http_transport=None, sitemap_cache_dir=None,
+                 sitemap_cache_ttl_sec=SITEMAP_CACHE_TTL_SEC,
+                 sensor_metadata_cache=None, sensor_index=None):
         self._logger = logger or module_logger
+        self._json = json_codec or default_codec
+        self._logger.debug("Using %s JSON backend.", self._json.backend)
         self._url = url
         self._ws = None
         self._ws_connecting_lock = tornado.locks.Lock()
         self._io_loop = io_loop or tornado.ioloop.IOLoop.current()
         self._on_update = on_update_callback
+        self._update_batcher = None
+        if on_update_callback and update_batch_interval_sec is not None:
+            self._update_batcher = UpdateBatcher(
+                on_update_callback, self._io_loop, update_batch_interval_sec,
+                update_batch_size)
+        self._sensor_values = SensorValueTable() if track_sensor_values else None
+        self._router = MessageRouter()
+        # request id -> (future, timeout handle)
         self._pending_requests = {}
-        self._http_client = tornado.httpclient.AsyncHTTPClient()
+        self._request_timeout_sec = request_timeout_sec
+        self._http_transport = (http_transport or
+                                HTTPTransport(force_instance=False))
         self._sitemap = None
+        self._sitemap_future = None
+        self._sitemap_cache = None
+        # True while the sitemap in use was read from the sitemap cache
+        self._sitemap_from_cache = False
+        if sitemap_cache_dir:
+            self._sitemap_cache = SitemapCache(
+                sitemap_cache_dir, sitemap_cache_ttl_sec, logger=self._logger)
         self._sensor_history_states = {}
+        self._sensor_metadata_cache = sensor_metadata_cache
+        self._sensor_index = sensor_index
+        self._all_sensor_details_future = None
+        self._history_cache = None
+        if history_cache_dir:
+            self._history_cache = SensorHistoryCache(
+                history_cache_dir, logger=self._logger)
         self._reference_observer_config = None
         self._disconnect_issued = False
-        self._ws_jsonrpc_cache = []
+        self._reconnect_policy = reconnect_policy or ReconnectPolicy()
+        self._on_connection_event = connection_event_callback
+        self._num_reconnect_failures = 0
+        self._reconnect_timeout = None
+        self._connected_time = None
+        self._ws_jsonrpc_cache = JSONRPCRequestCache()
+        self._heart_beat = HeartbeatMonitor(heart_beat_max_missed)
         self._heart_beat_timer = PeriodicCallback(
-            self._send_heart_beat, WS_HEART_BEAT_INTERVAL)
+            self._send_heart_beat, heart_beat_interval_sec * 1000.0)
         self._current_user_id = None
 
+    @property
+    def json_backend(self):
+        """Name of the JSON library used to encode and decode messages."""
+        return self._json.backend
+
+    @property
+    def num_pending_requests(self):
+        """Number of websocket requests still waiting for a reply."""
+        return len(self._pending_requests)
+
+    @property
+    def sensor_values(self):
+        """Latest values of the sensors received via subscriptions.
+
+        A :class:`.SensorValueTable`, updated as sensor updates arrive, before
+        `on_update_callback` is called, or None if the client was not created
+        with `track_sensor_values` set.
+        """
+        return self._sensor_values
+
     @tornado.gen.coroutine
     def logout(self):
         """ Logs user out of katportal. Katportal then deletes the cached
@@ -182,7 +302,8 @@ class KATPortalClient(object):
         """
         try:
             if self._session_id is not None:
-                url = self.sitemap['authorization'] + '/user/logout'
+                sitemap = yield self.load_sitemap()
+                url = sitemap['authorization'] + '/user/logout'
                 response = yield self.authorized_fetch(
                     url=url, auth_token=self._session_id, method='POST', body='{}')
                 self._logger.info("Logout result: %s", response.body)
@@ -209,16 +330,17 @@ class KATPortalClient(object):
 
         """
         login_token = create_jwt_login_token(username, password)
-        url = self.sitemap['authorization'] + '/user/verify/' + role
+        sitemap = yield self.load_sitemap()
+        url = sitemap['authorization'] + '/user/verify/' + role
         response = yield self.authorized_fetch(url=url, auth_token=login_token)
 
         try:
-            response_json = json.loads(response.body)
+            response_json = self._json.loads(response.body)
             if not response_json.get('logged_in', False) or response_json.get('session_id'):
                 self._session_id = response_json.get('session_id')
                 self._current_user_id = response_json.get('user_id')
 
-                login_url = self.sitemap['authorization'] + '/user/login'
+                login_url = sitemap['authorization'] + '/user/login'
                 response = yield self.authorized_fetch(
                     url=login_url, auth_token=self._session_id,
                     method='POST', body='')
@@ -245,7 +367,39 @@ class KATPortalClient(object):
             "Authorization": "CustomJWT {}".format(auth_token)})
         request = HTTPRequest(
             url, headers=login_header, **kwargs)
-        response = yield self._http_client.fetch(request)
+        response = yield self._fetch(self._sitemap_endpoint(url), request)
+        raise tornado.gen.Return(response)
+
+    def _sitemap_endpoint(self, url):
+        """Return the name of the sitemap endpoint a URL belongs to."""
+        endpoint, endpoint_url = 'other', ''
+        for name, value in (self._sitemap or {}).iteritems():
+            if (isinstance(value, basestring) and len(value) > len(endpoint_url) and
+                    url.startswith(value)):
+                endpoint, endpoint_url = name, value
+        return endpoint
+
+    @tornado.gen.coroutine
+    def _fetch(self, endpoint, request, **kwargs):
+        """
+        Fetch a URL or request via the HTTP transport, timing `endpoint`.
+
+        If the endpoint is not found, and its URL came from the sitemap
+        cache, the cache is out of date, so the sitemap is refreshed in the
+        background.
+        """
+        try:
+            response = yield self._http_transport.fetch(
+                endpoint, request, io_loop=self._io_loop, **kwargs)
+        except tornado.httpclient.HTTPError as exc:
+            if (exc.code == 404 and self._sitemap_from_cache and
+                    endpoint != 'sitemap'):
+                self._logger.warn(
+                    "Endpoint %s not found, refreshing cached sitemap.", endpoint)
+                self._sitemap_from_cache = False
+                self._sitemap_cache.invalidate(self._url)
+                self._start_sitemap_fetch()
+            raise
         raise tornado.gen.Return(response)
 
     def _get_sitemap(self, url):
@@ -253,6 +407,8 @@ class KATPortalClient(object):
         Fetches the sitemap from the specified URL.
 
         See :meth:`.sitemap` for details, including the return value.
+        This blocks the IOLoop until the sitemap arrives, unlike
+        :meth:`.load_sitemap`.
 
         Parameters
         ----------
@@ -267,6 +423,68 @@ class KATPortalClient(object):
         dict:
             Sitemap endpoints - see :meth:`.sitemap`.
         """
+        result = self._empty_sitemap(url)
+        if self._is_http_url(url):
+            http_client = tornado.httpclient.HTTPClient()
+            try:
+                try:
+                    response = http_client.fetch(url)
+                    self._update_sitemap(result, response.body)
+                except tornado.httpclient.HTTPError:
+                    self._logger.exception("Failed to get sitemap!")
+            finally:
+                http_client.close()
+        return result
+
+    @tornado.gen.coroutine
+    def _fetch_sitemap(self, url):
+        """
+        Fetches the sitemap from the specified URL, without blocking.
+
+        If the sitemap is in the sitemap cache, the request is conditional,
+        and the cached sitemap is used if it has not changed, or if the
+        request fails.
+        """
+        result = self._empty_sitemap(url)
+        if not self._is_http_url(url):
+            raise tornado.gen.Return(result)
+        cached = None
+        request = url
+        if self._sitemap_cache is not None:
+            cached = self._sitemap_cache.get(url)
+        if cached is not None and (cached['etag'] or cached['last_modified']):
+            headers = HTTPHeaders()
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+            request = HTTPRequest(url, headers=headers)
+        try:
+            response = yield self._fetch('sitemap', request)
+        except tornado.httpclient.HTTPError as exc:
+            if cached is not None and exc.code == 304:
+                self._logger.debug("Cached sitemap is still valid.")
+                self._sitemap_cache.touch(url)
+                raise tornado.gen.Return(cached['sitemap'])
+            self._logger.exception("Failed to get sitemap!")
+            if cached is not None and exc.code == 404:
+                self._sitemap_cache.invalidate(url)
+            elif cached is not None:
+                raise tornado.gen.Return(cached['sitemap'])
+            raise tornado.gen.Return(result)
+        if (self._update_sitemap(result, response.body) and
+                self._sitemap_cache is not None):
+            self._sitemap_cache.put(
+                url, result, etag=response.headers.get('ETag'),
+                last_modified=response.headers.get('Last-Modified'))
+        raise tornado.gen.Return(result)
+
+    @staticmethod
+    def _is_http_url(url):
+        return (url.lower().startswith('http://') or
+                url.lower().startswith('https://'))
+
+    def _empty_sitemap(self, url):
         result = {
             'authorization': '',
             'websocket': '',
@@ -276,26 +494,95 @@ class KATPortalClient(object):
             'subarray_sensor_values': '',
             'target_descriptions': ''
         }
-        if (url.lower().startswith('http://') or
-                url.lower().startswith('https://')):
-            http_client = tornado.httpclient.HTTPClient()
-            try:
-                try:
-                    response = http_client.fetch(url)
-                    response = json.loads(response.body)
-                    result.update(response['client'])
-                except tornado.httpclient.HTTPError:
-                    self._logger.exception("Failed to get sitemap!")
-                except json.JSONError:
-                    self._logger.exception("Failed to parse sitemap!")
-                except KeyError:
-                    self._logger.exception("Failed to parse sitemap!")
-            finally:
-                http_client.close()
-        else:
+        if not self._is_http_url(url):
             result['websocket'] = url
         return result
 
+    def _update_sitemap(self, result, body):
+        """Update a sitemap from the body of a sitemap response.
+
+        Returns True if the response could be parsed.
+        """
+        try:
+            response = self._json.loads(body)
+            result.update(response['client'])
+        except JSONError:
+            self._logger.exception("Failed to parse sitemap!")
+        except KeyError:
+            self._logger.exception("Failed to parse sitemap!")
+        else:
+            return True
+        return False
+
+    @tornado.gen.coroutine
+    def load_sitemap(self, refresh=False, timeout_sec=SITEMAP_TIMEOUT):
+        """
+        Fetches the sitemap without blocking the IOLoop.
+
+        The sitemap is only fetched once, unless it is refreshed, and
+        concurrent calls wait for the same request.  With a sitemap cache,
+        a cached sitemap is returned without waiting, and is revalidated in
+        the background if it is stale.  :meth:`connect` calls
+        this, and so does each method that needs the sitemap, so that the
+        :attr:`sitemap` property, which blocks the IOLoop if the sitemap has
+        not been fetched yet, can be used freely afterwards.
+
+        Parameters
+        ----------
+        refresh: bool
+            Fetch the sitemap again, even if it was already fetched, e.g.
+            after katportal was reconfigured (default=False).
+        timeout_sec: float
+            Time to wait for the sitemap, in seconds.  The request carries on
+            after a timeout, and later calls wait for it
+            (default=SITEMAP_TIMEOUT, None to wait forever).
+
+        Returns
+        -------
+        dict:
+            Sitemap endpoints - see :attr:`sitemap`.
+
+        Raises
+        ------
+        tornado.gen.TimeoutError:
+            If the sitemap did not arrive in time.
+        """
+        if self._sitemap and not refresh:
+            raise tornado.gen.Return(self._sitemap)
+        if self._sitemap_cache is not None and not refresh:
+            cached = self._sitemap_cache.get(self._url)
+            if cached is not None:
+                self._sitemap = cached['sitemap']
+                self._sitemap_from_cache = True
+                self._logger.debug("Cached sitemap: %s.", self._sitemap)
+                if not self._sitemap_cache.is_fresh(cached):
+                    self._logger.debug("Revalidating cached sitemap.")
+                    self._start_sitemap_fetch()
+                raise tornado.gen.Return(self._sitemap)
+        future = self._start_sitemap_fetch()
+        if timeout_sec is not None:
+            future = tornado.gen.with_timeout(
+                timedelta(seconds=timeout_sec), future, io_loop=self._io_loop)
+        sitemap = yield future
+        raise tornado.gen.Return(sitemap)
+
+    def _start_sitemap_fetch(self):
+        """Return the future of the sitemap request, making one if needed."""
+        future = self._sitemap_future
+        if future is None:
+            future = self._sitemap_future = self._fetch_sitemap(self._url)
+            future.add_done_callback(self._sitemap_fetched)
+        return future
+
+    def _sitemap_fetched(self, future):
+        self._sitemap_future = None
+        if future.exception() is None:
+            self._sitemap = future.result()
+            self._sitemap_from_cache = False
+            self._logger.debug("Sitemap: %s.", self._sitemap)
+        else:
+            self._logger.error("Failed to get sitemap: %s", future.exception())
+
     @property
     def sitemap(self):
         """
@@ -303,9 +590,12 @@ class KATPortalClient(object):
 
         The portal webserver provides a sitemap with a number of URLs.  The
         endpoints could change over time, but the keys to access them will not.
-        The websever is only queried once, the first time the property is
-        accessed.  Typically users will not need to access the sitemap
-        directly - the class's methods make use of it.
+        The websever is only queried once, by :meth:`load_sitemap` or the
+        first time the property is accessed.  Accessing the property first
+        blocks the IOLoop during that request, so in a coroutine call
+        :meth:`load_sitemap` (or :meth:`connect`) instead.  Typically users
+        will not need to access the sitemap directly - the class's methods
+        make use of it.
 
         Returns
         -------
@@ -334,6 +624,7 @@ class KATPortalClient(object):
 
         """
         if not self._sitemap:
+            self._logger.debug("Fetching sitemap synchronously.")
             self._sitemap = self._get_sitemap(self._url)
             self._logger.debug("Sitemap: %s.", self._sitemap)
         return self._sitemap
@@ -357,55 +648,139 @@ class KATPortalClient(object):
             websocket connection. If this is True the websocket connection will attempt
             to resend the subscriptions and sampling strategies that was sent while the
             websocket connection was open. If the websocket connection cannot reconnect,
-            it will try again periodically. If this is false and the websocket cannot be
-            connected, no further attempts will be made to connect.
+            it will try again, with delays given by the client's reconnect policy.
+            If this is false and the websocket cannot be connected, no further
+            attempts will be made to connect.
         """
         # The lock is used to ensure only a single connection can be made
         with (yield self._ws_connecting_lock.acquire()):
             self._disconnect_issued = False
+            self._reconnect_timeout = None
             if not self.is_connected:
                 self._logger.debug(
                     "Connecting to websocket %s", self.sitemap['websocket'])
                 try:
                     if self._heart_beat_timer.is_running():
                         self._heart_beat_timer.stop()
+                    connect_start_time = time.time()
+                    connection = []
                     self._ws = yield websocket_connect(
                         self.sitemap['websocket'],
-                        on_message_callback=self._websocket_message,
+                        on_message_callback=functools.partial(
+                            self._connection_message, connection),
                         connect_timeout=WS_CONNECT_TIMEOUT)
+                    connection.append(self._ws)
+                    self._ws.on_pong = self._heart_beat_pong
+                    self._heart_beat.reset()
+                    self._connected_time = time.time()
+                    self._connection_event(
+                        'connected', reconnecting=reconnecting,
+                        attempt=self._num_reconnect_failures + 1,
+                        duration_sec=self._connected_time - connect_start_time)
                     if reconnecting:
-                        yield self._resend_subscriptions_and_strategies()
+                        num_failed = (
+                            yield self._resend_subscriptions_and_strategies())
+                        self._connection_event(
+                            'resubscribed',
+                            num_requests=len(self._ws_jsonrpc_cache),
+                            num_failed=num_failed,
+                            duration_sec=time.time() - self._connected_time)
                         self._logger.info("Reconnected :)")
+                    self._num_reconnect_failures = 0
                     self._heart_beat_timer.start()
                 except Exception:
                     self._logger.exception(
                         'Could not connect websocket to %s',
                         self.sitemap['websocket'])
                     if reconnecting:
+                        self._num_reconnect_failures += 1
+                        delay_sec = self._reconnect_policy.delay(
+                            self._num_reconnect_failures)
+                        self._connection_event(
+                            'connect_failed', attempt=self._num_reconnect_failures,
+                            retry_delay_sec=delay_sec)
                         self._logger.info(
-                            'Retrying connection in %s seconds...', WS_RECONNECT_INTERVAL)
-                        self._io_loop.call_later(
-                            WS_RECONNECT_INTERVAL, self._connect, True)
+                            'Retrying connection in %.1f seconds...', delay_sec)
+                        self._reconnect_timeout = self._io_loop.call_later(
+                            delay_sec, self._connect, True)
                 if not self.is_connected and not reconnecting:
                     self._logger.error("Failed to connect!")
 
+    def _connection_event(self, event, **details):
+        """Report a change to the websocket connection to the user."""
+        if self._on_connection_event:
+            self._io_loop.add_callback(self._on_connection_event, event, details)
+
+    def _report_disconnected(self):
+        if self._connected_time is not None:
+            self._connection_event(
+                'disconnected', connected_sec=time.time() - self._connected_time)
+            self._connected_time = None
+
+    def _connection_message(self, connection, msg):
+        """Pass on a message from a websocket connection.
+
+        A connection that was already replaced, e.g. after it was closed
+        to reconnect, reports its close (a None message) late, and that
+        must not close the current connection as well.
+        """
+        if msg is None and connection and connection[0] is not self._ws:
+            self._logger.debug("Ignoring close of previous websocket connection.")
+            return
+        return self._websocket_message(msg)
+
     @tornado.gen.coroutine
     def connect(self):
         """Connect to the websocket server specified during instantiation."""
+        yield self.load_sitemap()
         yield self._connect(reconnecting=False)
 
     @tornado.gen.coroutine
     def _send_heart_beat(self):
         """
-        Sends a PING message to katportal to test if the websocket connection is still
-        alive. If there is an error sending this message, tornado will call the
-        _websocket_message callback function with None as the message, where we realise
-        that the websocket connection has failed.
+        Sends a websocket ping to katportal to test if the websocket connection is still
+        alive, and to measure its round-trip time. If too many consecutive pings are
+        not answered (e.g. the connection is half open), the connection is treated as
+        closed by the server, and reconnected. If there is an error sending the ping,
+        tornado will call the _websocket_message callback function with None as the
+        message, where we realise that the websocket connection has failed.
         """
-        if self._ws is not None:
-            self._ws.write_message('PING')
-        else:
+        if self._ws is None:
             self._logger.debug('Attempting to send a PING over a closed websocket!')
+            return
+        payload = self._heart_beat.ping()
+        if self._heart_beat.dead:
+            self._logger.warn('No reply to the last %d heart beats!',
+                              self._heart_beat.num_missed)
+            yield self._websocket_message(None)
+        elif hasattr(self._ws, 'ping'):
+            self._ws.ping(payload)
+        else:
+            # tornado < 5 has no public ping method on client connections
+            self._ws.protocol.write_ping(payload)
+
+    def _heart_beat_pong(self, data):
+        round_trip_time = self._heart_beat.pong(data)
+        if round_trip_time is not None:
+            self._logger.debug('Heart beat round-trip time: %.3f seconds.',
+                               round_trip_time)
+
+    @property
+    def heart_beat_latency(self):
+        """Statistics of the recent heart beat round-trip times, in seconds.
+
+        See :meth:`.HeartbeatMonitor.latency_stats`.
+        """
+        return self._heart_beat.latency_stats()
+
+    @property
+    def http_latency(self):
+        """Statistics of the recent HTTP request latencies, in seconds.
+
+        A dict of endpoint name, e.g. 'sensor_detail', to statistics.  See
+        :meth:`.HTTPTransport.latency_stats`.
+        """
+        return self._http_transport.latency_stats()
 
     def disconnect(self):
         """Disconnect from the connected websocket server."""
@@ -413,13 +788,21 @@ class KATPortalClient(object):
             self._heart_beat_timer.stop()
 
         self._disconnect_issued = True
-        self._ws_jsonrpc_cache = []
+        if self._reconnect_timeout is not None:
+            self._io_loop.remove_timeout(self._reconnect_timeout)
+            self._reconnect_timeout = None
+        self._ws_jsonrpc_cache = JSONRPCRequestCache()
         self._logger.debug("Cleared JSONRPCRequests cache.")
+        self._router = MessageRouter()
+        if self._update_batcher is not None:
+            self._update_batcher.flush()
 
         if self.is_connected:
             self._ws.close()
             self._ws = None
             self._logger.debug("Disconnected client websocket.")
+        self._report_disconnected()
+        self._fail_pending_requests("Websocket disconnected")
 
     def _cache_jsonrpc_request(self, jsonrpc_request):
         """
@@ -450,65 +833,75 @@ class KATPortalClient(object):
         katportal.
 
         JSONRPCRequests with identical methods and params will not be cached more than
-        once.
-        """
-        requests_to_remove = []
-        if jsonrpc_request.method == 'unsubscribe':
-            for req in self._ws_jsonrpc_cache:
-                # match namespace and subscription string for subscribes
-                if (req.method == 'subscribe' and
-                        req.params == jsonrpc_request.params):
-                    requests_to_remove.append(req)
-        elif (jsonrpc_request.method.startswith('set_sampling_strat') and
-              jsonrpc_request.params[2] == 'none'):
-            # index 2 of params is always the sampling strategy
-            for req in self._ws_jsonrpc_cache:
-                # match the namespace and sensor/filter combination
-                # namespace is always at index 0 of params and sensor/filter
-                # is always at index 1
-                if (req.method == jsonrpc_request.method and
-                        req.params[0] == jsonrpc_request.params[0] and
-                        req.params[1] == jsonrpc_request.params[1]):
-                    requests_to_remove.append(req)
-        else:
-            duplicate_found = False
-            for req in self._ws_jsonrpc_cache:
-                # check if there is a difference between the items in the dict of existing
-                # JSONRPCRequests, if we find that we already have this JSONRPCRequest in
-                # the cache, don't add it to the cache.
-                duplicate_found = (req.method_and_params_hash() ==
-                                   jsonrpc_request.method_and_params_hash())
-                if duplicate_found:
-                    break
-            if not duplicate_found:
-                self._ws_jsonrpc_cache.append(jsonrpc_request)
-
-        for req in requests_to_remove:
-            self._ws_jsonrpc_cache.remove(req)
+        once, and a sampling strategy replaces the previous strategy for the same
+        sensor or filter.  See :class:`.JSONRPCRequestCache`.
+        """
+        self._ws_jsonrpc_cache.add(jsonrpc_request)
+
+    @tornado.gen.coroutine
+    def _resend_requests(self, requests):
+        """Resend cached requests, with up to RESEND_MAX_CONCURRENT in flight.
+
+        The requests are written in order, without waiting for each reply,
+        and progress is logged as the replies arrive.  A request that fails,
+        e.g. times out, is logged, and does not stop the others.
+
+        Returns
+        -------
+        int:
+            Number of requests that failed.
+        """
+        semaphore = tornado.locks.Semaphore(RESEND_MAX_CONCURRENT)
+        num_resent = [0]
+        num_failed = [0]
+
+        @tornado.gen.coroutine
+        def resend(req):
+            try:
+                result = yield self._send(req)
+                self._logger.debug(
+                    'Resent JSONRPCRequest %s, with result: %s', req, result)
+            except Exception as exc:
+                num_failed[0] += 1
+                self._logger.error(
+                    'Failed to resend JSONRPCRequest %s: %s', req, exc)
+            finally:
+                semaphore.release()
+                num_resent[0] += 1
+                if (num_resent[0] % RESEND_PROGRESS_INTERVAL == 0 or
+                        num_resent[0] == len(requests)):
+                    self._logger.info(
+                        'Resent %d of %d JSONRPCRequests (%d failed).',
+                        num_resent[0], len(requests), num_failed[0])
+
+        futures = []
+        for req in requests:
+            yield semaphore.acquire()
+            futures.append(resend(req))
+        yield futures
+        raise tornado.gen.Return(num_failed[0])
 
     @tornado.gen.coroutine
     def _resend_subscriptions_and_strategies(self):
         """
         Resend the cached subscriptions and strategies that has been set while
         the websocket connection was connected. This cache is cleared when a
-        disconnect is issued by the client. The cache is a list of
-        JSONRPCRequests"""
-        for req in self._ws_jsonrpc_cache:
-            self._logger.info('Resending JSONRPCRequest %s', req)
-            result = yield self._send(req)
-            self._logger.info('Resent JSONRPCRequest, with result: %s', result)
+        disconnect is issued by the client. The cache is a
+        :class:`.JSONRPCRequestCache`."""
+        self._logger.info('Resending %d JSONRPCRequests.',
+                          len(self._ws_jsonrpc_cache))
+        num_failed = yield self._resend_requests(list(self._ws_jsonrpc_cache))
+        raise tornado.gen.Return(num_failed)
 
     @tornado.gen.coroutine
     def _resend_subscriptions(self):
         """
         Resend the cached subscriptions only. This is necessary when we receive
         a redis-reconnect server message."""
-        for req in self._ws_jsonrpc_cache:
-            if req.method == 'subscribe':
-                self._logger.info('Resending JSONRPCRequest %s', req)
-                result = yield self._send(req)
-                self._logger.info(
-                    'Resent JSONRPCRequest, with result: %s', result)
+        subscriptions = [req for req in self._ws_jsonrpc_cache
+                         if req.method == 'subscribe']
+        self._logger.info('Resending %d subscriptions.', len(subscriptions))
+        yield self._resend_requests(subscriptions)
 
     @tornado.gen.coroutine
     def _websocket_message(self, msg):
@@ -529,6 +922,8 @@ class KATPortalClient(object):
         """
         if msg is None:
             self._logger.warn("Websocket server disconnected!")
+            self._fail_pending_requests("Websocket server disconnected")
+            self._report_disconnected()
             if not self._disconnect_issued:
                 if self._ws is not None:
                     self._ws.close()
@@ -536,7 +931,7 @@ class KATPortalClient(object):
                 yield self._connect(reconnecting=True)
             return
         try:
-            msg = json.loads(msg)
+            msg = self._json.loads(msg)
             self._logger.debug("Message received: %s", msg)
             msg_id = str(msg['id'])
             if msg_id.startswith('redis-pubsub'):
@@ -553,7 +948,7 @@ class KATPortalClient(object):
             self._logger.exception(
                 "Error processing websocket message! {}".format(msg))
             if self._on_update:
-                self._io_loop.add_callback(self._on_update, msg)
+                self._dispatch_update(msg)
             else:
                 self._logger.warn('Ignoring message (no on_update_callback): %s',
                                   msg)
@@ -581,49 +976,39 @@ class KATPortalClient(object):
                     if inform['done']:
                         state['done_event'].set()
                 elif isinstance(msg_data, list):
-                    num_received = 0
-                    for sample in msg_data:
-                        if len(sample) == 6:
-                            # assume sample data message, extract fields of interest
-                            # (timestamp returned in milliseconds, so scale to seconds)
-                            # example:  [1476164224429L, 1476164223640L,
-                            #            1476164224429354L, u'5.07571614843',
-                            #            u'anc_mean_wind_speed', u'nominal']
-                            if state['include_value_ts']:
-                                # Requesting value_timestamp in addition to
-                                # sample timestamp
-                                sensor_sample = SensorSampleValueTs(
-                                    timestamp=sample[
-                                        0] / SAMPLE_HISTORY_REQUEST_MULTIPLIER_TO_SEC,
-                                    value_timestamp=sample[
-                                        1] / SAMPLE_HISTORY_REQUEST_MULTIPLIER_TO_SEC,
-                                    value=sample[3],
-                                    status=sample[5])
-                            else:
-                                # Only sample timestamp
-                                sensor_sample = SensorSample(
-                                    timestamp=sample[
-                                        0] / SAMPLE_HISTORY_REQUEST_MULTIPLIER_TO_SEC,
-                                    value=sample[3],
-                                    status=sample[5])
-                            state['samples'].append(sensor_sample)
-                            num_received += 1
+                    num_received = state['samples'].add_samples(msg_data)
                     state['num_samples_pending'] -= num_received
                 else:
                     self._logger.warn(
                         'Ignoring unexpected message: %s', msg_result)
                 processed = True
         if not processed:
-            if self._on_update:
-                self._io_loop.add_callback(self._on_update, msg_result)
-            else:
+            if self._sensor_values is not None and isinstance(msg_result, dict):
+                self._sensor_values.update(msg_result.get('msg_data'))
+            handlers = ()
+            if self._router and 'msg_channel' in msg_result:
+                handlers = self._router.route(msg_result['msg_channel'],
+                                              msg_result.get('msg_pattern'))
+            if handlers:
+                for handler in handlers:
+                    self._io_loop.add_callback(handler, msg_result)
+            elif self._on_update:
+                self._dispatch_update(msg_result)
+            elif self._sensor_values is None:
                 self._logger.warn('Ignoring message (no on_update_callback): %s',
                                   msg_result)
 
+    def _dispatch_update(self, update):
+        """Schedule the on_update_callback for an update, or add it to a batch."""
+        if self._update_batcher is not None:
+            self._update_batcher.add(update)
+        else:
+            self._io_loop.add_callback(self._on_update, update)
+
     @tornado.gen.coroutine
     def _process_json_rpc_message(self, msg, msg_id):
         """Internal handler for JSON RPC response messages."""
-        future = self._pending_requests.get(msg_id, None)
+        future = self._pop_pending_request(msg_id)
         if future:
             error = msg.get('error', None)
             result = msg.get('result', None)
@@ -635,12 +1020,49 @@ class KATPortalClient(object):
             self._logger.error(
                 "Message received without a matching pending request! '{}'".format(msg))
 
-    def _send(self, req):
+    def _pop_pending_request(self, req_id):
+        """Stop waiting for the reply to a request, and return its future."""
+        future, timeout = self._pending_requests.pop(req_id, (None, None))
+        if timeout is not None:
+            self._io_loop.remove_timeout(timeout)
+        return future
+
+    def _expire_request(self, req_id, timeout_sec):
+        future = self._pop_pending_request(req_id)
+        if future is not None and not future.done():
+            future.set_exception(RequestTimeoutError(
+                "No reply to request {} after {} seconds".format(req_id, timeout_sec)))
+
+    def _fail_pending_requests(self, reason):
+        """Fail all the requests still waiting for a reply."""
+        if self._pending_requests:
+            self._logger.warn("%s, failing %d pending requests.",
+                              reason, len(self._pending_requests))
+        for req_id in list(self._pending_requests):
+            future = self._pop_pending_request(req_id)
+            if not future.done():
+                future.set_exception(ConnectionClosedError(
+                    "{} before reply to request {}".format(reason, req_id)))
+
+    def _send(self, req, timeout_sec=None):
+        """Send a JSON-RPC request, and return a future for its result.
+
+        The future fails with a :class:`.RequestTimeoutError` if there is no
+        reply within `timeout_sec` (default: the client's request timeout),
+        or with a :class:`.ConnectionClosedError` if the websocket closes
+        before the reply arrives.
+        """
         future = tornado.gen.Future()
         if self.is_connected:
             req_id = str(req.id)
-            self._pending_requests[req_id] = future
-            self._ws.write_message(req())
+            if timeout_sec is None:
+                timeout_sec = self._request_timeout_sec
+            timeout = None
+            if timeout_sec is not None:
+                timeout = self._io_loop.call_later(
+                    timeout_sec, self._expire_request, req_id, timeout_sec)
+            self._pending_requests[req_id] = (future, timeout)
+            self._ws.write_message(req(self._json))
             return future
         else:
             err_msg = "Failed to send request! Not connected."
@@ -655,8 +1077,24 @@ class KATPortalClient(object):
         result = yield self._send(req)
         raise tornado.gen.Return(result)
 
+    @staticmethod
+    def _sub_string_list(sub_strings):
+        """Return subscription string identifiers as a list."""
+        if sub_strings is None:
+            return ['*']
+        elif isinstance(sub_strings, basestring):
+            return [sub_strings]
+        return list(sub_strings)
+
+    @classmethod
+    def _subscription_patterns(cls, namespace, sub_strings):
+        """Return the channel patterns of subscriptions, including the namespace."""
+        # katportal picks the general namespace's name, so match any
+        return ['{}:{}'.format(namespace or '*', sub_string)
+                for sub_string in cls._sub_string_list(sub_strings)]
+
     @tornado.gen.coroutine
-    def subscribe(self, namespace, sub_strings=None):
+    def subscribe(self, namespace, sub_strings=None, handler=None):
         r"""Subscribe to the specified string identifiers in a namespace.
 
         A namespace provides grouping and consist of channels that can be
@@ -732,6 +1170,11 @@ class KATPortalClient(object):
         sub_strings: str or list of str
             The exact and pattern string identifiers to subscribe to.
             Format = [namespace:]channel. Optional (default='*')
+        handler: function
+            Optional callback for the messages of this subscription, with the
+            same signature as a non-batched `on_update_callback`.  Messages
+            with a handler are not passed to `on_update_callback`.
+            (default=None, use `on_update_callback`)
 
         Returns
         -------
@@ -741,6 +1184,9 @@ class KATPortalClient(object):
         req = JSONRPCRequest('subscribe', [namespace, sub_strings])
         result = yield self._send(req)
         self._cache_jsonrpc_request(req)
+        if handler is not None:
+            for pattern in self._subscription_patterns(namespace, sub_strings):
+                self._router.add(pattern, handler)
         raise tornado.gen.Return(result)
 
     @tornado.gen.coroutine
@@ -774,6 +1220,8 @@ class KATPortalClient(object):
         req = JSONRPCRequest('unsubscribe', [namespace, unsub_strings])
         result = yield self._send(req)
         self._cache_jsonrpc_request(req)
+        for pattern in self._subscription_patterns(namespace, unsub_strings):
+            self._router.remove(pattern)
         raise tornado.gen.Return(result)
 
     @tornado.gen.coroutine
@@ -880,12 +1328,108 @@ class KATPortalClient(object):
         self._cache_jsonrpc_request(req)
         raise tornado.gen.Return(result)
 
+    @tornado.gen.coroutine
+    def send_batch(self, requests, timeout_sec=None, return_exceptions=False):
+        """Send many JSON-RPC requests, without waiting for each reply.
+
+        All the requests are written to the websocket straight away, and
+        the replies are matched up as they arrive, so a batch takes about
+        one round trip instead of one per request.  Subscriptions and
+        sampling strategies that succeed are remembered for reconnects, as
+        if they were sent individually, even if other requests fail.
+
+        Parameters
+        ----------
+        requests: list of :class:`.JSONRPCRequest`
+            The requests to send, e.g. 'subscribe' or 'set_sampling_strategy'
+            requests.
+        timeout_sec: float
+            Time to wait for the reply to each request (default=None, use the
+            client's request timeout).
+        return_exceptions: bool
+            If True, the exception of each failed request is returned in
+            place of its result.  Otherwise, the first failure is raised
+            once all the requests have finished (default=False).
+
+        Returns
+        -------
+        list
+            The results of the requests, in the same order.
+        """
+        outcomes = yield [self._send_outcome(req, timeout_sec)
+                          for req in requests]
+        results = []
+        first_error = None
+        for req, (succeeded, result) in zip(requests, outcomes):
+            if succeeded and req.method in RECONNECT_CACHED_METHODS:
+                self._cache_jsonrpc_request(req)
+            elif not succeeded and first_error is None:
+                first_error = result
+            results.append(result)
+        if first_error is not None and not return_exceptions:
+            raise first_error
+        raise tornado.gen.Return(results)
+
+    @tornado.gen.coroutine
+    def _send_outcome(self, req, timeout_sec):
+        """Send a JSON-RPC request, and return (succeeded, result or error)."""
+        try:
+            result = yield self._send(req, timeout_sec)
+        except Exception as exc:
+            raise tornado.gen.Return((False, exc))
+        raise tornado.gen.Return((True, result))
+
+    @tornado.gen.coroutine
+    def set_sampling_strategy_batch(self, namespace, strategies,
+                                    persist_to_redis=False):
+        """Set up sensor strategies for many individual sensors at once.
+
+        This is equivalent to calling :meth:`.set_sampling_strategy` for each
+        sensor, but the requests are pipelined with :meth:`.send_batch`.
+
+        Parameters
+        ----------
+        namespace: str
+            Namespace with the relevant sensor subscriptions. If empty string
+            '', the general namespace will be used.
+        strategies: dict
+            Exact sensor name -> strategy and its optional parameters, as for
+            :meth:`.set_sampling_strategy`, e.g.
+            {'m063_ap_connected': 'event', 'anc_mean_wind_speed': 'period 1'}
+        persist_to_redis: bool
+            Whether to persist the sensor updates to redis or not
+            (default=False).
+
+        Returns
+        -------
+        dict
+            Dictionary with sensor names, as given, as keys and results as
+            values, as for :meth:`.set_sampling_strategies`.  If a request
+            failed, its value is the JSON-RPC error instead.
+        """
+        sensor_names = list(strategies)
+        requests = [
+            JSONRPCRequest('set_sampling_strategy',
+                           [namespace, sensor_name, strategies[sensor_name],
+                            persist_to_redis])
+            for sensor_name in sensor_names]
+        results = yield self.send_batch(requests)
+        combined = {}
+        for sensor_name, result in zip(sensor_names, results):
+            if isinstance(result, dict) and sensor_name in result:
+                result = result[sensor_name]
+            elif isinstance(result, dict) and len(result) == 1:
+                # keyed by katportal's form of the sensor name
+                result, = result.values()
+            combined[sensor_name] = result
+        raise tornado.gen.Return(combined)
+
     def _extract_schedule_blocks(self, json_text, subarray_number):
         """Extract and return list of schedule block IDs from a JSON response."""
-        data = json.loads(json_text)
+        data = self._json.loads(json_text)
         results = []
         if data['result']:
-            schedule_blocks = json.loads(data['result'])
+            schedule_blocks = self._json.loads(data['result'])
             for schedule_block in schedule_blocks:
                 if (schedule_block['sub_nr'] == subarray_number and
                         schedule_block['type'] == 'OBSERVATION'):
@@ -916,10 +1460,11 @@ class KATPortalClient(object):
             priority of the schedule blocks (first has hightest priority).
 
         """
-        url = self.sitemap['schedule_blocks'] + '/scheduled'
-        response = yield self._http_client.fetch(url)
+        sitemap = yield self.load_sitemap()
+        url = sitemap['schedule_blocks'] + '/scheduled'
+        response = yield self._fetch('schedule_blocks', url)
         results = self._extract_schedule_blocks(response.body,
-                                                int(self.sitemap['sub_nr']))
+                                                int(sitemap['sub_nr']))
         raise tornado.gen.Return(results)
 
     @tornado.gen.coroutine
@@ -979,7 +1524,7 @@ class KATPortalClient(object):
         sb_targets = sb.get('targets')
         if sb_targets is not None:
             try:
-                targets_list = json.loads(sb_targets)
+                targets_list = self._json.loads(sb_targets)
             except Exception:
                 raise ScheduleBlockTargetsParsingError(
                     'There was an error parsing the schedule block (%s) '
@@ -1050,9 +1595,10 @@ class KATPortalClient(object):
         ScheduleBlockNotFoundError:
             If no information was available for the requested schedule block.
         """
-        url = self.sitemap['schedule_blocks'] + '/' + id_code
-        response = yield self._http_client.fetch(url)
-        response = json.loads(response.body)
+        sitemap = yield self.load_sitemap()
+        url = sitemap['schedule_blocks'] + '/' + id_code
+        response = yield self._fetch('schedule_blocks', url)
+        response = self._json.loads(response.body)
         schedule_block = response['result']
         if not schedule_block:
             raise ScheduleBlockNotFoundError(
@@ -1061,7 +1607,7 @@ class KATPortalClient(object):
 
     def _extract_sensors_details(self, json_text):
         """Extract and return list of sensor names from a JSON response."""
-        sensors = json.loads(json_text)
+        sensors = self._json.loads(json_text)
         results = []
         # Errors are returned in dict, while valid data is returned in a list.
         if isinstance(sensors, dict):
@@ -1077,8 +1623,78 @@ class KATPortalClient(object):
                 results.append(sensor_info)
         return results
 
+    def _load_all_sensor_details(self):
+        """Return the future of the request for the details of all the sensors.
+
+        The sensor metadata cache is updated when it completes, and
+        concurrent callers wait for the same request.
+        """
+        future = self._all_sensor_details_future
+        if future is None:
+            future = self._all_sensor_details_future = (
+                self._fetch_all_sensor_details())
+            future.add_done_callback(self._all_sensor_details_fetched)
+        return future
+
     @tornado.gen.coroutine
-    def sensor_names(self, filters):
+    def _fetch_all_sensor_details(self):
+        sitemap = yield self.load_sitemap()
+        url = sitemap['historic_sensor_values'] + '/sensors'
+        response = yield self._fetch('sensor_detail', url + '?sensors=.*')
+        results = self._extract_sensors_details(response.body)
+        self._logger.debug("Loaded details of %d sensors.", len(results))
+        if self._sensor_metadata_cache is not None:
+            self._sensor_metadata_cache.put_all(results)
+        if self._sensor_index is not None:
+            added, removed = self._sensor_index.update(
+                result['name'] for result in results)
+            self._logger.debug("Sensor index: %d added, %d removed.",
+                               len(added), len(removed))
+
+    def _all_sensor_details_fetched(self, future):
+        self._all_sensor_details_future = None
+        if future.exception() is not None:
+            self._logger.error("Failed to load all sensor details: %s",
+                               future.exception())
+
+    @property
+    def sensor_index(self):
+        """The local :class:`.SensorIndex` of sensor names, or None."""
+        return self._sensor_index
+
+    @tornado.gen.coroutine
+    def load_sensor_index(self, refresh=False):
+        """
+        Fetches the names of all the sensors into the local sensor index.
+
+        The names are only fetched if the index is empty, or if it is stale,
+        in which case the current names are used while they are refreshed in
+        the background.
+
+        Parameters
+        ----------
+        refresh: bool
+            Fetch the names, and wait for them, even if the index is not
+            stale (default=False).
+
+        Returns
+        -------
+        :class:`.SensorIndex`:
+            The index, which can be searched with regular expressions and
+            glob-style patterns.
+        """
+        index = self._sensor_index
+        if index is None:
+            raise ValueError("The client was created without a sensor_index")
+        if refresh or not index.loaded:
+            yield self._load_all_sensor_details()
+        elif index.stale:
+            self._load_all_sensor_details()
+        raise tornado.gen.Return(index)
+
+    @tornado.gen.coroutine
+    def sensor_names(self, filters, max_concurrent=SENSOR_QUERY_MAX_CONCURRENT,
+                     merge_filters=False):
         """Return list of matching sensor names.
 
         Provides the list of available sensors in the system that match the
@@ -1095,6 +1711,17 @@ class KATPortalClient(object):
         filters: str or list of str
             List of regular expression patterns to match.
             See :meth:`.set_sampling_strategies` for more detail.
+        max_concurrent: int
+            Maximum number of filters queried at once
+            (default=SENSOR_QUERY_MAX_CONCURRENT).
+        merge_filters: bool
+            Combine the filters into a few alternations, e.g. 'a|b', which
+            are queried instead of each filter.  Filters with backslashes or
+            groups with special meanings are still queried on their own
+            (default=False).
+
+        If the client has a sensor index, the filters are evaluated locally
+        instead, and `max_concurrent` and `merge_filters` do not apply.
 
         Returns
         -------
@@ -1106,23 +1733,75 @@ class KATPortalClient(object):
         SensorNotFoundError:
             - If any of the filters were invalid regular expression patterns.
         """
-        url = self.sitemap['historic_sensor_values'] + '/sensors'
         if isinstance(filters, str):
             filters = [filters]
+        if self._sensor_index is not None:
+            index = yield self.load_sensor_index()
+            try:
+                names = index.search_all(filters)
+            except re.error as exc:
+                raise SensorNotFoundError(
+                    "Invalid sensor request: {}".format(exc))
+            raise tornado.gen.Return(names)
+        sitemap = yield self.load_sitemap()
+        url = sitemap['historic_sensor_values'] + '/sensors?sensors='
+        # each filter is only queried once
+        filters = [filt for index, filt in enumerate(filters)
+                   if filt not in filters[:index]]
+        queries = [(filt, url + quote(filt, safe='')) for filt in filters
+                   if not merge_filters or not self._is_simple_filter(filt)]
+        if merge_filters:
+            queries.extend(self._combined_sensor_queries(
+                url, [filt for filt in filters if self._is_simple_filter(filt)],
+                template='({})'))
+        cache = self._sensor_metadata_cache
         results = set()
-        for filt in filters:
-            response = yield self._http_client.fetch("{}?sensors={}".format(url, filt))
-            new_sensors = self._extract_sensors_details(response.body)
+        uncached = []
+        for pattern, query in queries:
+            names = cache.names(pattern) if cache is not None else None
+            if names is None:
+                uncached.append((pattern, query))
+            else:
+                results.update(names)
+        responses = yield self._fetch_sensor_queries(
+            'sensor_names', [query for _, query in uncached], max_concurrent)
+        for (pattern, _), new_sensors in zip(uncached, responses):
+            if cache is not None:
+                cache.put(new_sensors, pattern, save=False)
             # only add sensors once, to ensure a unique list
-            for sensor in new_sensors:
-                results.add(sensor['name'])
+            results.update(sensor['name'] for sensor in new_sensors)
+        if cache is not None and uncached:
+            cache.save()
         raise tornado.gen.Return(list(results))
 
+    @staticmethod
+    def _is_simple_filter(sensor_filter):
+        """Return True if a filter means the same inside an alternation."""
+        return '\\' not in sensor_filter and '(?' not in sensor_filter
+
+    @tornado.gen.coroutine
+    def _fetch_sensor_queries(self, endpoint, queries,
+                              max_concurrent=SENSOR_QUERY_MAX_CONCURRENT):
+        """Fetch sensor queries concurrently, and return the sensors of each."""
+        semaphore = tornado.locks.Semaphore(max_concurrent)
+
+        @tornado.gen.coroutine
+        def fetch(query):
+            with (yield semaphore.acquire()):
+                response = yield self._fetch(endpoint, query)
+            raise tornado.gen.Return(self._extract_sensors_details(response.body))
+
+        results = yield [fetch(query) for query in queries]
+        raise tornado.gen.Return(results)
+
     @tornado.gen.coroutine
     def sensor_detail(self, sensor_name):
         """Return detailed attribute information for a sensor.
 
-        For a list of sensor names, see :meth:`.sensors_list`.
+        For a list of sensor names, see :meth:`.sensors_list`.  If the client
+        has a sensor metadata cache, the details are taken from it if they
+        are there, see :class:`.SensorMetadataCache`.  Once the cache has
+        the details of all the sensors, other names are not looked up.
 
         .. note::
 
@@ -1170,9 +1849,25 @@ class KATPortalClient(object):
             - If no information was available for the requested sensor name.
             - If the sensor name was not a unique match for a single sensor.
         """
-        url = self.sitemap['historic_sensor_values'] + '/sensors'
-        response = yield self._http_client.fetch("{}?sensors={}".format(url, sensor_name))
+        cache = self._sensor_metadata_cache
+        if cache is not None:
+            if cache.bulk_load and not cache.complete:
+                try:
+                    yield self._load_all_sensor_details()
+                except Exception:
+                    self._logger.exception("Failed to load all sensor details")
+            result = cache.get(sensor_name)
+            if result is not None:
+                raise tornado.gen.Return(result)
+            if cache.complete:
+                raise SensorNotFoundError("Sensor name not found: " + sensor_name)
+        sitemap = yield self.load_sitemap()
+        url = sitemap['historic_sensor_values'] + '/sensors'
+        response = yield self._fetch(
+            'sensor_detail', "{}?sensors={}".format(url, sensor_name))
         results = self._extract_sensors_details(response.body)
+        if cache is not None:
+            cache.put(results)
         if len(results) == 0:
             raise SensorNotFoundError("Sensor name not found: " + sensor_name)
         elif len(results) > 1:
@@ -1189,13 +1884,188 @@ class KATPortalClient(object):
         else:
             raise tornado.gen.Return(results[0])
 
+    @tornado.gen.coroutine
+    def _download_sensor_history(self, sensor_name, start_time_sec,
+                                 end_time_sec, samples, timeout_sec,
+                                 done_event=None):
+        """Request a sensor's sample history and wait until it has arrived.
+
+        The samples are published by katportal on a temporary namespace, and
+        passed to the `samples` accumulator by :meth:`._process_redis_message`
+        as they are received.  The wait ends when `done_event` is set, which
+        is also done once all the samples have arrived, so the caller can
+        set it to abandon the download.
+
+        Raises
+        -------
+        SensorHistoryRequestError:
+            - If there was an error submitting the request.
+            - If the request timed out
+        """
+        # create new namespace and state variables per query, to allow multiple
+        # request simultaneously
+        state = {
+            'sensor': sensor_name,
+            'done_event': done_event or tornado.locks.Event(),
+            'num_samples_pending': 0,
+            'samples': samples
+        }
+        namespace = str(uuid.uuid4())
+        self._sensor_history_states[namespace] = state
+        try:
+            # ensure connected, and subscribed before sending request
+            yield self.connect()
+            yield self.subscribe(namespace, ['*'])
+
+            params = {
+                'sensor': sensor_name,
+                'time_type': SAMPLE_HISTORY_REQUEST_TIME_TYPE,
+                'start': start_time_sec * SAMPLE_HISTORY_REQUEST_MULTIPLIER_TO_SEC,
+                'end': end_time_sec * SAMPLE_HISTORY_REQUEST_MULTIPLIER_TO_SEC,
+                'namespace': namespace,
+                'request_in_chunks': 1,
+                'chunk_size': SAMPLE_HISTORY_CHUNK_SIZE,
+                'limit': MAX_SAMPLES_PER_HISTORY_QUERY
+            }
+            url = url_concat(
+                self.sitemap['historic_sensor_values'] + '/samples', params)
+            self._logger.debug("Sensor history request: %s", url)
+            response = yield self._fetch('sensor_history', url)
+            data = self._json.loads(response.body)
+            if isinstance(data, dict) and data['result'] == 'success':
+                download_start_sec = time.time()
+                # Query accepted by portal - data will be returned via websocket, but
+                # we need to wait until it has arrived.  For synchronisation, we wait
+                # for a 'done_event'. This event is updated in
+                # _process_redis_message().
+                try:
+                    timeout_delta = timedelta(seconds=timeout_sec)
+                    yield state['done_event'].wait(timeout=timeout_delta)
+
+                    self._logger.debug('Done in %d seconds, fetched %s samples.' % (
+                        time.time() - download_start_sec,
+                        len(samples)))
+                except tornado.gen.TimeoutError:
+                    raise SensorHistoryRequestError(
+                        "Sensor history request timed out")
+
+            else:
+                raise SensorHistoryRequestError("Error requesting sensor history: {}"
+                                                .format(response.body))
+        finally:
+            # Free the state variables that were only required for the duration of
+            # the download.  Do not disconnect - there may be websocket activity
+            # initiated by another call.
+            del self._sensor_history_states[namespace]
+            if self.is_connected:
+                yield self.unsubscribe(namespace, ['*'])
+
+    @tornado.gen.coroutine
+    def sensor_details(self, sensor_names):
+        """Return detailed attribute information for many sensors.
+
+        The names are combined into a few regular expressions, each matching
+        many sensors, so that only a few requests are needed.  The requests
+        are made concurrently.
+
+        .. note::
+
+            The websocket is not used for this request - it does not need
+            to be connected.
+
+        Parameters
+        ----------
+        sensor_names: list of str
+            Exact sensor names - see description in :meth:`.set_sampling_strategy`.
+
+        Returns
+        -------
+        dict:
+            Sensor name, as given -> detailed attribute information for the
+            sensor, see :meth:`.sensor_detail`, or None if there is no such
+            sensor.
+        """
+        cache = self._sensor_metadata_cache
+        results = {}
+        missing = []
+        for sensor_name in sensor_names:
+            result = cache.get(sensor_name) if cache is not None else None
+            if result is not None:
+                results[sensor_name] = result
+            else:
+                missing.append(sensor_name)
+        if missing:
+            sitemap = yield self.load_sitemap()
+            url = sitemap['historic_sensor_values'] + '/sensors?sensors='
+            queries = self._combined_sensor_queries(
+                url, [_escape_regex(normalise_sensor_name(name))
+                      for name in missing])
+            responses = yield self._fetch_sensor_queries(
+                'sensor_details', [query for _, query in queries])
+            found = {}
+            for details in responses:
+                if cache is not None:
+                    cache.put(details, save=False)
+                for detail in details:
+                    found[detail['name']] = detail
+            if cache is not None:
+                cache.save()
+            for sensor_name in missing:
+                detail = found.get(normalise_sensor_name(sensor_name))
+                results[sensor_name] = dict(detail) if detail is not None else None
+        raise tornado.gen.Return(results)
+
+    @staticmethod
+    def _combined_sensor_queries(base_url, patterns, template='^({})$',
+                                 max_url_length=SENSOR_QUERY_MAX_URL_LENGTH):
+        """Combine sensor name patterns into a few alternations.
+
+        Each alternation of a group of patterns, put in `template`, is
+        queried with a URL no longer than `max_url_length`, unless the group
+        has a single pattern.  The default template matches any one of a
+        group of sensor names exactly.
+
+        Returns
+        -------
+        list:
+            List of (combined pattern, query URL) tuples.
+        """
+        def query(group):
+            pattern = template.format('|'.join(group))
+            return pattern, base_url + quote(pattern, safe='')
+
+        # the URL length of a group: the base URL, the template and a '|'
+        # between each pattern, all URL encoded
+        separator_length = len(quote('|', safe=''))
+        overhead = (len(base_url) + len(quote(template.format(''), safe='')) -
+                    separator_length)
+        queries = []
+        group = []
+        length = overhead
+        for pattern in sorted(set(patterns)):
+            pattern_length = len(quote(pattern, safe='')) + separator_length
+            if group and length + pattern_length > max_url_length:
+                queries.append(query(group))
+                group = []
+                length = overhead
+            group.append(pattern)
+            length += pattern_length
+        if group:
+            queries.append(query(group))
+        return queries
+
     @tornado.gen.coroutine
     def sensor_history(self, sensor_name, start_time_sec, end_time_sec,
-                       include_value_ts=False, timeout_sec=300):
+                       include_value_ts=False, timeout_sec=300, as_arrays=False,
+                       split_windows=False, max_concurrent=1, bucket_sec=None):
         """Return time history of sample measurements for a sensor.
 
         For a list of sensor names, see :meth:`.sensors_list`.
 
+        If the client was created with a `history_cache_dir`, only the parts
+        of the time range that are not in the local cache are requested from
+        katportal.
+
         Parameters
         ----------
         sensor_name: str
@@ -1212,6 +2082,29 @@ class KATPortalClient(object):
         timeout_sec: float
             Maximum time (in sec) to wait for the history to be retrieved.
             An exception will be raised if the request times out. (default:300)
+        as_arrays: bool
+            Flag to return the samples in columnar form, as a
+            :class:`.SensorSampleArrays`, instead of a list of namedtuples.
+            This uses far less memory for large histories.  Requires numpy.
+            Default: False.
+        split_windows: bool
+            Flag to automatically split the query into smaller time windows
+            if the number of samples exceeds the maximum allowed per query
+            (MAX_SAMPLES_PER_HISTORY_QUERY).  The size of the sub-windows is
+            estimated from the sample density observed in the truncated
+            query, and the results are joined into a single time ordered
+            series.  Default: False.
+        max_concurrent: int
+            Maximum number of sub-window queries in progress at the same
+            time, if split_windows is set.  Default: 1.
+        bucket_sec: float
+            If specified, the samples are summarised in time buckets of this
+            width (in seconds, starting at start_time_sec) as they are
+            received, and a list of :class:`.SensorSampleAggregate`
+            namedtuples (count, min, max, mean and last value per non-empty
+            bucket) is returned instead of the samples.  Only the bucket
+            summaries are held in memory.  Cannot be combined with
+            as_arrays.  Default: None.
 
         Returns
         -------
@@ -1223,85 +2116,287 @@ class KATPortalClient(object):
             See :class:`.SensorSample` and :class:`.SensorSampleValueTs` for details.
             If the sensor named never existed, or is otherwise invalid, the
             list will be empty - no exception is raised.
+            If as_arrays was set, a :class:`.SensorSampleArrays` is returned
+            instead.
+            If bucket_sec was set, a list of :class:`.SensorSampleAggregate`
+            namedtuples is returned instead.
+            If split_windows was not set, the result is truncated to
+            MAX_SAMPLES_PER_HISTORY_QUERY samples.
 
         Raises
         -------
         SensorHistoryRequestError:
             - If there was an error submitting the request.
             - If the request timed out
+        ValueError:
+            - If both as_arrays and bucket_sec were set.
         """
-        # create new namespace and state variables per query, to allow multiple
-        # request simultaneously
-        state = {
-            'sensor': sensor_name,
-            'done_event': tornado.locks.Event(),
-            'num_samples_pending': 0,
-            'include_value_ts': include_value_ts,
-            'samples': []
-        }
-        namespace = str(uuid.uuid4())
-        self._sensor_history_states[namespace] = state
-        # ensure connected, and subscribed before sending request
-        yield self.connect()
-        yield self.subscribe(namespace, ['*'])
+        if as_arrays and bucket_sec:
+            raise ValueError("as_arrays and bucket_sec cannot both be set")
+        if self._history_cache is not None:
+            result = yield self._cached_sensor_history(
+                sensor_name, start_time_sec, end_time_sec, include_value_ts,
+                timeout_sec, as_arrays, split_windows, max_concurrent,
+                bucket_sec)
+        else:
+            new_samples, combine_results = self._history_accumulator(
+                start_time_sec, include_value_ts, as_arrays, bucket_sec)
+            result = yield self._fetch_sensor_history(
+                sensor_name, start_time_sec, end_time_sec, timeout_sec,
+                split_windows, max_concurrent, new_samples, combine_results)
+        raise tornado.gen.Return(result)
 
-        params = {
-            'sensor': sensor_name,
-            'time_type': SAMPLE_HISTORY_REQUEST_TIME_TYPE,
-            'start': start_time_sec * SAMPLE_HISTORY_REQUEST_MULTIPLIER_TO_SEC,
-            'end': end_time_sec * SAMPLE_HISTORY_REQUEST_MULTIPLIER_TO_SEC,
-            'namespace': namespace,
-            'request_in_chunks': 1,
-            'chunk_size': SAMPLE_HISTORY_CHUNK_SIZE,
-            'limit': MAX_SAMPLES_PER_HISTORY_QUERY
-        }
-        url = url_concat(
-            self.sitemap['historic_sensor_values'] + '/samples', params)
-        self._logger.debug("Sensor history request: %s", url)
-        response = yield self._http_client.fetch(url)
-        data = json.loads(response.body)
-        if isinstance(data, dict) and data['result'] == 'success':
-            download_start_sec = time.time()
-            # Query accepted by portal - data will be returned via websocket, but
-            # we need to wait until it has arrived.  For synchronisation, we wait
-            # for a 'done_event'. This event is updated in
-            # _process_redis_message().
-            try:
-                timeout_delta = timedelta(seconds=timeout_sec)
-                yield state['done_event'].wait(timeout=timeout_delta)
+    @staticmethod
+    def _history_accumulator(start_time_sec, include_value_ts, as_arrays,
+                             bucket_sec):
+        """Select how sample history data is accumulated.
 
-                self._logger.debug('Done in %d seconds, fetched %s samples.' % (
-                    time.time() - download_start_sec,
-                    len(state['samples'])))
-            except tornado.gen.TimeoutError:
-                raise SensorHistoryRequestError(
-                    "Sensor history request timed out")
+        See :meth:`.sensor_history` for the parameters.
 
+        Returns
+        -------
+        tuple:
+            A function returning a new, empty accumulator, and a function
+            that joins the results of accumulators for consecutive time
+            ranges.
+        """
+        if bucket_sec:
+            accumulator = SampleBucketAggregator
+            new_samples = functools.partial(
+                SampleBucketAggregator, bucket_sec, start_time_sec)
         else:
-            raise SensorHistoryRequestError("Error requesting sensor history: {}"
-                                            .format(response.body))
+            accumulator = SampleArrayAccumulator if as_arrays else SampleListAccumulator
+            new_samples = functools.partial(accumulator, include_value_ts)
+        return new_samples, accumulator.combine
+
+    @tornado.gen.coroutine
+    def _fetch_sensor_history(self, sensor_name, start_time_sec, end_time_sec,
+                              timeout_sec, split_windows, max_concurrent,
+                              new_samples, combine_results):
+        """Retrieve a sensor's history from katportal.
+
+        See :meth:`.sensor_history` for the parameters, and
+        :meth:`._history_accumulator` for `new_samples` and `combine_results`.
+        """
+        if split_windows:
+            result = yield self._split_sensor_history(
+                sensor_name, start_time_sec, end_time_sec, timeout_sec,
+                new_samples, combine_results, max_concurrent)
+            raise tornado.gen.Return(result)
+
+        samples = new_samples()
+        yield self._download_sensor_history(
+            sensor_name, start_time_sec, end_time_sec, samples, timeout_sec)
 
-        def sort_by_timestamp(sample):
-            return sample.timestamp
         # return a sorted copy, as data may have arrived out of order
-        result = sorted(state['samples'], key=sort_by_timestamp)
+        result = samples.result()
+        self._logger.debug('Ordered %d samples from %d runs in %.3f seconds.',
+                           len(result), samples.num_runs,
+                           samples.sort_duration_sec)
 
-        if len(result) >= MAX_SAMPLES_PER_HISTORY_QUERY:
+        if len(samples) >= MAX_SAMPLES_PER_HISTORY_QUERY:
             self._logger.warn(
                 'Maximum sample limit (%d) hit - there may be more data available.',
                 MAX_SAMPLES_PER_HISTORY_QUERY)
 
-        # Free the state variables that were only required for the duration of
-        # the download.  Do not disconnect - there may be websocket activity
-        # initiated by another call.
-        yield self.unsubscribe(namespace, ['*'])
-        del self._sensor_history_states[namespace]
+        raise tornado.gen.Return(result)
 
+    @tornado.gen.coroutine
+    def _cached_sensor_history(self, sensor_name, start_time_sec, end_time_sec,
+                               include_value_ts, timeout_sec, as_arrays,
+                               split_windows, max_concurrent, bucket_sec=None):
+        """Retrieve a sensor's history via the local history cache.
+
+        Only the parts of the time range that are not in the cache are
+        requested from katportal, and those are added to the cache.
+        See :meth:`.sensor_history` for the parameters.
+        """
+        request_start_sec = time.time()
+        cache = self._history_cache
+        entry = cache.load(sensor_name)
+        gaps = cache.gaps(entry, start_time_sec, end_time_sec)
+        uncached = []
+        for gap_start_sec, gap_end_sec in gaps:
+            timeout_left_sec = timeout_sec - (time.time() - request_start_sec)
+            gap_samples = yield self._fetch_sensor_history(
+                sensor_name, gap_start_sec, gap_end_sec, timeout_left_sec,
+                split_windows, max_concurrent, SampleColumnAccumulator,
+                SampleColumnAccumulator.combine)
+            complete = (split_windows or
+                        len(gap_samples) < MAX_SAMPLES_PER_HISTORY_QUERY)
+            uncached.append(cache.update(
+                entry, gap_start_sec, gap_end_sec, gap_samples, complete))
+        if gaps:
+            cache.save(entry)
+        self._logger.debug('Fetched %d gaps in cached %s history.',
+                           len(gaps), sensor_name)
+        samples = cache.samples(entry, start_time_sec, end_time_sec)
+        for gap_samples in uncached:
+            samples.insert(gap_samples)
+
+        if bucket_sec:
+            aggregator = SampleBucketAggregator(bucket_sec, start_time_sec)
+            for timestamp, value, status in zip(
+                    samples.timestamp, samples.value, samples.status):
+                aggregator.add_sample(timestamp, value, status)
+            result = aggregator.result()
+        elif as_arrays:
+            result = SensorSampleArrays.from_columns(samples, include_value_ts)
+        else:
+            result = samples.samples(include_value_ts)
         raise tornado.gen.Return(result)
 
+    @tornado.gen.coroutine
+    def _split_sensor_history(self, sensor_name, start_time_sec, end_time_sec,
+                              timeout_sec, new_samples, combine_results,
+                              max_concurrent):
+        """Retrieve a sensor's history, splitting the query into smaller windows.
+
+        A window is queried first, and if the sample limit is hit, it is split
+        into sub-windows small enough for the sample density seen, which are
+        queried in turn (repeatedly, if necessary).  The windows are half open,
+        [start, end), except for the last one, so that samples on a boundary
+        are not duplicated.  The samples are accumulated per window, using
+        accumulators from `new_samples`, and the windows' results are joined
+        by `combine_results`.  See :meth:`.sensor_history` for the other
+        parameters.
+        """
+        request_start_sec = time.time()
+        request_slots = tornado.locks.Semaphore(max(1, max_concurrent))
+        min_window_sec = 1.0 / SAMPLE_HISTORY_REQUEST_MULTIPLIER_TO_SEC
+
+        @tornado.gen.coroutine
+        def fetch_window(window_start_sec, window_end_sec, is_last):
+            samples = new_samples()
+            window = SampleWindowFilter(
+                samples, window_start_sec, window_end_sec, include_end=is_last)
+            timeout_left_sec = max(
+                0, timeout_sec - (time.time() - request_start_sec))
+            try:
+                yield request_slots.acquire(
+                    timeout=timedelta(seconds=timeout_left_sec))
+            except tornado.gen.TimeoutError:
+                raise SensorHistoryRequestError(
+                    "Sensor history request timed out")
+            try:
+                timeout_left_sec = timeout_sec - (time.time() - request_start_sec)
+                yield self._download_sensor_history(
+                    sensor_name, window_start_sec, window_end_sec, window,
+                    timeout_left_sec)
+            finally:
+                request_slots.release()
+
+            window_sec = window_end_sec - window_start_sec
+            if window.num_received < MAX_SAMPLES_PER_HISTORY_QUERY:
+                raise tornado.gen.Return([samples.result()])
+            if window_sec / 2 < min_window_sec:
+                self._logger.warn(
+                    'Maximum sample limit (%d) hit in a %s second window - '
+                    'there may be more data available.',
+                    MAX_SAMPLES_PER_HISTORY_QUERY, window_sec)
+                raise tornado.gen.Return([samples.result()])
+
+            # Estimate the sample density from the truncated result, assuming
+            # the earliest samples are returned first, and aim for windows
+            # that are about half full.
+            num_windows = 2
+            if samples.last_timestamp is not None:
+                covered_sec = samples.last_timestamp - window_start_sec
+                if covered_sec > 0:
+                    num_windows = max(num_windows, int(math.ceil(
+                        2.0 * window_sec / covered_sec)))
+            num_windows = min(num_windows, int(window_sec / min_window_sec))
+            del samples
+            self._logger.debug(
+                'Sample limit hit, splitting %s history window [%s, %s] into %d',
+                sensor_name, window_start_sec, window_end_sec, num_windows)
+            boundaries = [window_start_sec + window_sec * i / num_windows
+                          for i in range(num_windows)] + [window_end_sec]
+            parts = yield [
+                fetch_window(boundaries[i], boundaries[i + 1],
+                             is_last and i == num_windows - 1)
+                for i in range(num_windows)]
+            raise tornado.gen.Return([part for window_parts in parts
+                                      for part in window_parts])
+
+        parts = yield fetch_window(start_time_sec, end_time_sec, True)
+        raise tornado.gen.Return(combine_results(parts))
+
+    @tornado.gen.coroutine
+    def sensor_history_stream(self, sensor_name, start_time_sec, end_time_sec,
+                              chunk_callback, include_value_ts=False,
+                              timeout_sec=300):
+        """Stream the time history of sample measurements for a sensor.
+
+        Like :meth:`.sensor_history`, but instead of returning all the samples
+        at the end of the download, each block of samples is passed to
+        `chunk_callback` as soon as it has been received.  The whole history
+        is never held in memory, so this is suitable for writing long
+        histories directly to disk or a database.
+
+        Parameters
+        ----------
+        sensor_name: str
+            Exact sensor name - see description in :meth:`.set_sampling_strategy`.
+        start_time_sec: float
+            Start time for sample history query, in seconds since the UNIX epoch
+            (1970-01-01 UTC).
+        end_time_sec: float
+            End time for sample history query, in seconds since the UNIX epoch.
+        chunk_callback: function
+            Callback invoked once per block of samples received.  Signature
+            has to include a single argument for the list of samples, e.g.
+            `def on_chunk(samples)`.  The samples in a block are time ordered,
+            but blocks may arrive out of order relative to one another.  If the
+            callback returns a Future (e.g. it is a coroutine), the next block
+            is only delivered once that Future has resolved.  Blocks that
+            arrive in the meantime are buffered.
+        include_value_ts: bool
+            Flag to also include value timestamp in addition to time series
+            sample timestamp in the result.
+            Default: False.
+        timeout_sec: float
+            Maximum time (in sec) to wait for the history to be retrieved.
+            An exception will be raised if the request times out. (default:300)
+
+        Returns
+        -------
+        int:
+            Total number of samples passed to `chunk_callback`.
+
+        Raises
+        -------
+        SensorHistoryRequestError:
+            - If there was an error submitting the request.
+            - If the request timed out
+        """
+        chunks = SampleChunkQueue(include_value_ts)
+        delivery = chunks.deliver(chunk_callback)
+        # delivery only ends early if the callback failed, so stop downloading
+        done_event = tornado.locks.Event()
+        delivery.add_done_callback(lambda future: done_event.set())
+        try:
+            yield self._download_sensor_history(
+                sensor_name, start_time_sec, end_time_sec, chunks, timeout_sec,
+                done_event=done_event)
+        except Exception:
+            chunks.close()
+            delivery.add_done_callback(self._sensor_history_delivered)
+            raise
+        chunks.close()
+        num_samples = yield delivery
+        raise tornado.gen.Return(num_samples)
+
+    def _sensor_history_delivered(self, future):
+        # the download failed, so nothing else waits for the delivery
+        if future.exception() is not None:
+            self._logger.error("Sensor history chunk callback failed: %s",
+                               future.exception())
+
     @tornado.gen.coroutine
     def sensors_histories(self, filters, start_time_sec, end_time_sec,
-                          include_value_ts=False, timeout_sec=300):
+                          include_value_ts=False, timeout_sec=300,
+                          max_concurrent=1):
         """Return time histories of sample measurements for multiple sensors.
 
         Finds the list of available sensors in the system that match the
@@ -1326,6 +2421,11 @@ class KATPortalClient(object):
         timeout_sec: float
             Maximum time to wait for all sensors' histories to be retrieved.
             An exception will be raised if the request times out.
+        max_concurrent: int
+            Maximum number of sensor history requests in progress at the same
+            time.  Each request uses its own namespace, so the downloads do
+            not interfere with each other.  The timeout is shared by all the
+            requests.  Default: 1 (one sensor at a time).
 
         Returns
         -------
@@ -1349,11 +2449,29 @@ class KATPortalClient(object):
         request_start_sec = time.time()
         sensors = yield self.sensor_names(filters)
         histories = {}
-        for sensor in sensors:
+        request_slots = tornado.locks.Semaphore(max(1, max_concurrent))
+
+        @tornado.gen.coroutine
+        def fetch_history(sensor):
             elapsed_time_sec = time.time() - request_start_sec
-            timeout_left_sec = timeout_sec - elapsed_time_sec
-            histories[sensor] = yield self.sensor_history(
-                sensor, start_time_sec, end_time_sec, timeout_left_sec)
+            timeout_left_sec = max(0, timeout_sec - elapsed_time_sec)
+            try:
+                yield request_slots.acquire(
+                    timeout=timedelta(seconds=timeout_left_sec))
+            except tornado.gen.TimeoutError:
+                raise SensorHistoryRequestError(
+                    "Sensor history request timed out")
+            try:
+                elapsed_time_sec = time.time() - request_start_sec
+                timeout_left_sec = timeout_sec - elapsed_time_sec
+                histories[sensor] = yield self.sensor_history(
+                    sensor, start_time_sec, end_time_sec,
+                    include_value_ts=include_value_ts,
+                    timeout_sec=timeout_left_sec)
+            finally:
+                request_slots.release()
+
+        yield [fetch_history(sensor) for sensor in sensors]
         raise tornado.gen.Return(histories)
 
     @tornado.gen.coroutine
@@ -1385,9 +2503,10 @@ class KATPortalClient(object):
             {..}]
 
         """
-        url = self.sitemap['userlogs'] + '/tags'
-        response = yield self._http_client.fetch(url)
-        raise tornado.gen.Return(json.loads(response.body))
+        sitemap = yield self.load_sitemap()
+        url = sitemap['userlogs'] + '/tags'
+        response = yield self._fetch('userlogs', url)
+        raise tornado.gen.Return(self._json.loads(response.body))
 
     @tornado.gen.coroutine
     def userlogs(self, start_time=None, end_time=None):
@@ -1481,7 +2600,8 @@ class KATPortalClient(object):
                 'end_time': '2017-02-07 23:59:59'
              }, {..}]
         """
-        url = self.sitemap['userlogs'] + '/query?'
+        sitemap = yield self.load_sitemap()
+        url = sitemap['userlogs'] + '/query?'
         if start_time is None:
             start_time = time.strftime('%Y-%m-%d 00:00:00')
         if end_time is None:
@@ -1493,7 +2613,7 @@ class KATPortalClient(object):
         query_string = urlencode(request_params)
         response = yield self.authorized_fetch(
             url='{}{}'.format(url, query_string), auth_token=self._session_id)
-        raise tornado.gen.Return(json.loads(response.body))
+        raise tornado.gen.Return(self._json.loads(response.body))
 
     @tornado.gen.coroutine
     def create_userlog(self, content, tag_ids=None, start_time=None,
@@ -1542,7 +2662,8 @@ class KATPortalClient(object):
                 'end_time': '2017-02-07 23:59:59'
              }
         """
-        url = self.sitemap['userlogs']
+        sitemap = yield self.load_sitemap()
+        url = sitemap['userlogs']
         new_userlog = {
             'user': self._current_user_id,
             'content': content
@@ -1556,8 +2677,8 @@ class KATPortalClient(object):
 
         response = yield self.authorized_fetch(
             url=url, auth_token=self._session_id,
-            method='POST', body=json.dumps(new_userlog))
-        raise tornado.gen.Return(json.loads(response.body))
+            method='POST', body=self._json.dumps(new_userlog))
+        raise tornado.gen.Return(self._json.loads(response.body))
 
     @tornado.gen.coroutine
     def modify_userlog(self, userlog, tag_ids=None):
@@ -1599,18 +2720,19 @@ class KATPortalClient(object):
         if tag_ids is None and 'tags' in userlog:
             try:
                 userlog['tag_ids'] = [
-                    tag_id for tag_id in json.loads(userlog['tags'])]
+                    tag_id for tag_id in self._json.loads(userlog['tags'])]
             except Exception:
                 self._logger.exception(
                     'Could not parse the tags field of the userlog: %s', userlog)
                 raise
         else:
             userlog['tag_ids'] = tag_ids
-        url = '{}/{}'.format(self.sitemap['userlogs'], userlog['id'])
+        sitemap = yield self.load_sitemap()
+        url = '{}/{}'.format(sitemap['userlogs'], userlog['id'])
         response = yield self.authorized_fetch(
             url=url, auth_token=self._session_id,
-            method='POST', body=json.dumps(userlog))
-        raise tornado.gen.Return(json.loads(response.body))
+            method='POST', body=self._json.dumps(userlog))
+        raise tornado.gen.Return(self._json.loads(response.body))
 
     @tornado.gen.coroutine
     def sensor_subarray_lookup(self, component, sensor, return_katcp_name=False,
@@ -1652,13 +2774,14 @@ class KATPortalClient(object):
             The full sensor name based on the given component and subarray.
 
         """
+        sitemap = yield self.load_sitemap()
         if sub_nr == None:
-            sub_nr = int(self.sitemap['sub_nr'])
+            sub_nr = int(sitemap['sub_nr'])
         if not sub_nr:
             raise SubarrayNumberUnknown()
         url = "{base_url}/{sub_nr}/{component}/{sensor}/{katcp_name}"
-        response = yield self._http_client.fetch(url.format(
-            base_url=self.sitemap['sensor_lookup'],
+        response = yield self._fetch('sensor_lookup', url.format(
+            base_url=sitemap['sensor_lookup'],
             sub_nr=sub_nr, component=component, sensor=sensor,
             return_katcp_name=1 if return_katcp_name else 0))
         # 1 or 0 because katportal expects that instead of a boolean value
@@ -1681,6 +2804,14 @@ class ScheduleBlockTargetsParsingError(Exception):
     """Raise if there was an error parsing the targets attribute of the
     ScheduleBlock"""
 
+class RequestTimeoutError(Exception):
+    """Raise if there is no reply to a websocket request in time."""
+
+
+class ConnectionClosedError(Exception):
+    """Raise if the websocket closes before the reply to a request."""
+
+
 class SubarrayNumberUnknown(Exception):
     """Raised when subarray number is unknown"""
 
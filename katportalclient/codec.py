@@ -0,0 +1,107 @@
+###############################################################################
+# SKA South Africa (http://ska.ac.za/)                                        #
+# Author: cam@ska.ac.za                                                       #
+# Copyright @ 2013 SKA SA. All rights reserved.                               #
+#                                                                             #
+# THIS SOFTWARE MAY NOT BE COPIED OR DISTRIBUTED IN ANY FORM WITHOUT THE      #
+# WRITTEN PERMISSION OF SKA SA.                                               #
+###############################################################################
+"""Module defining the JSON codec used for katportal messages."""
+
+import importlib
+import json
+
+from omnijson import JSONError
+
+
+# JSON libraries to try, fastest first.  The standard library's json
+# module is always available, so it is the last resort.
+JSON_BACKENDS = ('orjson', 'rapidjson', 'ujson', 'json')
+
+
+def _compact_dumps(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def _orjson_functions(module):
+    def dumps(obj):
+        # orjson encodes to bytes, but websocket text frames need text
+        return module.dumps(obj).decode('utf-8')
+    return module.loads, dumps
+
+
+def _ujson_functions(module):
+    def loads(data):
+        # without precise_float, ujson may round the last digit of floats
+        return module.loads(data, precise_float=True)
+    # ujson encodes floats with at most 15 significant digits, so outgoing
+    # requests, which are small, are encoded by the standard library
+    return loads, _compact_dumps
+
+
+def _default_functions(module):
+    return module.loads, module.dumps
+
+
+def _json_functions(module):
+    return module.loads, _compact_dumps
+
+
+_BACKEND_FUNCTIONS = {
+    'orjson': _orjson_functions,
+    'ujson': _ujson_functions,
+    'json': _json_functions,
+}
+
+
+class JSONCodec(object):
+    """Encodes and decodes JSON, using the fastest library available.
+
+    Raw websocket messages and HTTP response bodies are passed straight
+    to the backend, which all accept bytes, so no intermediate decoded
+    copy of a message is made.  Decoding errors are raised as
+    :class:`omnijson.JSONError`, whichever backend is used.
+
+    Parameters
+    ----------
+    backends: sequence of str
+        Names of the JSON libraries to use, in order of preference.  The
+        first one that can be imported is used.  Default: JSON_BACKENDS.
+
+    Raises
+    ------
+    ValueError:
+        If none of the backends can be imported.
+    """
+
+    def __init__(self, backends=JSON_BACKENDS):
+        self.backend = None
+        for name in backends:
+            try:
+                module = importlib.import_module(name)
+            except ImportError:
+                continue
+            make_functions = _BACKEND_FUNCTIONS.get(name, _default_functions)
+            self._loads, self._dumps = make_functions(module)
+            self.backend = name
+            break
+        else:
+            raise ValueError("None of the JSON backends {} are available"
+                             .format(list(backends)))
+
+    def __repr__(self):
+        return "<{} backend={}>".format(self.__class__.__name__, self.backend)
+
+    def loads(self, data):
+        """Decode a JSON document, given as bytes or text."""
+        try:
+            return self._loads(data)
+        except (ValueError, TypeError) as exc:
+            raise JSONError(str(exc))
+
+    def dumps(self, obj):
+        """Encode an object as a JSON string."""
+        return self._dumps(obj)
+
+
+default_codec = JSONCodec()
@@ -0,0 +1,161 @@
+###############################################################################
+# SKA South Africa (http://ska.ac.za/)                                        #
+# Author: cam@ska.ac.za                                                       #
+# Copyright @ 2013 SKA SA. All rights reserved.                               #
+#                                                                             #
+# THIS SOFTWARE MAY NOT BE COPIED OR DISTRIBUTED IN ANY FORM WITHOUT THE      #
+# WRITTEN PERMISSION OF SKA SA.                                               #
+###############################################################################
+"""Module defining how the websocket connection to katportal is maintained."""
+
+import random
+import time
+from collections import deque
+
+
+def latency_stats(latencies):
+    """Summarise a sequence of latencies, in seconds.
+
+    Returns
+    -------
+    dict:
+        'count', 'min', 'mean', 'p50', 'p90', 'p99' and 'max' of the
+        latencies ('count' only, if there are none).
+    """
+    stats = {'count': len(latencies)}
+    if latencies:
+        ordered = sorted(latencies)
+
+        def percentile(fraction):
+            return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+        stats.update(min=ordered[0], max=ordered[-1],
+                     mean=sum(ordered) / len(ordered),
+                     p50=percentile(0.5), p90=percentile(0.9),
+                     p99=percentile(0.99))
+    return stats
+
+
+class ReconnectPolicy(object):
+    """Delays between attempts to reconnect a dropped websocket connection.
+
+    The first attempt is made immediately after the connection drops.  If
+    it fails, the delay before each further attempt grows exponentially,
+    up to a maximum.  A random part of each delay is dropped (jitter), so
+    that many clients do not reconnect to katportal in lockstep after an
+    outage.
+
+    Parameters
+    ----------
+    initial_delay_sec: float
+        Delay before the second attempt, in seconds (default=1).
+    max_delay_sec: float
+        Maximum delay between attempts, in seconds (default=60).
+    multiplier: float
+        Factor by which the delay grows after each failed attempt
+        (default=2).
+    jitter: float
+        Fraction of each delay that is randomised, between 0 (no jitter)
+        and 1 (delay anywhere between 0 and the full value) (default=0.5).
+    """
+
+    def __init__(self, initial_delay_sec=1.0, max_delay_sec=60.0,
+                 multiplier=2.0, jitter=0.5):
+        if not 0 <= jitter <= 1:
+            raise ValueError("Jitter must be between 0 and 1, not {}"
+                             .format(jitter))
+        self.initial_delay_sec = initial_delay_sec
+        self.max_delay_sec = max_delay_sec
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    def __repr__(self):
+        return ("<ReconnectPolicy initial={}s max={}s multiplier={} jitter={}>"
+                .format(self.initial_delay_sec, self.max_delay_sec,
+                        self.multiplier, self.jitter))
+
+    def delay(self, num_failures):
+        """Return the delay before the next attempt, in seconds.
+
+        Parameters
+        ----------
+        num_failures: int
+            Number of attempts that have failed since the connection dropped.
+        """
+        if num_failures < 1:
+            return 0.0
+        delay = self.initial_delay_sec
+        for _ in range(num_failures - 1):
+            delay *= self.multiplier
+            if delay >= self.max_delay_sec:
+                break
+        delay = min(delay, self.max_delay_sec)
+        return delay * (1.0 - self.jitter * random.random())
+
+
+class HeartbeatMonitor(object):
+    """Round-trip times and missed replies of websocket heart beat pings.
+
+    Each ping carries a sequence number, which the pong echoes back.  A ping
+    that has not been answered by the time the next one is sent counts as
+    missed, and the connection is considered dead after `max_missed`
+    consecutive missed pings.
+
+    Parameters
+    ----------
+    max_missed: int
+        Number of consecutive missed pings after which the connection is
+        considered dead (default=3).
+    history_size: int
+        Number of recent round-trip times kept for :meth:`latency_stats`
+        (default=100).
+    """
+
+    def __init__(self, max_missed=3, history_size=100):
+        self.max_missed = max_missed
+        self.round_trip_times = deque(maxlen=history_size)
+        self.num_missed = 0
+        self._sequence = 0
+        self._ping_time = None
+
+    def reset(self):
+        """Forget the outstanding ping, e.g. for a new connection."""
+        self.num_missed = 0
+        self._ping_time = None
+
+    @property
+    def dead(self):
+        """True if too many consecutive pings have not been answered."""
+        return self.num_missed >= self.max_missed
+
+    def ping(self):
+        """Record that a ping is being sent, and return its payload."""
+        if self._ping_time is not None:
+            self.num_missed += 1
+        self._sequence += 1
+        self._ping_time = time.time()
+        return str(self._sequence).encode('ascii')
+
+    def pong(self, data):
+        """Record a pong, and return the round-trip time (None if unexpected)."""
+        if self._ping_time is None or data != str(self._sequence).encode('ascii'):
+            return None
+        round_trip_time = time.time() - self._ping_time
+        self.round_trip_times.append(round_trip_time)
+        self._ping_time = None
+        self.num_missed = 0
+        return round_trip_time
+
+    def latency_stats(self):
+        """Summarise the recent round-trip times, in seconds.
+
+        Returns
+        -------
+        dict:
+            'count', 'min', 'mean', 'p50', 'p90', 'p99' and 'max' of the
+            recent round-trip times ('count' only, if there are none yet),
+            and the current number of consecutive 'missed' pings.
+        """
+        stats = latency_stats(self.round_trip_times)
+        stats['missed'] = self.num_missed
+        return stats
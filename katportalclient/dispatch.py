@@ -0,0 +1,223 @@
+###############################################################################
+# SKA South Africa (http://ska.ac.za/)                                        #
+# Author: cam@ska.ac.za                                                       #
+# Copyright @ 2013 SKA SA. All rights reserved.                               #
+#                                                                             #
+# THIS SOFTWARE MAY NOT BE COPIED OR DISTRIBUTED IN ANY FORM WITHOUT THE      #
+# WRITTEN PERMISSION OF SKA SA.                                               #
+###############################################################################
+"""Module defining how Pub/Sub updates are delivered to the user."""
+
+import re
+
+
+# Characters with a special meaning in Redis glob-style patterns
+_GLOB_SPECIAL = frozenset('*?[\\')
+
+
+def is_glob_pattern(pattern):
+    """Return True if a subscription string is a Redis glob-style pattern."""
+    return any(char in _GLOB_SPECIAL for char in pattern)
+
+
+def glob_to_regex(pattern):
+    """Compile a Redis glob-style pattern into an equivalent regular expression.
+
+    Follows Redis' rules: '*' matches any characters (including none),
+    '?' matches a single character, '[abc]', '[a-z]' and '[^abc]' match
+    character classes, and '\\' escapes the next character.
+
+    Parameters
+    ----------
+    pattern: str
+        Redis glob-style pattern, e.g. 'namespace:m06[23]_ap_*'.
+
+    Returns
+    -------
+    A compiled regular expression that matches the whole channel name.
+    """
+    parts = []
+    index = 0
+    length = len(pattern)
+    while index < length:
+        char = pattern[index]
+        index += 1
+        if char == '*':
+            parts.append('.*')
+        elif char == '?':
+            parts.append('.')
+        elif char == '\\' and index < length:
+            parts.append(re.escape(pattern[index]))
+            index += 1
+        elif char == '[':
+            negate = index < length and pattern[index] == '^'
+            if negate:
+                index += 1
+            members = []
+            while index < length and pattern[index] != ']':
+                if pattern[index] == '\\' and index + 1 < length:
+                    index += 1
+                    members.append(re.escape(pattern[index]))
+                elif (index + 2 < length and pattern[index + 1] == '-' and
+                        pattern[index + 2] != ']'):
+                    start, end = sorted((pattern[index], pattern[index + 2]))
+                    members.append('{}-{}'.format(re.escape(start), re.escape(end)))
+                    index += 2
+                else:
+                    members.append(re.escape(pattern[index]))
+                index += 1
+            # Redis treats an unterminated class as running to the end
+            index += 1
+            if members:
+                parts.append('[{}{}]'.format('^' if negate else '', ''.join(members)))
+            else:
+                # an empty class matches nothing (or anything, if negated)
+                parts.append('.' if negate else '(?!)')
+        else:
+            parts.append(re.escape(char))
+    return re.compile('(?s)' + ''.join(parts) + r'\Z')
+
+
+class UpdateBatcher(object):
+    """Coalesces updates, and delivers them to a callback as lists.
+
+    An update is delivered at most `interval_sec` after it was added, or
+    as soon as `max_batch_size` updates are waiting, whichever is first.
+    Updates are delivered in the order they were added, and each batch
+    is delivered with a single IOLoop callback.
+
+    Parameters
+    ----------
+    callback: function
+        Called with a list of updates, e.g. `def on_update(messages)`.
+    io_loop: tornado.ioloop.IOLoop
+        IOLoop to deliver the updates on.
+    interval_sec: float
+        Maximum time an update is held back, in seconds.
+    max_batch_size: int
+        Maximum number of updates per batch.
+    """
+
+    def __init__(self, callback, io_loop, interval_sec, max_batch_size):
+        if interval_sec < 0 or max_batch_size < 1:
+            raise ValueError(
+                "Invalid batch interval {} or size {}".format(
+                    interval_sec, max_batch_size))
+        self._callback = callback
+        self._io_loop = io_loop
+        self.interval_sec = interval_sec
+        self.max_batch_size = max_batch_size
+        self._updates = []
+        self._timeout = None
+
+    def __len__(self):
+        return len(self._updates)
+
+    def add(self, update):
+        """Add an update to the current batch."""
+        self._updates.append(update)
+        if len(self._updates) >= self.max_batch_size:
+            self.flush()
+        elif self._timeout is None:
+            self._timeout = self._io_loop.call_later(
+                self.interval_sec, self.flush)
+
+    def flush(self):
+        """Deliver the current batch now, if it is not empty."""
+        if self._timeout is not None:
+            self._io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        if self._updates:
+            updates, self._updates = self._updates, []
+            self._io_loop.add_callback(self._callback, updates)
+
+
+class MessageRouter(object):
+    """Finds the handlers for Pub/Sub messages, based on their channel.
+
+    Handlers are registered for exact channel names or Redis glob-style
+    patterns, each including the namespace, e.g. 'namespace:sensor_*'.
+    Redis delivers a separate message for each pattern subscription that
+    matches a channel, labelled with the pattern, so such messages are
+    routed to the pattern's handlers by dictionary lookup.  The compiled
+    patterns are only searched for messages that do not name a known
+    pattern.
+
+    Pattern subscriptions in the general namespace are registered under
+    the namespace '*', e.g. '*:sensor_*', as katportal picks that
+    namespace's name.  Their messages name the actual namespace, e.g.
+    'general:sensor_*', so they are routed by the part of the pattern
+    after the namespace when no handlers have that exact pattern.
+    """
+
+    def __init__(self):
+        self._exact = {}
+        # pattern -> (compiled regex, list of handlers)
+        self._patterns = {}
+
+    def __len__(self):
+        return len(self._exact) + len(self._patterns)
+
+    def add(self, pattern, handler):
+        """Register a handler for a channel name or glob-style pattern."""
+        if is_glob_pattern(pattern):
+            if pattern not in self._patterns:
+                self._patterns[pattern] = (glob_to_regex(pattern), [])
+            handlers = self._patterns[pattern][1]
+        else:
+            handlers = self._exact.setdefault(pattern, [])
+        if handler not in handlers:
+            handlers.append(handler)
+
+    def remove(self, pattern, handler=None):
+        """Remove the handlers for a channel name or glob-style pattern.
+
+        If `handler` is specified, only that handler is removed, otherwise
+        all the pattern's handlers are.
+        """
+        if handler is None:
+            self._exact.pop(pattern, None)
+            self._patterns.pop(pattern, None)
+            return
+        if pattern in self._patterns:
+            handlers = self._patterns[pattern][1]
+        else:
+            handlers = self._exact.get(pattern, [])
+        if handler in handlers:
+            handlers.remove(handler)
+        if not handlers:
+            self.remove(pattern)
+
+    def route(self, channel, pattern=None):
+        """Return the handlers for a message.
+
+        Parameters
+        ----------
+        channel: str
+            The channel the message was published on ('msg_channel').
+        pattern: str
+            The subscription pattern the message was delivered for
+            ('msg_pattern'), if any.
+
+        Returns
+        -------
+        list:
+            The handlers for the message, which may be empty.  A message
+            delivered for a pattern without handlers has none, as Redis
+            delivers another copy for each pattern that has them.
+        """
+        if pattern is not None:
+            entry = self._patterns.get(pattern)
+            if entry is None:
+                _, separator, sub_string = pattern.partition(':')
+                if separator:
+                    entry = self._patterns.get('*:' + sub_string)
+            return entry[1] if entry is not None else []
+        handlers = self._exact.get(channel)
+        if handlers:
+            return handlers
+        matched = []
+        for regex, pattern_handlers in self._patterns.itervalues():
+            if regex.match(channel):
+                matched.extend(pattern_handlers)
+        return matched
@@ -0,0 +1,925 @@
+###############################################################################
+# SKA South Africa (http://ska.ac.za/)                                        #
+# Author: cam@ska.ac.za                                                       #
+# Copyright @ 2013 SKA SA. All rights reserved.                               #
+#                                                                             #
+# THIS SOFTWARE MAY NOT BE COPIED OR DISTRIBUTED IN ANY FORM WITHOUT THE      #
+# WRITTEN PERMISSION OF SKA SA.                                               #
+###############################################################################
+"""Module defining sensor sample types and sample history accumulators."""
+
+import bisect
+import heapq
+import itertools
+import math
+import operator
+import time
+from array import array
+from collections import namedtuple
+
+import tornado.gen
+import tornado.queues
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+
+# Request sample times  in milliseconds for better precision
+SAMPLE_HISTORY_REQUEST_TIME_TYPE = 'ms'
+SAMPLE_HISTORY_REQUEST_MULTIPLIER_TO_SEC = 1000.0
+# Maximum number of time ordered runs of samples to merge, instead of sorting
+MAX_MERGE_RUNS = 64
+
+
+class SensorSample(namedtuple('SensorSample', 'timestamp, value, status')):
+    """Class to represent all sensor samples.
+
+    Fields:
+        - timestamp:  float
+            The timestamp (UNIX epoch) the sample was received by CAM.
+            timestamp value is reported with millisecond precision.
+        - value:  str
+            The value of the sensor when sampled.  The units depend on the
+            sensor, see :meth:`.sensor_detail`.
+        - status:  str
+            The status of the sensor when the sample was taken. As defined
+            by the KATCP protocol. Examples: 'nominal', 'warn', 'failure', 'error',
+            'critical', 'unreachable', 'unknown', etc.
+    """
+
+    def csv(self):
+        """Returns sample in comma separated values format."""
+        return '{},{},{}'.format(self.timestamp, self.value, self.status)
+
+
+class SensorSampleValueTs(namedtuple(
+        'SensorSampleValueTs', 'timestamp, value_timestamp, value, status')):
+    """Class to represent sensor samples, including the value_timestamp.
+
+    Fields:
+        - timestamp:  float
+            The timestamp (UNIX epoch) the sample was received by CAM.
+            Timestamp value is reported with millisecond precision.
+        - value_timestamp:  float
+            The timestamp (UNIX epoch) the sample was read at the lowest level sensor.
+            value_timestamp value is reported with millisecond precision.
+        - value:  str
+            The value of the sensor when sampled.  The units depend on the
+            sensor, see :meth:`.sensor_detail`.
+        - status:  str
+            The status of the sensor when the sample was taken. As defined
+            by the KATCP protocol. Examples: 'nominal', 'warn', 'failure', 'error',
+            'critical', 'unreachable', 'unknown', etc.
+    """
+
+    def csv(self):
+        """Returns sample in comma separated values format."""
+        return '{},{},{},{}'.format(
+            self.timestamp, self.value_timestamp, self.value, self.status)
+
+
+class SensorSampleAggregate(namedtuple(
+        'SensorSampleAggregate',
+        'timestamp, count, min, max, mean, last, status, numeric_count')):
+    """Class to represent the summary of the sensor samples in a time bucket.
+
+    Fields:
+        - timestamp:  float
+            The start time (UNIX epoch) of the bucket.
+        - count:  int
+            The number of samples in the bucket.
+        - min:  float
+            The minimum sample value, or None if the values are not numeric.
+        - max:  float
+            The maximum sample value, or None if the values are not numeric.
+        - mean:  float
+            The mean sample value, or None if the values are not numeric.
+        - last:  str
+            The value of the latest sample in the bucket.
+        - status:  str
+            The status of the latest sample in the bucket.
+        - numeric_count:  int
+            The number of samples in the bucket with numeric values, which
+            the min, max and mean are based on.
+    """
+
+    def csv(self):
+        """Returns aggregate in comma separated values format."""
+        return '{},{},{},{},{},{},{},{}'.format(*self)
+
+
+def _float_array(values):
+    """Return an array('d') of sample times as a float64 numpy array."""
+    if not values:
+        return np.zeros(0, dtype=np.float64)
+    return np.frombuffer(values, dtype=np.float64).copy()
+
+
+def _object_array(values):
+    """Return sample values as an object array, without converting them."""
+    array_values = np.empty(len(values), dtype=object)
+    array_values[:] = values
+    return array_values
+
+
+def _value_array(values):
+    """Return sample values as a float array if possible, else an object array."""
+    try:
+        return np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        return _object_array(values)
+
+
+class SensorSampleArrays(object):
+    """Columnar representation of a sensor's sample history.
+
+    Returned by :meth:`.KATPortalClient.sensor_history` when `as_arrays`
+    is set.  All the arrays have the same length and are ordered by
+    timestamp.  Requires numpy.
+
+    Attributes
+    ----------
+    timestamp: numpy.ndarray of float64
+        The timestamps (UNIX epoch) the samples were received by CAM.
+    value_timestamp: numpy.ndarray of float64 or None
+        The timestamps (UNIX epoch) the samples were read at the lowest level
+        sensor.  None, unless `include_value_ts` was requested.
+    value: numpy.ndarray
+        The sample values.  The array has a float64 dtype if all the values
+        could be converted to floats, otherwise it is an object array with
+        the values as received.
+    status_code: numpy.ndarray of uint8
+        The status of each sample, as an index into `status_names`.
+    status_names: tuple of str
+        The distinct KATCP status names, e.g. ('nominal', 'warn').
+    """
+
+    def __init__(self, timestamp, value_timestamp, value, status_code,
+                 status_names):
+        self.timestamp = timestamp
+        self.value_timestamp = value_timestamp
+        self.value = value
+        self.status_code = status_code
+        self.status_names = tuple(status_names)
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def __repr__(self):
+        return "<{} with {} samples>".format(
+            self.__class__.__name__, len(self))
+
+    @classmethod
+    def from_samples(cls, samples, include_value_ts=False):
+        """Create from a time ordered list of sample namedtuples.
+
+        Parameters
+        ----------
+        samples: list
+            List of :class:`.SensorSample` or :class:`.SensorSampleValueTs`
+            namedtuples.
+        include_value_ts: bool
+            Also store the value timestamps, which requires
+            :class:`.SensorSampleValueTs` namedtuples.
+        """
+        if np is None:
+            raise ImportError("numpy is required for columnar sample history")
+        status_lookup = {}
+        status_codes = [status_lookup.setdefault(sample.status, len(status_lookup))
+                        for sample in samples]
+        value_timestamp = None
+        if include_value_ts:
+            value_timestamp = np.array(
+                [sample.value_timestamp for sample in samples], dtype=np.float64)
+        return cls(
+            timestamp=np.array(
+                [sample.timestamp for sample in samples], dtype=np.float64),
+            value_timestamp=value_timestamp,
+            value=_value_array([sample.value for sample in samples]),
+            status_code=np.array(status_codes, dtype=np.uint8),
+            status_names=sorted(status_lookup, key=status_lookup.get))
+
+    @classmethod
+    def from_columns(cls, samples, include_value_ts=False):
+        """Create from a :class:`.SampleColumns`.
+
+        Parameters
+        ----------
+        samples: :class:`.SampleColumns`
+            Time ordered sample columns.
+        include_value_ts: bool
+            Also store the value timestamps.
+        """
+        if np is None:
+            raise ImportError("numpy is required for columnar sample history")
+        status_lookup = {}
+        status_codes = [status_lookup.setdefault(status, len(status_lookup))
+                        for status in samples.status]
+        value_timestamp = None
+        if include_value_ts:
+            value_timestamp = _float_array(samples.value_timestamp)
+        return cls(
+            timestamp=_float_array(samples.timestamp),
+            value_timestamp=value_timestamp,
+            value=_value_array(samples.value),
+            status_code=np.array(status_codes, dtype=np.uint8),
+            status_names=sorted(status_lookup, key=status_lookup.get))
+
+    @classmethod
+    def concatenate(cls, parts):
+        """Join several :class:`.SensorSampleArrays` end to end.
+
+        The parts are assumed to cover consecutive, non-overlapping time
+        ranges, so the result stays time ordered.  The status codes are
+        remapped to a common set of status names.
+        """
+        status_names = []
+        status_lookup = {}
+        status_codes = []
+        for part in parts:
+            code_map = np.zeros(max(1, len(part.status_names)), dtype=np.uint8)
+            for code, name in enumerate(part.status_names):
+                if name not in status_lookup:
+                    status_lookup[name] = len(status_names)
+                    status_names.append(name)
+                code_map[code] = status_lookup[name]
+            status_codes.append(code_map[part.status_code])
+        value_timestamp = None
+        if parts and parts[0].value_timestamp is not None:
+            value_timestamp = np.concatenate(
+                [part.value_timestamp for part in parts])
+        values = [part.value for part in parts]
+        if any(value.dtype == object for value in values):
+            values = [value.astype(object) for value in values]
+        return cls(
+            timestamp=np.concatenate(
+                [part.timestamp for part in parts] or [np.zeros(0)]),
+            value_timestamp=value_timestamp,
+            value=np.concatenate(values or [np.zeros(0)]),
+            status_code=np.concatenate(
+                status_codes or [np.zeros(0, dtype=np.uint8)]),
+            status_names=status_names)
+
+    @property
+    def status(self):
+        """Return the status names per sample, as an object array."""
+        names = np.array(self.status_names, dtype=object)
+        return names[self.status_code]
+
+    def to_samples(self):
+        """Return the samples as a list of sample namedtuples.
+
+        Returns
+        -------
+        list:
+            List of :class:`.SensorSample` or, if the value timestamps are
+            available, :class:`.SensorSampleValueTs` namedtuples.
+        """
+        timestamps = self.timestamp.tolist()
+        values = self.value.tolist()
+        statuses = self.status.tolist()
+        if self.value_timestamp is None:
+            return [SensorSample(*fields)
+                    for fields in zip(timestamps, values, statuses)]
+        value_timestamps = self.value_timestamp.tolist()
+        return [SensorSampleValueTs(*fields)
+                for fields in zip(timestamps, value_timestamps, values, statuses)]
+
+
+class SampleColumns(object):
+    """Time ordered sample history, stored column by column.
+
+    Unlike :class:`.SensorSampleArrays`, this does not need numpy.  The
+    times are stored in float arrays, and the values and statuses in
+    lists, as received.  It is the form in which the local history cache
+    stores and merges samples.
+
+    Attributes
+    ----------
+    timestamp: array.array of float
+        The timestamps (UNIX epoch) the samples were received by CAM.
+    value_timestamp: array.array of float
+        The timestamps (UNIX epoch) the samples were read at the lowest level
+        sensor.
+    value: list
+        The sample values.
+    status: list of str
+        The status of each sample.
+    """
+
+    COLUMNS = ('timestamp', 'value_timestamp', 'value', 'status')
+
+    def __init__(self, timestamp=None, value_timestamp=None, value=None,
+                 status=None):
+        self.timestamp = array('d') if timestamp is None else timestamp
+        self.value_timestamp = (array('d') if value_timestamp is None
+                                else value_timestamp)
+        self.value = [] if value is None else value
+        self.status = [] if status is None else status
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def __repr__(self):
+        return "<{} with {} samples>".format(
+            self.__class__.__name__, len(self))
+
+    def _columns(self):
+        return [getattr(self, name) for name in self.COLUMNS]
+
+    def slice(self, first=0, last=None):
+        """Return a copy of the samples with indices in [first, last)."""
+        return SampleColumns(*[column[first:last] for column in self._columns()])
+
+    def take(self, indices):
+        """Return a copy of the samples with the given indices, in that order."""
+        timestamp, value_timestamp, value, status = self._columns()
+        return SampleColumns(
+            array('d', [timestamp[index] for index in indices]),
+            array('d', [value_timestamp[index] for index in indices]),
+            [value[index] for index in indices],
+            [status[index] for index in indices])
+
+    def between(self, start_time_sec, end_time_sec):
+        """Return a copy of the samples in a time range, including both ends."""
+        return self.slice(bisect.bisect_left(self.timestamp, start_time_sec),
+                          bisect.bisect_right(self.timestamp, end_time_sec))
+
+    def insert(self, other):
+        """Merge another time ordered set of samples into these, in place.
+
+        Other samples that all fall between two consecutive samples, e.g.
+        those retrieved for a gap in the cache, are spliced in.  Otherwise
+        the columns are reordered.
+        """
+        if not len(other):
+            return
+        index = bisect.bisect_right(self.timestamp, other.timestamp[0])
+        if index == len(self) or other.timestamp[-1] <= self.timestamp[index]:
+            for column, other_column in zip(self._columns(), other._columns()):
+                column[index:index] = other_column
+            return
+        for column, other_column in zip(self._columns(), other._columns()):
+            column.extend(other_column)
+        merged = self.take(sorted(xrange(len(self)),
+                                  key=self.timestamp.__getitem__))
+        for name in self.COLUMNS:
+            setattr(self, name, getattr(merged, name))
+
+    def samples(self, include_value_ts=False):
+        """Return the samples as a list of sample namedtuples.
+
+        Returns
+        -------
+        list:
+            List of :class:`.SensorSample` or, if `include_value_ts` is set,
+            :class:`.SensorSampleValueTs` namedtuples.
+        """
+        if include_value_ts:
+            return [SensorSampleValueTs(*fields) for fields in zip(
+                self.timestamp, self.value_timestamp, self.value, self.status)]
+        return [SensorSample(*fields)
+                for fields in zip(self.timestamp, self.value, self.status)]
+
+    @staticmethod
+    def concatenate(parts):
+        """Join several :class:`.SampleColumns` end to end.
+
+        The parts are assumed to cover consecutive, non-overlapping time
+        ranges, so the result stays time ordered.
+        """
+        result = SampleColumns()
+        for part in parts:
+            for column, part_column in zip(result._columns(), part._columns()):
+                column.extend(part_column)
+        return result
+
+
+def parse_samples(raw_samples, include_value_ts=False):
+    """Convert a block of raw samples, as published by katportal, to namedtuples.
+
+    Each sample is a list with 6 elements, e.g.
+    ``[1476164224429L, 1476164223640L, 1476164224429354L,
+    u'5.07571614843', u'anc_mean_wind_speed', u'nominal']``.
+    The times are in milliseconds, so are scaled to seconds.
+    Samples with an unexpected length are ignored.
+
+    Parameters
+    ----------
+    raw_samples: list
+        List of raw samples.
+    include_value_ts: bool
+        Build :class:`.SensorSampleValueTs` instead of :class:`.SensorSample`
+        namedtuples.
+
+    Returns
+    -------
+    list:
+        List of sample namedtuples, in the same order as the raw samples.
+    """
+    samples = []
+    for sample in raw_samples:
+        if len(sample) == 6:
+            if include_value_ts:
+                sensor_sample = SensorSampleValueTs(
+                    timestamp=sample[0] / SAMPLE_HISTORY_REQUEST_MULTIPLIER_TO_SEC,
+                    value_timestamp=sample[1] / SAMPLE_HISTORY_REQUEST_MULTIPLIER_TO_SEC,
+                    value=sample[3],
+                    status=sample[5])
+            else:
+                sensor_sample = SensorSample(
+                    timestamp=sample[0] / SAMPLE_HISTORY_REQUEST_MULTIPLIER_TO_SEC,
+                    value=sample[3],
+                    status=sample[5])
+            samples.append(sensor_sample)
+    return samples
+
+
+class SampleListAccumulator(object):
+    """Accumulates sample history data as a list of sample namedtuples.
+
+    The blocks of samples published by katportal are each time ordered,
+    but may arrive out of order relative to one another.  The samples are
+    kept in time ordered runs, so that the final result can be produced by
+    merging the runs, rather than sorting all the samples again.
+
+    Parameters
+    ----------
+    include_value_ts: bool
+        Build :class:`.SensorSampleValueTs` instead of :class:`.SensorSample`
+        namedtuples.
+
+    Attributes
+    ----------
+    num_runs: int
+        Number of time ordered runs the samples were received in.
+    sort_duration_sec: float
+        Time taken to order the samples in the last call to :meth:`.result`.
+    """
+
+    def __init__(self, include_value_ts=False):
+        self.include_value_ts = include_value_ts
+        self.sort_duration_sec = 0.0
+        self.last_timestamp = None
+        self._runs = []
+        self._num_samples = 0
+
+    def __len__(self):
+        return self._num_samples
+
+    @property
+    def num_runs(self):
+        return len(self._runs)
+
+    def add_samples(self, raw_samples):
+        """Add a block of raw samples, as published by katportal.
+
+        See :func:`.parse_samples` for the format of the raw samples.
+
+        Returns
+        -------
+        int:
+            Number of samples added.
+        """
+        samples = parse_samples(raw_samples, self.include_value_ts)
+        run = self._runs[-1] if self._runs else None
+        for sample in samples:
+            if run is None or sample.timestamp < run[-1].timestamp:
+                run = [sample]
+                self._runs.append(run)
+            else:
+                run.append(sample)
+            if self.last_timestamp is None or sample.timestamp > self.last_timestamp:
+                self.last_timestamp = sample.timestamp
+        self._num_samples += len(samples)
+        return len(samples)
+
+    def result(self):
+        """Return the samples, sorted by timestamp."""
+        start_sec = time.time()
+        if len(self._runs) == 1:
+            # samples arrived in order, so there is nothing to do
+            samples = list(self._runs[0])
+        elif len(self._runs) <= MAX_MERGE_RUNS:
+            samples = list(heapq.merge(*self._runs))
+        else:
+            # badly fragmented, a full sort is cheaper than a wide merge
+            samples = sorted(itertools.chain(*self._runs),
+                             key=operator.attrgetter('timestamp'))
+        self.sort_duration_sec = time.time() - start_sec
+        return samples
+
+    @staticmethod
+    def combine(results):
+        """Join results for consecutive, non-overlapping time ranges."""
+        return list(itertools.chain(*results))
+
+
+class SampleArrayAccumulator(object):
+    """Accumulates sample history data in growable typed arrays.
+
+    Timestamps and numeric values are stored as doubles and statuses as
+    single byte codes, so the memory used per sample is a small fraction of
+    that used by a namedtuple per sample.  The values are only kept as a
+    list of objects once a value that is not numeric arrives, in which case
+    the values before it are kept as floats.  The result is a
+    :class:`.SensorSampleArrays`.
+
+    Parameters
+    ----------
+    include_value_ts: bool
+        Also store the value timestamps.
+
+    Attributes
+    ----------
+    num_runs: int
+        Number of time ordered runs the samples were received in.
+    sort_duration_sec: float
+        Time taken to order the samples in the last call to :meth:`.result`.
+    """
+
+    def __init__(self, include_value_ts=False):
+        if np is None:
+            raise ImportError("numpy is required for columnar sample history")
+        self.include_value_ts = include_value_ts
+        self.num_runs = 0
+        self.sort_duration_sec = 0.0
+        self.last_timestamp = None
+        self._timestamps = array('d')
+        self._value_timestamps = array('d')
+        # float array, or a list once a value is not numeric
+        self._values = array('d')
+        self._status_codes = array('B')
+        self._status_names = []
+        self._status_lookup = {}
+
+    def __len__(self):
+        return len(self._timestamps)
+
+    def _status_code(self, status):
+        code = self._status_lookup.get(status)
+        if code is None:
+            code = len(self._status_names)
+            if code > 255:
+                raise ValueError("Too many distinct sample statuses")
+            self._status_lookup[status] = code
+            self._status_names.append(status)
+        return code
+
+    def add_samples(self, raw_samples):
+        """Add a block of raw samples, as published by katportal.
+
+        See :func:`.parse_samples` for the format of the raw samples.
+        """
+        raw_samples = [sample for sample in raw_samples if len(sample) == 6]
+        timestamps = self._timestamps
+        for sample in raw_samples:
+            timestamp = sample[0] / SAMPLE_HISTORY_REQUEST_MULTIPLIER_TO_SEC
+            if not timestamps or timestamp < timestamps[-1]:
+                self.num_runs += 1
+            if self.last_timestamp is None or timestamp > self.last_timestamp:
+                self.last_timestamp = timestamp
+            timestamps.append(timestamp)
+            self._status_codes.append(self._status_code(sample[5]))
+        if self.include_value_ts:
+            self._value_timestamps.extend(
+                sample[1] / SAMPLE_HISTORY_REQUEST_MULTIPLIER_TO_SEC
+                for sample in raw_samples)
+        values = [sample[3] for sample in raw_samples]
+        if isinstance(self._values, array):
+            try:
+                values = array('d', [float(value) for value in values])
+            except (TypeError, ValueError):
+                self._values = self._values.tolist()
+        self._values.extend(values)
+        return len(raw_samples)
+
+    def result(self):
+        """Return a :class:`.SensorSampleArrays`, sorted by timestamp."""
+        start_sec = time.time()
+
+        def column(values, dtype):
+            return np.frombuffer(values, dtype=dtype) if values \
+                else np.zeros(0, dtype=dtype)
+
+        timestamps = column(self._timestamps, np.float64)
+        if self.num_runs <= 1:
+            # samples arrived in order, so only a copy is needed
+            def ordered(values):
+                return values.copy()
+        else:
+            order = np.argsort(timestamps, kind='mergesort')
+
+            def ordered(values):
+                return values[order]
+        value_timestamps = None
+        if self.include_value_ts:
+            value_timestamps = ordered(column(self._value_timestamps, np.float64))
+        result = SensorSampleArrays(
+            timestamp=ordered(timestamps),
+            value_timestamp=value_timestamps,
+            value=ordered(column(self._values, np.float64)
+                          if isinstance(self._values, array)
+                          else _object_array(self._values)),
+            status_code=ordered(column(self._status_codes, np.uint8)),
+            status_names=self._status_names)
+        self.sort_duration_sec = time.time() - start_sec
+        return result
+
+    @staticmethod
+    def combine(results):
+        """Join results for consecutive, non-overlapping time ranges."""
+        return SensorSampleArrays.concatenate(results)
+
+
+class SampleColumnAccumulator(object):
+    """Accumulates sample history data as :class:`.SampleColumns`.
+
+    All the fields of each sample are kept, including the value timestamp,
+    as needed by the local history cache.
+
+    Attributes
+    ----------
+    num_runs: int
+        Number of time ordered runs the samples were received in.
+    sort_duration_sec: float
+        Time taken to order the samples in the last call to :meth:`.result`.
+    """
+
+    def __init__(self):
+        self.num_runs = 0
+        self.sort_duration_sec = 0.0
+        self.last_timestamp = None
+        self._samples = SampleColumns()
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add_samples(self, raw_samples):
+        """Add a block of raw samples, as published by katportal.
+
+        See :func:`.parse_samples` for the format of the raw samples.
+        """
+        num_added = 0
+        samples = self._samples
+        for sample in raw_samples:
+            if len(sample) == 6:
+                timestamp = sample[0] / SAMPLE_HISTORY_REQUEST_MULTIPLIER_TO_SEC
+                if not samples.timestamp or timestamp < samples.timestamp[-1]:
+                    self.num_runs += 1
+                if self.last_timestamp is None or timestamp > self.last_timestamp:
+                    self.last_timestamp = timestamp
+                samples.timestamp.append(timestamp)
+                samples.value_timestamp.append(
+                    sample[1] / SAMPLE_HISTORY_REQUEST_MULTIPLIER_TO_SEC)
+                samples.value.append(sample[3])
+                samples.status.append(sample[5])
+                num_added += 1
+        return num_added
+
+    def result(self):
+        """Return a :class:`.SampleColumns`, sorted by timestamp."""
+        start_sec = time.time()
+        samples = self._samples
+        if self.num_runs <= 1:
+            result = samples.slice()
+        else:
+            result = samples.take(sorted(xrange(len(samples)),
+                                         key=samples.timestamp.__getitem__))
+        self.sort_duration_sec = time.time() - start_sec
+        return result
+
+    @staticmethod
+    def combine(results):
+        """Join results for consecutive, non-overlapping time ranges."""
+        return SampleColumns.concatenate(results)
+
+
+class SampleBucketAggregator(object):
+    """Summarises sample history data in fixed width time buckets.
+
+    The samples are reduced as they arrive, so only the summary of each
+    bucket is held in memory.  The result is a list of
+    :class:`.SensorSampleAggregate` namedtuples.
+
+    Parameters
+    ----------
+    bucket_sec: float
+        Width of each time bucket, in seconds.
+    origin_sec: float
+        Start time of the first bucket, in seconds since the UNIX epoch.
+        Typically the start of the history query.
+    """
+
+    def __init__(self, bucket_sec, origin_sec=0.0):
+        if bucket_sec <= 0:
+            raise ValueError("Bucket width must be positive, not {}"
+                             .format(bucket_sec))
+        self.bucket_sec = float(bucket_sec)
+        self.origin_sec = origin_sec
+        self.num_runs = 0
+        self.sort_duration_sec = 0.0
+        self.last_timestamp = None
+        # bucket index -> [count, numeric count, min, max, sum,
+        #                  last timestamp, last value, last status]
+        self._buckets = {}
+        self._num_samples = 0
+
+    def __len__(self):
+        return self._num_samples
+
+    def add_sample(self, timestamp, value, status):
+        """Add a single sample, with timestamp in seconds."""
+        index = int(math.floor((timestamp - self.origin_sec) / self.bucket_sec))
+        bucket = self._buckets.get(index)
+        if bucket is None:
+            bucket = [0, 0, None, None, 0.0, None, None, None]
+            self._buckets[index] = bucket
+        bucket[0] += 1
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            pass
+        else:
+            bucket[1] += 1
+            bucket[2] = number if bucket[2] is None else min(bucket[2], number)
+            bucket[3] = number if bucket[3] is None else max(bucket[3], number)
+            bucket[4] += number
+        if bucket[5] is None or timestamp >= bucket[5]:
+            bucket[5:] = [timestamp, value, status]
+        if self.last_timestamp is None or timestamp > self.last_timestamp:
+            self.last_timestamp = timestamp
+        self._num_samples += 1
+
+    def add_samples(self, raw_samples):
+        """Add a block of raw samples, as published by katportal.
+
+        See :func:`.parse_samples` for the format of the raw samples.
+        """
+        num_added = 0
+        for sample in raw_samples:
+            if len(sample) == 6:
+                self.add_sample(
+                    sample[0] / SAMPLE_HISTORY_REQUEST_MULTIPLIER_TO_SEC,
+                    sample[3], sample[5])
+                num_added += 1
+        return num_added
+
+    def result(self):
+        """Return the non-empty buckets, in time order."""
+        start_sec = time.time()
+        result = []
+        for index in sorted(self._buckets):
+            count, num_numeric, minimum, maximum, total, _, last, status = \
+                self._buckets[index]
+            result.append(SensorSampleAggregate(
+                timestamp=self.origin_sec + index * self.bucket_sec,
+                count=count,
+                min=minimum,
+                max=maximum,
+                mean=total / num_numeric if num_numeric else None,
+                last=last,
+                status=status,
+                numeric_count=num_numeric))
+        self.sort_duration_sec = time.time() - start_sec
+        return result
+
+    @staticmethod
+    def combine(results):
+        """Join results for consecutive, non-overlapping time ranges.
+
+        A bucket that straddles the boundary between two time ranges
+        appears in both results, so the two parts are merged.
+        """
+        combined = []
+        for aggregate in itertools.chain(*results):
+            if combined and combined[-1].timestamp == aggregate.timestamp:
+                previous = combined[-1]
+                numeric = [part for part in (previous, aggregate)
+                           if part.numeric_count]
+                num_numeric = sum(part.numeric_count for part in numeric)
+                minimum = maximum = mean = None
+                if numeric:
+                    minimum = min(part.min for part in numeric)
+                    maximum = max(part.max for part in numeric)
+                    mean = sum(part.mean * part.numeric_count
+                               for part in numeric) / num_numeric
+                combined[-1] = SensorSampleAggregate(
+                    previous.timestamp, previous.count + aggregate.count,
+                    minimum, maximum, mean, aggregate.last, aggregate.status,
+                    num_numeric)
+            else:
+                combined.append(aggregate)
+        return combined
+
+
+class SampleWindowFilter(object):
+    """Passes on only the raw samples inside a time window to an accumulator.
+
+    Used when a history query is split into adjacent sub-windows, so that
+    samples exactly on a boundary between two windows are only kept once.
+
+    Parameters
+    ----------
+    samples: accumulator
+        The accumulator to pass the samples on to, e.g.
+        :class:`.SampleListAccumulator`.
+    start_time_sec: float
+        Start of the window (inclusive), in seconds since the UNIX epoch.
+    end_time_sec: float
+        End of the window, in seconds since the UNIX epoch.
+    include_end: bool
+        Keep samples with a timestamp equal to `end_time_sec`.
+    """
+
+    def __init__(self, samples, start_time_sec, end_time_sec, include_end=False):
+        self.samples = samples
+        self.num_received = 0
+        self._start_ms = start_time_sec * SAMPLE_HISTORY_REQUEST_MULTIPLIER_TO_SEC
+        self._end_ms = end_time_sec * SAMPLE_HISTORY_REQUEST_MULTIPLIER_TO_SEC
+        self._include_end = include_end
+
+    def __len__(self):
+        return self.num_received
+
+    def _in_window(self, sample):
+        if not sample or sample[0] < self._start_ms:
+            return False
+        if self._include_end:
+            return sample[0] <= self._end_ms
+        return sample[0] < self._end_ms
+
+    def add_samples(self, raw_samples):
+        """Add the raw samples inside the window to the accumulator.
+
+        Returns
+        -------
+        int:
+            Number of samples received, including those outside the window.
+        """
+        self.num_received += len(raw_samples)
+        self.samples.add_samples(
+            [sample for sample in raw_samples if self._in_window(sample)])
+        return len(raw_samples)
+
+
+class SampleChunkQueue(object):
+    """Passes blocks of sample history data on to a callback as they arrive.
+
+    Blocks are buffered until the callback is ready for them, so only the
+    blocks that have not been delivered yet are held in memory.
+
+    Parameters
+    ----------
+    include_value_ts: bool
+        Build :class:`.SensorSampleValueTs` instead of :class:`.SensorSample`
+        namedtuples.
+    """
+
+    def __init__(self, include_value_ts=False):
+        self.include_value_ts = include_value_ts
+        self._queue = tornado.queues.Queue()
+        self._num_received = 0
+
+    def __len__(self):
+        return self._num_received
+
+    def add_samples(self, raw_samples):
+        """Queue a block of raw samples, as published by katportal.
+
+        See :func:`.parse_samples` for the format of the raw samples.
+        """
+        samples = parse_samples(raw_samples, self.include_value_ts)
+        if samples:
+            self._queue.put_nowait(samples)
+            self._num_received += len(samples)
+        return len(samples)
+
+    def close(self):
+        """Indicate that no more samples will be added."""
+        self._queue.put_nowait(None)
+
+    @tornado.gen.coroutine
+    def deliver(self, chunk_callback):
+        """Pass each queued block of samples to `chunk_callback`, until closed.
+
+        If the callback returns a Future, it is waited for before the next
+        block is delivered.
+
+        Returns
+        -------
+        int:
+            Total number of samples delivered.
+        """
+        num_delivered = 0
+        while True:
+            samples = yield self._queue.get()
+            if samples is None:
+                break
+            result = chunk_callback(samples)
+            if tornado.gen.is_future(result):
+                yield result
+            num_delivered += len(samples)
+        raise tornado.gen.Return(num_delivered)
@@ -0,0 +1,202 @@
+###############################################################################
+# SKA South Africa (http://ska.ac.za/)                                        #
+# Author: cam@ska.ac.za                                                       #
+# Copyright @ 2013 SKA SA. All rights reserved.                               #
+#                                                                             #
+# THIS SOFTWARE MAY NOT BE COPIED OR DISTRIBUTED IN ANY FORM WITHOUT THE      #
+# WRITTEN PERMISSION OF SKA SA.                                               #
+###############################################################################
+"""Module defining a local index of sensor names, for matching filters."""
+
+import bisect
+import re
+import time
+
+from dispatch import glob_to_regex
+
+
+# Age after which the sensor index is refreshed, in seconds
+SENSOR_INDEX_TTL_SEC = 3600
+
+# Characters with a special meaning in regular expressions and globs
+_REGEX_SPECIAL = frozenset('.^$*+?{}[]\\|()')
+_GLOB_SPECIAL = frozenset('*?[\\')
+
+
+def _literal_prefix(pattern, special, quantifiers=''):
+    """Return the literal characters at the start of a pattern."""
+    for index, char in enumerate(pattern):
+        if char in special:
+            if char in quantifiers:
+                # a quantifier makes the character before it optional
+                index = max(index - 1, 0)
+            return pattern[:index]
+    return pattern
+
+
+class SensorIndex(object):
+    """Local index of sensor names, for matching filters without katportal.
+
+    The names are kept sorted, so that the names with a given prefix are
+    found by bisection, and only those are searched for patterns that begin
+    with a literal prefix.  A trie of the underscore-separated parts of the
+    names, e.g. component, device and attribute, gives the possible next
+    parts of a name, for completion.
+
+    Parameters
+    ----------
+    sensor_names: iterable of str
+        Initial sensor names (default=(), empty).
+    ttl_sec: float
+        Age after which the index is stale, and should be refreshed
+        (default=SENSOR_INDEX_TTL_SEC).
+    """
+
+    def __init__(self, sensor_names=(), ttl_sec=SENSOR_INDEX_TTL_SEC):
+        self.ttl_sec = ttl_sec
+        self.updated = None
+        self._names = []
+        # part of name -> subtrie, with None -> True marking a complete name
+        self._trie = {}
+        if sensor_names:
+            self.update(sensor_names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, sensor_name):
+        index = bisect.bisect_left(self._names, sensor_name)
+        return index < len(self._names) and self._names[index] == sensor_name
+
+    def __iter__(self):
+        return iter(self._names)
+
+    @property
+    def loaded(self):
+        """True if the index has been filled with the sensor names."""
+        return self.updated is not None
+
+    @property
+    def stale(self):
+        """True if the index has not been updated for `ttl_sec`."""
+        return not self.loaded or time.time() - self.updated >= self.ttl_sec
+
+    def add(self, sensor_name):
+        """Add a sensor name to the index."""
+        index = bisect.bisect_left(self._names, sensor_name)
+        if index < len(self._names) and self._names[index] == sensor_name:
+            return
+        self._names.insert(index, sensor_name)
+        node = self._trie
+        for part in sensor_name.split('_'):
+            node = node.setdefault(part, {})
+        node[None] = True
+
+    def remove(self, sensor_name):
+        """Remove a sensor name from the index, if it is there."""
+        index = bisect.bisect_left(self._names, sensor_name)
+        if index == len(self._names) or self._names[index] != sensor_name:
+            return
+        del self._names[index]
+        path = [self._trie]
+        parts = sensor_name.split('_')
+        for part in parts:
+            path.append(path[-1][part])
+        del path[-1][None]
+        # prune the branches that no longer lead to a name
+        for node, part in reversed(zip(path[:-1], parts)):
+            if node[part]:
+                break
+            del node[part]
+
+    def update(self, sensor_names):
+        """Replace the names in the index, changing only the differences.
+
+        Returns
+        -------
+        tuple:
+            Sorted lists of the (added, removed) sensor names.
+        """
+        new_names = set(sensor_names)
+        old_names = set(self._names)
+        added = sorted(new_names - old_names)
+        removed = sorted(old_names - new_names)
+        if len(added) + len(removed) > len(self._names) // 2:
+            self._names = []
+            self._trie = {}
+            for sensor_name in sorted(new_names):
+                self.add(sensor_name)
+        else:
+            for sensor_name in removed:
+                self.remove(sensor_name)
+            for sensor_name in added:
+                self.add(sensor_name)
+        self.updated = time.time()
+        return added, removed
+
+    def prefixed(self, prefix):
+        """Return the sorted names that start with a prefix."""
+        if not prefix:
+            return list(self._names)
+        first = bisect.bisect_left(self._names, prefix)
+        # the first string after all the ones that start with the prefix
+        last = bisect.bisect_left(
+            self._names, prefix[:-1] + unichr(ord(prefix[-1]) + 1), first)
+        return self._names[first:last]
+
+    def next_parts(self, prefix):
+        """Return the possible next parts of names, for completion.
+
+        Parameters
+        ----------
+        prefix: str
+            Start of a name, e.g. 'anc_' or 'anc_g'.
+
+        Returns
+        -------
+        list:
+            Sorted parts that can complete the last part of the prefix, e.g.
+            ['gust', 'mean'] for 'anc_'.
+        """
+        parts = prefix.split('_')
+        node = self._trie
+        for part in parts[:-1]:
+            node = node.get(part)
+            if node is None:
+                return []
+        return sorted(part for part in node
+                      if part is not None and part.startswith(parts[-1]))
+
+    def search(self, pattern):
+        """Return the sorted names that match a regular expression.
+
+        Like the filters of :meth:`.KATPortalClient.sensor_names`, the
+        pattern can match anywhere in a name, unless it is anchored by '^'.
+        """
+        regex = re.compile(pattern)
+        # alternatives and inline flags, e.g. '(?i)', can change the prefix
+        if pattern.startswith('^') and '|' not in pattern and '(?' not in pattern:
+            candidates = self.prefixed(_literal_prefix(
+                pattern[1:], _REGEX_SPECIAL, quantifiers='?*{'))
+        else:
+            candidates = self._names
+        return [name for name in candidates if regex.search(name)]
+
+    def glob(self, pattern):
+        """Return the sorted names that match a glob-style pattern.
+
+        The pattern must match the whole name, e.g. 'anc_*_wind_speed'.
+        See :func:`.glob_to_regex` for the syntax.
+        """
+        regex = glob_to_regex(pattern)
+        return [name for name in self.prefixed(_literal_prefix(pattern, _GLOB_SPECIAL))
+                if regex.match(name)]
+
+    def search_all(self, patterns):
+        """Return the sorted names that match any of the regular expressions."""
+        if len(patterns) == 1:
+            return self.search(patterns[0])
+        matches = set()
+        for pattern in patterns:
+            matches.update(self.search(pattern))
+        return sorted(matches)
@@ -0,0 +1,281 @@
+###############################################################################
+# SKA South Africa (http://ska.ac.za/)                                        #
+# Author: cam@ska.ac.za                                                       #
+# Copyright @ 2013 SKA SA. All rights reserved.                               #
+#                                                                             #
+# THIS SOFTWARE MAY NOT BE COPIED OR DISTRIBUTED IN ANY FORM WITHOUT THE      #
+# WRITTEN PERMISSION OF SKA SA.                                               #
+###############################################################################
+"""Module sharing websocket connections to katportal between many clients."""
+
+import logging
+
+import tornado.gen
+import tornado.ioloop
+
+from client import KATPortalClient
+from request import JSONRPCRequest
+from transport import HTTPTransport
+
+
+module_logger = logging.getLogger('kat.katportalclient')
+
+
+class SharedWebsocket(object):
+    """A websocket connection shared by several :class:`.SharedKATPortalClient`.
+
+    The connection itself is a :class:`.KATPortalClient` without an
+    `on_update_callback`.  Subscriptions are reference counted per namespace
+    and string identifier, so katportal is only asked to subscribe when the
+    first client subscribes, and to unsubscribe when the last one does.
+    Each string identifier is subscribed with its own request, so that its
+    entry in the connection's reconnect cache is dropped when it is
+    unsubscribed.  Messages are routed to each subscribed client.
+
+    Parameters
+    ----------
+    client: :class:`.KATPortalClient`
+        The client that owns the websocket connection.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.consumers = set()
+        # (namespace, sub_string) -> set of subscribed consumers
+        self._subscribers = {}
+
+    @tornado.gen.coroutine
+    def subscribe(self, consumer, namespace, sub_strings):
+        """Subscribe a client, and return the number of string identifiers."""
+        new_sub_strings = [sub_string for sub_string in sub_strings
+                           if not self._subscribers.get((namespace, sub_string))]
+        for sub_string, pattern in zip(
+                sub_strings, consumer._subscription_patterns(namespace, sub_strings)):
+            self._subscribers.setdefault((namespace, sub_string), set()).add(consumer)
+            self.client._router.add(pattern, consumer._receive_shared_message)
+        yield [self.client.subscribe(namespace, [sub_string])
+               for sub_string in new_sub_strings]
+        raise tornado.gen.Return(len(sub_strings))
+
+    @tornado.gen.coroutine
+    def unsubscribe(self, consumer, namespace, sub_strings):
+        """Unsubscribe a client, and return the number of string identifiers."""
+        unused_sub_strings = []
+        for sub_string, pattern in zip(
+                sub_strings, consumer._subscription_patterns(namespace, sub_strings)):
+            subscribers = self._subscribers.get((namespace, sub_string))
+            if not subscribers or consumer not in subscribers:
+                continue
+            subscribers.discard(consumer)
+            self.client._router.remove(pattern, consumer._receive_shared_message)
+            if not subscribers:
+                del self._subscribers[(namespace, sub_string)]
+                unused_sub_strings.append(sub_string)
+        if self.client.is_connected:
+            yield [self.client.unsubscribe(namespace, [sub_string])
+                   for sub_string in unused_sub_strings]
+        else:
+            # not resubscribed when the connection comes back
+            for sub_string in unused_sub_strings:
+                self.client._cache_jsonrpc_request(
+                    JSONRPCRequest('unsubscribe', [namespace, [sub_string]]))
+        raise tornado.gen.Return(len(sub_strings))
+
+    @tornado.gen.coroutine
+    def release(self, consumer):
+        """Drop all the subscriptions of a client that stops using the connection."""
+        self.consumers.discard(consumer)
+        subscriptions = {}
+        for namespace, sub_string in list(self._subscribers):
+            if consumer in self._subscribers[(namespace, sub_string)]:
+                subscriptions.setdefault(namespace, []).append(sub_string)
+        for namespace, sub_strings in subscriptions.iteritems():
+            yield self.unsubscribe(consumer, namespace, sub_strings)
+
+
+class KATPortalClientManager(object):
+    """Creates clients that share websocket connections to katportal.
+
+    Clients for different subarrays, or with different callbacks, created by
+    the same manager share one websocket connection per katportal
+    websocket URL, with one heart beat and one reconnect cache.  Subscribing
+    and unsubscribing in one client does not affect the subscriptions of
+    the others.  The clients also share one :class:`.HTTPTransport`, and so
+    its HTTP connections, unless they are given their own.  A transport that
+    the manager creates is closed by :meth:`close`.
+
+    Parameters
+    ----------
+    io_loop: tornado.ioloop.IOLoop
+        Optional IOLoop instance (default=None).
+    logger: logging.Logger
+        Optional logger instance (default=None).
+    client_options:
+        Other keyword arguments for the :class:`.KATPortalClient` that owns
+        each shared connection, e.g. `reconnect_policy` or `http_transport`.
+    """
+
+    def __init__(self, io_loop=None, logger=None, **client_options):
+        self._io_loop = io_loop or tornado.ioloop.IOLoop.current()
+        self._logger = logger or module_logger
+        self._own_transport = client_options.get('http_transport') is None
+        if self._own_transport:
+            client_options['http_transport'] = HTTPTransport()
+        self._client_options = client_options
+        # websocket URL -> SharedWebsocket
+        self._connections = {}
+
+    @property
+    def num_connections(self):
+        """Number of websocket connections in use."""
+        return len(self._connections)
+
+    def client(self, url, on_update_callback, **options):
+        """Create a client that shares this manager's websocket connections.
+
+        Parameters
+        ----------
+        url: str
+            Client sitemap URL, see :class:`.KATPortalClient`.
+        on_update_callback: function
+            Callback for the Pub/Sub messages of this client's subscriptions.
+        options:
+            Other keyword arguments for :class:`.KATPortalClient`, e.g.
+            `update_batch_interval_sec` or `track_sensor_values`.
+
+        Returns
+        -------
+        :class:`.SharedKATPortalClient`
+        """
+        options.setdefault('logger', self._logger)
+        options.setdefault('http_transport', self._client_options['http_transport'])
+        return SharedKATPortalClient(self, url, on_update_callback,
+                                     io_loop=self._io_loop, **options)
+
+    @tornado.gen.coroutine
+    def _acquire(self, websocket_url, consumer):
+        shared = self._connections.get(websocket_url)
+        if shared is None:
+            self._logger.debug("Creating shared websocket to %s", websocket_url)
+            shared = SharedWebsocket(KATPortalClient(
+                websocket_url, None, io_loop=self._io_loop, logger=self._logger,
+                **self._client_options))
+            self._connections[websocket_url] = shared
+        shared.consumers.add(consumer)
+        yield shared.client.connect()
+        raise tornado.gen.Return(shared)
+
+    @tornado.gen.coroutine
+    def _release(self, websocket_url, consumer):
+        shared = self._connections.get(websocket_url)
+        if shared is None:
+            return
+        yield shared.release(consumer)
+        if not shared.consumers and self._connections.get(websocket_url) is shared:
+            self._logger.debug("Closing shared websocket to %s", websocket_url)
+            del self._connections[websocket_url]
+            shared.client.disconnect()
+
+    def close(self):
+        """Disconnect all the shared websocket connections.
+
+        The HTTP transport is also closed, if the manager created it.
+        """
+        for shared in self._connections.itervalues():
+            shared.client.disconnect()
+        self._connections.clear()
+        if self._own_transport:
+            self._client_options['http_transport'].close()
+
+
+class SharedKATPortalClient(KATPortalClient):
+    """A :class:`.KATPortalClient` that uses a shared websocket connection.
+
+    Create these with :meth:`.KATPortalClientManager.client`.  Websocket
+    requests are sent over the manager's connection for the client's
+    katportal, and the messages for this client's subscriptions are
+    delivered to its own callbacks.
+    """
+
+    def __init__(self, manager, url, on_update_callback, **options):
+        super(SharedKATPortalClient, self).__init__(url, on_update_callback, **options)
+        self._manager = manager
+        self._shared = None
+
+    @property
+    def is_connected(self):
+        """Return True if the shared websocket connection is connected."""
+        return self._shared is not None and self._shared.client.is_connected
+
+    @tornado.gen.coroutine
+    def connect(self):
+        """Connect to the shared websocket connection for this client's katportal."""
+        sitemap = yield self.load_sitemap()
+        self._disconnect_issued = False
+        self._shared = yield self._manager._acquire(sitemap['websocket'], self)
+
+    @tornado.gen.coroutine
+    def disconnect(self):
+        """Stop using the shared websocket connection, and drop subscriptions.
+
+        The subscriptions no other client needs are unsubscribed, and the
+        connection is closed once no client uses it.  Failures are logged,
+        as the client is disconnected regardless.
+        """
+        self._disconnect_issued = True
+        if self._update_batcher is not None:
+            self._update_batcher.flush()
+        self._router = type(self._router)()
+        if self._shared is not None:
+            self._shared = None
+            try:
+                yield self._manager._release(self.sitemap['websocket'], self)
+            except Exception:
+                self._logger.exception("Error releasing shared websocket.")
+            else:
+                self._logger.debug("Released shared websocket.")
+
+    def _send(self, req, timeout_sec=None):
+        if self._shared is None:
+            return super(SharedKATPortalClient, self)._send(req, timeout_sec)
+        return self._shared.client._send(req, timeout_sec)
+
+    def _cache_jsonrpc_request(self, jsonrpc_request):
+        # The owner of the connection resends requests after reconnecting
+        if self._shared is not None:
+            self._shared.client._cache_jsonrpc_request(jsonrpc_request)
+
+    def _receive_shared_message(self, msg_result):
+        self._process_redis_message({'result': msg_result}, 'redis-pubsub')
+
+    @tornado.gen.coroutine
+    def subscribe(self, namespace, sub_strings=None, handler=None):
+        """Subscribe to the specified string identifiers in a namespace.
+
+        See :meth:`.KATPortalClient.subscribe`.  Subscriptions that another
+        client of the same connection already has are not sent to katportal
+        again, so the result is the number of string identifiers given.
+        """
+        yield self.connect()
+        result = yield self._shared.subscribe(
+            self, namespace, self._sub_string_list(sub_strings))
+        if handler is not None:
+            for pattern in self._subscription_patterns(namespace, sub_strings):
+                self._router.add(pattern, handler)
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def unsubscribe(self, namespace, unsub_strings=None):
+        """Unsubscribe from the specified string identifiers in a namespace.
+
+        See :meth:`.KATPortalClient.unsubscribe`.  katportal is only asked to
+        unsubscribe once no other client of the same connection is
+        subscribed, so the result is the number of string identifiers given.
+        """
+        result = 0
+        if self._shared is not None:
+            result = yield self._shared.unsubscribe(
+                self, namespace, self._sub_string_list(unsub_strings))
+        for pattern in self._subscription_patterns(namespace, unsub_strings):
+            self._router.remove(pattern)
+        raise tornado.gen.Return(result)
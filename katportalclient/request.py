@@ -9,8 +9,9 @@
 """Module defining the JSON-RPC request class used by websocket client."""
 
 import uuid
+from collections import OrderedDict
 
-import omnijson as json
+from codec import default_codec
 
 
 class JSONRPCRequest(object):
@@ -35,9 +36,16 @@ class JSONRPCRequest(object):
         self.method = method
         self.params = params
 
-    def __call__(self):
-        """Return object's attribute dictionary in JSON form."""
-        return json.dumps(self.__dict__)
+    def __call__(self, codec=default_codec):
+        """Return object's attribute dictionary in JSON form.
+
+        Parameters
+        ----------
+        codec: :class:`.JSONCodec`
+            Codec used to encode the request.  Default: the codec shared
+            by all clients.
+        """
+        return codec.dumps(self.__dict__)
 
     def __repr__(self):
         """Return a human readable string of the object"""
@@ -53,3 +61,78 @@ class JSONRPCRequest(object):
         # if params is a list or set or anything like that, this will raise a
         # TypeError
         return hash((self.method, str(self.params)))
+
+
+def _freeze(value):
+    """Return a hashable equivalent of JSON-RPC request parameters."""
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.iteritems()))
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
+
+
+class JSONRPCRequestCache(object):
+    """
+    Ordered collection of the requests to resend after a reconnect.
+
+    Requests are indexed by method and parameters, and sampling strategies
+    also by namespace and sensor (or filter), so that adding a request,
+    and dropping the requests it cancels, takes constant time.
+
+    - A request identical to one in the cache is not added again.
+    - An 'unsubscribe' request removes the matching 'subscribe' request,
+      and is not added.
+    - A sampling strategy replaces the strategy previously set for the same
+      namespace and sensor (or filter) by the same method.  A strategy of
+      'none' only removes the previous one.
+    """
+
+    def __init__(self):
+        # (method, frozen params) -> JSONRPCRequest, in the order added
+        self._requests = OrderedDict()
+        # (method, namespace, frozen sensor/filter) -> key in _requests
+        self._strategies = {}
+
+    def __len__(self):
+        return len(self._requests)
+
+    def __iter__(self):
+        return self._requests.itervalues()
+
+    def __getitem__(self, index):
+        return self._requests.values()[index]
+
+    @staticmethod
+    def _strategy_key(req):
+        # namespace is always at index 0 of params, sensor/filter at index 1
+        # and strategy at index 2
+        if (req.method.startswith('set_sampling_strat') and
+                isinstance(req.params, (list, tuple)) and len(req.params) > 2):
+            return (req.method, req.params[0], _freeze(req.params[1]))
+        return None
+
+    def add(self, req):
+        """Add a request to the cache, and drop the requests it cancels."""
+        if req.method == 'unsubscribe':
+            self._requests.pop(('subscribe', _freeze(req.params)), None)
+            return
+        key = (req.method, _freeze(req.params))
+        if key in self._requests:
+            return
+        strategy_key = self._strategy_key(req)
+        if strategy_key is not None:
+            previous_key = self._strategies.pop(strategy_key, None)
+            if previous_key is not None:
+                del self._requests[previous_key]
+            if req.params[2] == 'none':
+                return
+            self._strategies[strategy_key] = key
+        self._requests[key] = req
+
+    def clear(self):
+        """Remove all the requests from the cache."""
+        self._requests.clear()
+        self._strategies.clear()
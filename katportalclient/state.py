@@ -0,0 +1,140 @@
+###############################################################################
+# SKA South Africa (http://ska.ac.za/)                                        #
+# Author: cam@ska.ac.za                                                       #
+# Copyright @ 2013 SKA SA. All rights reserved.                               #
+#                                                                             #
+# THIS SOFTWARE MAY NOT BE COPIED OR DISTRIBUTED IN ANY FORM WITHOUT THE      #
+# WRITTEN PERMISSION OF SKA SA.                                               #
+###############################################################################
+"""Module defining the latest sensor values received via subscriptions."""
+
+from history import SensorSample
+
+
+class SensorValue(object):
+    """Latest value of a sensor, updated in place.
+
+    Attributes
+    ----------
+    name: str
+        Name of the sensor.
+    timestamp: float
+        The timestamp (UNIX epoch) the value was received by CAM.
+    value: object
+        The value of the sensor.
+    status: str
+        The KATCP status of the sensor, e.g. 'nominal'.
+    received_timestamp: float
+        The timestamp (UNIX epoch) the update was published by katportal.
+    """
+
+    __slots__ = ('name', 'timestamp', 'value', 'status', 'received_timestamp')
+
+    def __init__(self, name, timestamp, value, status, received_timestamp):
+        self.name = name
+        self.timestamp = timestamp
+        self.value = value
+        self.status = status
+        self.received_timestamp = received_timestamp
+
+    def __repr__(self):
+        return ("<SensorValue {} timestamp={} value={!r} status={}>"
+                .format(self.name, self.timestamp, self.value, self.status))
+
+    def sample(self):
+        """Return the value as a :class:`.SensorSample` namedtuple."""
+        return SensorSample(self.timestamp, self.value, self.status)
+
+
+class SensorValueTable(object):
+    """Latest value of each sensor, from Pub/Sub sensor updates.
+
+    Lookups by sensor name are dictionary lookups.  An update that is older
+    than the value already in the table is ignored, so that updates for the
+    same sensor from overlapping subscriptions cannot move it back in time.
+    """
+
+    def __init__(self):
+        self._values = {}
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, sensor_name):
+        return sensor_name in self._values
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __getitem__(self, sensor_name):
+        return self._values[sensor_name]
+
+    def get(self, sensor_name, default=None):
+        """Return the :class:`.SensorValue` for a sensor, or `default`."""
+        return self._values.get(sensor_name, default)
+
+    def update(self, msg_data):
+        """Update the table from the data of a sensor update message.
+
+        Parameters
+        ----------
+        msg_data: dict
+            The 'msg_data' of a Pub/Sub message, with 'name', 'timestamp',
+            'value', 'status' and 'received_timestamp' items.
+
+        Returns
+        -------
+        bool:
+            True if the table was updated, False if the message is not a
+            sensor update, or is older than the value in the table.
+        """
+        try:
+            name = msg_data['name']
+            timestamp = msg_data['timestamp']
+            value = msg_data['value']
+            status = msg_data['status']
+        except (KeyError, TypeError):
+            return False
+        received_timestamp = msg_data.get('received_timestamp')
+        sensor_value = self._values.get(name)
+        if sensor_value is None:
+            self._values[name] = SensorValue(
+                name, timestamp, value, status, received_timestamp)
+        elif timestamp >= sensor_value.timestamp:
+            sensor_value.timestamp = timestamp
+            sensor_value.value = value
+            sensor_value.status = status
+            sensor_value.received_timestamp = received_timestamp
+        else:
+            return False
+        return True
+
+    def snapshot(self, sensor_names=None):
+        """Return the current values of many sensors at once.
+
+        Parameters
+        ----------
+        sensor_names: iterable of str
+            Names of the sensors to include.  Sensors that have no value are
+            left out.  Default: None, all the sensors in the table.
+
+        Returns
+        -------
+        dict:
+            Sensor name -> :class:`.SensorSample` namedtuple.  Unlike the
+            :class:`.SensorValue` records, these are not changed by later
+            updates.
+        """
+        if sensor_names is None:
+            return {name: sensor_value.sample()
+                    for name, sensor_value in self._values.iteritems()}
+        snapshot = {}
+        for name in sensor_names:
+            sensor_value = self._values.get(name)
+            if sensor_value is not None:
+                snapshot[name] = sensor_value.sample()
+        return snapshot
+
+    def clear(self):
+        """Remove all the values from the table."""
+        self._values.clear()
@@ -0,0 +1,179 @@
+###############################################################################
+# SKA South Africa (http://ska.ac.za/)                                        #
+# Author: cam@ska.ac.za                                                       #
+# Copyright @ 2013 SKA SA. All rights reserved.                               #
+#                                                                             #
+# THIS SOFTWARE MAY NOT BE COPIED OR DISTRIBUTED IN ANY FORM WITHOUT THE      #
+# WRITTEN PERMISSION OF SKA SA.                                               #
+###############################################################################
+"""Tests for katportalclient local caches."""
+
+
+import os
+import shutil
+import tempfile
+import time
+from array import array
+
+import unittest2 as unittest
+
+from katportalclient.cache import (
+    SensorHistoryCache, SensorMetadataCache, SitemapCache, normalise_sensor_name)
+from katportalclient.history import SampleColumns, SensorSampleValueTs
+
+
+def make_samples(timestamps):
+    return SampleColumns(
+        array('d', timestamps), array('d', [t - 0.5 for t in timestamps]),
+        [str(t) for t in timestamps], ['nominal'] * len(timestamps))
+
+
+def sample_list(timestamps):
+    return [SensorSampleValueTs(t, t - 0.5, str(t), 'nominal')
+            for t in timestamps]
+
+
+class TestSensorHistoryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.cache = SensorHistoryCache(self.cache_dir)
+        self.entry = self.cache.load('sensor')
+
+    def test_gaps(self):
+        entry = self.entry
+        self.assertEqual(self.cache.gaps(entry, 10, 20), [(10, 20)])
+        self.cache.update(entry, 12, 14, make_samples([12, 13, 14]))
+        self.cache.update(entry, 16, 17, make_samples([16]))
+        self.assertEqual(self.cache.gaps(entry, 10, 20),
+                         [(10, 12), (14, 16), (17, 20)])
+        self.assertEqual(self.cache.gaps(entry, 12.5, 13.5), [])
+        self.assertEqual(self.cache.gaps(entry, 13, 13), [])
+        self.assertEqual(self.cache.gaps(entry, 15, 15), [(15, 15)])
+        # adjacent intervals are merged
+        self.cache.update(entry, 14, 16, make_samples([14, 15, 16]))
+        self.assertEqual(self.cache.gaps(entry, 10, 20), [(10, 12), (17, 20)])
+        self.assertEqual(self.cache.samples(entry, 0, 100).samples(True),
+                         sample_list([12, 13, 14, 15, 16]))
+
+    def test_samples_persisted_without_duplicates(self):
+        self.cache.update(self.entry, 12, 14, make_samples([12, 13, 14]))
+        not_stored = self.cache.update(
+            self.entry, 10, 12, make_samples([10, 11, 12]))
+        self.assertEqual(len(not_stored), 0)
+        self.cache.save(self.entry)
+        other_cache = SensorHistoryCache(self.cache_dir)
+        entry = other_cache.load('sensor')
+        self.assertEqual(other_cache.samples(entry, 0, 100).samples(True),
+                         sample_list([10, 11, 12, 13, 14]))
+        self.assertEqual(other_cache.samples(entry, 11, 13).samples(True),
+                         sample_list([11, 12, 13]))
+        self.assertEqual(os.listdir(self.cache_dir), ['sensor.history'])
+
+    def test_files_named_after_normalised_name(self):
+        self.cache.save(self.cache.load('anc.weather.Wind-speed'))
+        self.cache.save(self.cache.load('../escape/sensor'))
+        self.assertEqual(sorted(os.listdir(self.cache_dir)),
+                         ['__%2Fescape%2Fsensor.history',
+                          'anc_weather_wind_speed.history'])
+        self.assertEqual(self.cache.load('anc_weather_wind_speed')['intervals'], [])
+
+    def test_recent_and_incomplete_samples_not_stored(self):
+        now = time.time()
+        not_stored = self.cache.update(
+            self.entry, now - 1000, now, make_samples([now - 900, now - 10]))
+        self.assertEqual(not_stored.samples(True), sample_list([now - 10]))
+        self.assertEqual(len(self.cache.gaps(self.entry, now - 1000, now)), 1)
+        not_stored = self.cache.update(
+            self.entry, 10, 20, make_samples([11]), complete=False)
+        self.assertEqual(not_stored.samples(True), sample_list([11]))
+        self.assertEqual(self.cache.gaps(self.entry, 10, 20), [(10, 20)])
+
+    def test_corrupt_file_ignored(self):
+        with open(os.path.join(self.cache_dir, 'sensor.history'), 'wb') as f:
+            f.write('not a pickle')
+        entry = self.cache.load('sensor')
+        self.assertEqual(self.cache.gaps(entry, 10, 20), [(10, 20)])
+
+
+class TestSitemapCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.cache = SitemapCache(self.cache_dir, ttl_sec=60)
+        self.url = 'http://portal/api/client/1'
+
+    def test_put_and_get(self):
+        self.assertIsNone(self.cache.get(self.url))
+        self.cache.put(self.url, {'sub_nr': '1'}, etag='"abc"')
+        entry = SitemapCache(self.cache_dir).get(self.url)
+        self.assertEqual(entry['sitemap'], {'sub_nr': '1'})
+        self.assertEqual(entry['etag'], '"abc"')
+        self.assertIsNone(entry['last_modified'])
+        self.assertTrue(self.cache.is_fresh(entry))
+        self.assertIsNone(self.cache.get('http://portal/api/client/2'))
+
+    def test_stale_entry_touched(self):
+        self.cache.put(self.url, {'sub_nr': '1'})
+        entry = self.cache.get(self.url)
+        entry['fetched'] -= 120
+        self.assertFalse(self.cache.is_fresh(entry))
+        self.cache.touch(self.url)
+        self.assertTrue(self.cache.is_fresh(self.cache.get(self.url)))
+
+    def test_invalidate(self):
+        self.cache.put(self.url, {'sub_nr': '1'})
+        self.cache.invalidate(self.url)
+        self.cache.invalidate(self.url)
+        self.assertIsNone(self.cache.get(self.url))
+
+
+class TestSensorMetadataCache(unittest.TestCase):
+
+    def test_normalise_sensor_name(self):
+        self.assertEqual(normalise_sensor_name('anc.weather.Wind-speed'),
+                         'anc_weather_wind_speed')
+
+    def test_get_and_names(self):
+        cache = SensorMetadataCache()
+        cache.put([{'name': 'anc_a'}, {'name': 'anc_b'}], 'anc_.*')
+        self.assertEqual(cache.get('anc.a'), {'name': 'anc_a'})
+        self.assertIsNone(cache.get('anc_c'))
+        self.assertEqual(cache.names('anc_.*'), ['anc_a', 'anc_b'])
+        self.assertIsNone(cache.names('anc_a'))
+        self.assertFalse(cache.complete)
+        # copies are returned
+        cache.get('anc_a')['name'] = 'changed'
+        self.assertEqual(cache.get('anc_a'), {'name': 'anc_a'})
+
+    def test_expiry(self):
+        cache = SensorMetadataCache(ttl_sec=0)
+        cache.put_all([{'name': 'anc_a'}])
+        self.assertFalse(cache.complete)
+        self.assertIsNone(cache.get('anc_a'))
+
+    def test_lru_eviction(self):
+        cache = SensorMetadataCache(max_size=2)
+        cache.put_all([{'name': 'a'}, {'name': 'b'}])
+        self.assertTrue(cache.complete)
+        cache.get('a')
+        cache.put([{'name': 'c'}])
+        self.assertFalse(cache.complete)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(len(cache), 2)
+
+    def test_persisted(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        filename = os.path.join(cache_dir, 'sensors.metadata')
+        SensorMetadataCache(filename=filename).put_all([{'name': 'a'}])
+        cache = SensorMetadataCache(filename=filename)
+        self.assertTrue(cache.complete)
+        self.assertEqual(cache.get('a'), {'name': 'a'})
+        cache.put([{'name': 'b'}], save=False)
+        self.assertIsNone(SensorMetadataCache(filename=filename).get('b'))
+        cache.save()
+        self.assertEqual(SensorMetadataCache(filename=filename).get('b'),
+                         {'name': 'b'})
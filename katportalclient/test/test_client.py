@@ -10,8 +10,14 @@
 
 
 import logging
+import os
+import re
+import shutil
 import StringIO
+import tempfile
 import time
+import urllib
+from datetime import timedelta
 from functools import partial
 
 import mock
@@ -19,14 +25,16 @@ import omnijson as json
 from tornado import gen
 from tornado import concurrent
 from tornado.web import Application
-from tornado.httpclient import HTTPResponse, HTTPRequest
+from tornado.httpclient import HTTPError, HTTPResponse, HTTPRequest
 from tornado.testing import gen_test
 from tornado.test.websocket_test import (
     WebSocketBaseTestCase, TestWebSocketHandler)
 
 from katportalclient import (
     KATPortalClient, JSONRPCRequest, ScheduleBlockNotFoundError, SensorNotFoundError,
-    SensorHistoryRequestError, ScheduleBlockTargetsParsingError, create_jwt_login_token)
+    SensorHistoryRequestError, ScheduleBlockTargetsParsingError,
+    RequestTimeoutError, ConnectionClosedError, ReconnectPolicy, create_jwt_login_token,
+    KATPortalClientManager, HTTPTransport, SensorIndex, SensorMetadataCache)
 
 
 LOGGER_NAME = 'test_portalclient'
@@ -157,6 +165,8 @@ class TestWebSocket(TestWebSocketHandler):
             reply['result'] = x + y
         elif message['method'] in ('subscribe', 'unsubscribe'):
             reply['result'] = len(message['params'][1])
+        elif message['params'][1:2] == ['invalid_sensor']:
+            reply['error'] = {'code': -32000, 'message': 'Unknown sensor'}
         elif message['method'] in ('set_sampling_strategy',
                                    'set_sampling_strategies'):
             reply['result'] = {}
@@ -212,6 +222,13 @@ class TestKATPortalClient(WebSocketBaseTestCase):
         self.addCleanup(http_async_client_patcher.stop)
         self.mock_http_async_client = http_async_client_patcher.start()
 
+        def mock_async_fetch(url):
+            future = concurrent.Future()
+            future.set_result(mock_fetch(url))
+            return future
+
+        self.mock_http_async_client().fetch.side_effect = mock_async_fetch
+
         def on_update_callback(msg, self):
             self.logger.info("Client got update message: '{}'".format(msg))
             self.on_update_callback_call_count += 1
@@ -284,6 +301,50 @@ class TestKATPortalClient(WebSocketBaseTestCase):
         yield self._portal_client._websocket_message(None)
         self._portal_client._io_loop.call_later.assert_called_once()
 
+    @gen_test
+    def test_reconnect_backoff_and_events(self):
+        events = []
+        test_client = KATPortalClient(
+            self.websocket_url, None,
+            reconnect_policy=ReconnectPolicy(initial_delay_sec=2, jitter=0),
+            connection_event_callback=lambda event, details: events.append(event))
+        yield test_client.connect()
+        test_client._resend_subscriptions_and_strategies = mock.MagicMock(
+            side_effect=Exception('resend failed'))
+        test_client._io_loop.call_later = mock.MagicMock()
+        yield test_client._websocket_message(None)
+        yield gen.moment
+        self.assertEqual(events, ['connected', 'disconnected', 'connected',
+                                  'connect_failed'])
+        self.assertEqual(test_client._io_loop.call_later.call_args[0][0], 2)
+        test_client._io_loop.remove_timeout = mock.MagicMock()
+        test_client.disconnect()
+        test_client._io_loop.remove_timeout.assert_called_once()
+
+    @gen_test
+    def test_heart_beat_latency(self):
+        test_client = KATPortalClient(self.websocket_url, None,
+                                      heart_beat_interval_sec=0.01)
+        yield test_client.connect()
+        yield gen.sleep(0.1)
+        latency = test_client.heart_beat_latency
+        self.assertGreater(latency['count'], 0)
+        self.assertEqual(latency['missed'], 0)
+        test_client.disconnect()
+
+    @gen_test
+    def test_heart_beat_dead_connection(self):
+        yield self._portal_client.connect()
+        # drop the pings, as on a half open connection
+        self._portal_client._ws.protocol.write_ping = mock.MagicMock()
+        self._portal_client._websocket_message = mock.MagicMock(
+            return_value=gen.maybe_future(None))
+        for _ in range(3):
+            yield self._portal_client._send_heart_beat()
+        self._portal_client._websocket_message.assert_not_called()
+        yield self._portal_client._send_heart_beat()
+        self._portal_client._websocket_message.assert_called_once_with(None)
+
     @gen_test
     def test_server_redis_reconnect_message(self):
         self.assertIsNotNone(self._portal_client)
@@ -339,6 +400,40 @@ class TestKATPortalClient(WebSocketBaseTestCase):
         yield self._portal_client._resend_subscriptions_and_strategies()
         self.assertEquals(self._portal_client._send.call_count, 6)
 
+    @gen_test
+    def test_resend_survives_failed_requests(self):
+        yield self._portal_client.connect()
+        failed_future = gen.Future()
+        failed_future.set_exception(RequestTimeoutError('No reply'))
+        sent_future = gen.Future()
+        sent_future.set_result(1)
+        self._portal_client._send = mock.MagicMock(
+            side_effect=[sent_future, failed_future, sent_future])
+        num_failed = yield self._portal_client._resend_requests([
+            JSONRPCRequest('subscribe', ['ants', [name]])
+            for name in ['m062*', 'm063*', 'm064*']])
+        self.assertEqual(num_failed, 1)
+        self.assertEqual(self._portal_client._send.call_count, 3)
+
+    @gen_test
+    def test_resend_consolidates_strategies(self):
+        yield self._portal_client.connect()
+        self._portal_client._send = mock.MagicMock(side_effect=self._portal_client._send)
+        for req in [
+                JSONRPCRequest('subscribe', ['ants', ['m063*']]),
+                JSONRPCRequest('set_sampling_strategy', ['ants', 'mode', 'period 1', False]),
+                JSONRPCRequest('set_sampling_strategy', ['ants', 'mode', 'event', False]),
+                JSONRPCRequest('set_sampling_strategy', ['ants', 'sensors_ok', 'event', False])]:
+            self._portal_client._cache_jsonrpc_request(req)
+        with mock.patch('katportalclient.client.RESEND_MAX_CONCURRENT', 2):
+            yield self._portal_client._resend_subscriptions_and_strategies()
+        resent = [req.params for (req,), _ in self._portal_client._send.call_args_list]
+        self.assertEqual(resent, [['ants', ['m063*']],
+                                  ['ants', 'mode', 'event', False],
+                                  ['ants', 'sensors_ok', 'event', False]])
+        self.assertEqual(len(self._portal_client._ws_jsonrpc_cache), 3)
+        self.assertEqual(self._portal_client.num_pending_requests, 0)
+
     @gen_test
     def test_disconnect(self):
         self.assertIsNotNone(self._portal_client)
@@ -347,7 +442,7 @@ class TestKATPortalClient(WebSocketBaseTestCase):
         self._portal_client.disconnect()
         self.assertFalse(self._portal_client.is_connected)
         self.assertFalse(self._portal_client._heart_beat_timer.is_running())
-        self.assertEquals(self._portal_client._ws_jsonrpc_cache, [])
+        self.assertEquals(len(self._portal_client._ws_jsonrpc_cache), 0)
         self.assertTrue(self._portal_client._disconnect_issued)
 
     @gen_test
@@ -361,6 +456,25 @@ class TestKATPortalClient(WebSocketBaseTestCase):
         with self.assertRaises(Exception):
             yield self._portal_client.add(8, 67)
 
+    def test_cache_jsonrpc_request_replaces_strategy(self):
+        cache = self._portal_client._ws_jsonrpc_cache
+        for sensor in range(1000):
+            self._portal_client._cache_jsonrpc_request(JSONRPCRequest(
+                'subscribe', ['namespace', ['sensor_{}'.format(sensor)]]))
+        self.assertEqual(len(cache), 1000)
+        req1 = JSONRPCRequest('set_sampling_strategies',
+                              ['namespace', ['filter1', 'filter2'], 'period 1'])
+        req2 = JSONRPCRequest('set_sampling_strategies',
+                              ['namespace', ['filter1', 'filter2'], 'event'])
+        self._portal_client._cache_jsonrpc_request(req1)
+        self._portal_client._cache_jsonrpc_request(req2)
+        self.assertEqual(len(cache), 1001)
+        self.assertEqual(cache[-1].id, req2.id)
+        self._portal_client._cache_jsonrpc_request(JSONRPCRequest(
+            'unsubscribe', ['namespace', ['sensor_500']]))
+        self.assertEqual(len(cache), 1000)
+        self.assertNotIn(['namespace', ['sensor_500']], [req.params for req in cache])
+
     @gen_test
     def test_cache_jsonrpc_request(self):
         req1 = JSONRPCRequest('test1', 'test_params1')
@@ -436,6 +550,143 @@ class TestKATPortalClient(WebSocketBaseTestCase):
         self.assertEqual(result, 2)
         self._portal_client._cache_jsonrpc_request.assert_called_once()
 
+    @gen_test
+    def test_subscribe_with_handler(self):
+        yield self._portal_client.connect()
+        jupiter_messages = []
+        moon_messages = []
+        yield self._portal_client.subscribe(
+            'planets', 'jupiter', handler=jupiter_messages.append)
+        yield self._portal_client.subscribe(
+            'planets', 'm*', handler=moon_messages.append)
+
+        def publish(channel, pattern=None):
+            msg_result = {'msg_channel': channel, 'msg_data': {}}
+            if pattern:
+                msg_result['msg_pattern'] = pattern
+            self._portal_client._process_redis_message(
+                {'result': msg_result}, 'redis-pubsub')
+
+        publish('planets:jupiter')
+        publish('planets:mars', 'planets:m*')
+        publish('planets:mars', 'planets:*')
+        publish('planets:mercury')
+        publish('planets:saturn')
+        yield gen.moment
+        self.assertEqual([msg['msg_channel'] for msg in jupiter_messages],
+                         ['planets:jupiter'])
+        self.assertEqual([msg['msg_channel'] for msg in moon_messages],
+                         ['planets:mars', 'planets:mercury'])
+        # unrouted messages still go to the on_update_callback
+        yield gen.moment
+        self.assertEqual(self.on_update_callback_call_count, 2)
+
+        yield self._portal_client.unsubscribe('planets', 'm*')
+        publish('planets:mars', 'planets:m*')
+        yield gen.moment
+        self.assertEqual(len(moon_messages), 2)
+
+    @gen_test
+    def test_subscribe_general_namespace_with_handler(self):
+        yield self._portal_client.connect()
+        moon_messages = []
+        yield self._portal_client.subscribe(
+            '', 'm063*', handler=moon_messages.append)
+        # katportal names the general namespace in the messages it sends
+        self._portal_client._process_redis_message(
+            {'result': {'msg_channel': 'planets:m063_ap_mode',
+                        'msg_pattern': 'planets:m063*',
+                        'msg_data': {}}},
+            'redis-pubsub')
+        yield gen.moment
+        self.assertEqual([msg['msg_channel'] for msg in moon_messages],
+                         ['planets:m063_ap_mode'])
+        self.assertEqual(self.on_update_callback_call_count, 0)
+
+    @gen_test
+    def test_manager_shares_websocket(self):
+        manager = KATPortalClientManager(
+            http_transport=HTTPTransport(use_curl=False))
+        messages = {'first': [], 'second': []}
+        first = manager.client(self.websocket_url, messages['first'].append)
+        second = manager.client(self.websocket_url, messages['second'].append)
+        yield first.subscribe('planets', ['jupiter', 'm*'])
+        yield second.subscribe('planets', 'jupiter')
+        self.assertEqual(manager.num_connections, 1)
+        self.assertTrue(first.is_connected and second.is_connected)
+        hub = first._shared.client
+        hub.subscribe = mock.MagicMock(wraps=hub.subscribe)
+        hub.unsubscribe = mock.MagicMock(wraps=hub.unsubscribe)
+
+        def publish(channel, pattern=None):
+            msg_result = {'msg_channel': channel, 'msg_data': {}}
+            if pattern:
+                msg_result['msg_pattern'] = pattern
+            hub._process_redis_message({'result': msg_result}, 'redis-pubsub')
+
+        publish('planets:jupiter')
+        publish('planets:mars', 'planets:m*')
+        yield gen.sleep(0.01)
+        self.assertEqual(len(messages['first']), 2)
+        self.assertEqual(len(messages['second']), 1)
+
+        # the other client still needs the subscription to 'jupiter'
+        result = yield first.unsubscribe('planets', 'jupiter')
+        self.assertEqual(result, 1)
+        hub.unsubscribe.assert_not_called()
+        # only the last subscriber's unsubscribe reaches katportal, and the
+        # subscription is no longer resent after a reconnect
+        yield first.unsubscribe('planets', 'm*')
+        hub.unsubscribe.assert_called_once_with('planets', ['m*'])
+        self.assertEqual([req.params for req in hub._ws_jsonrpc_cache],
+                         [['planets', ['jupiter']]])
+        publish('planets:jupiter')
+        yield gen.sleep(0.01)
+        self.assertEqual(len(messages['first']), 2)
+        self.assertEqual(len(messages['second']), 2)
+
+        yield second.disconnect()
+        hub.unsubscribe.assert_called_with('planets', ['jupiter'])
+        self.assertEqual(hub.unsubscribe.call_count, 2)
+        self.assertEqual(manager.num_connections, 1)
+        yield first.disconnect()
+        self.assertEqual(manager.num_connections, 0)
+        self.assertFalse(hub.is_connected)
+
+    @gen_test
+    def test_manager_routes_general_namespace(self):
+        manager = KATPortalClientManager(
+            http_transport=HTTPTransport(use_curl=False))
+        messages = []
+        client = manager.client(self.websocket_url, messages.append)
+        yield client.subscribe('', 'm063*')
+        hub = client._shared.client
+        # katportal names the general namespace in the messages it sends
+        hub._process_redis_message(
+            {'result': {'msg_channel': 'planets:m063_ap_mode',
+                        'msg_pattern': 'planets:m063*',
+                        'msg_data': {}}},
+            'redis-pubsub')
+        yield gen.sleep(0.01)
+        self.assertEqual([msg['msg_channel'] for msg in messages],
+                         ['planets:m063_ap_mode'])
+
+    @gen_test
+    def test_manager_disconnect_logs_release_failure(self):
+        manager = KATPortalClientManager(
+            http_transport=HTTPTransport(use_curl=False))
+        client = manager.client(self.websocket_url, None)
+        yield client.connect()
+        client._logger = mock.MagicMock()
+        release = gen.Future()
+        release.set_exception(RuntimeError('release failed'))
+        with mock.patch.object(manager, '_release', return_value=release):
+            yield client.disconnect()
+        self.assertFalse(client.is_connected)
+        client._logger.exception.assert_called_once_with(
+            "Error releasing shared websocket.")
+        manager.close()
+
     @gen_test
     def test_unsubscribe(self):
         self._portal_client._cache_jsonrpc_request = mock.MagicMock()
@@ -465,6 +716,82 @@ class TestKATPortalClient(WebSocketBaseTestCase):
         self.assertTrue('mode' in result.keys())
         self._portal_client._cache_jsonrpc_request.assert_called_once()
 
+    @gen_test
+    def test_send_batch(self):
+        yield self._portal_client.connect()
+        results = yield self._portal_client.send_batch(
+            [JSONRPCRequest('add', [1, 2]),
+             JSONRPCRequest('subscribe', ['planets', ['jupiter', 'm*']])])
+        self.assertEqual(results, [3, 2])
+        self.assertEqual([req.method for req in self._portal_client._ws_jsonrpc_cache],
+                         ['subscribe'])
+
+    @gen_test
+    def test_send_batch_with_timeout(self):
+        yield self._portal_client.connect()
+        write_message = self._portal_client._ws.write_message
+
+        def drop_add(message):
+            # no reply arrives for the 'add' request
+            if '"add"' not in message:
+                write_message(message)
+
+        self._portal_client._ws.write_message = drop_add
+        requests = [JSONRPCRequest('subscribe', ['planets', ['jupiter']]),
+                    JSONRPCRequest('add', [1, 2]),
+                    JSONRPCRequest('subscribe', ['planets', ['m*']])]
+        with self.assertRaises(RequestTimeoutError):
+            yield self._portal_client.send_batch(requests, timeout_sec=0.1)
+        # the subscriptions that succeeded are still resent on reconnect
+        self.assertEqual([req.params for req in self._portal_client._ws_jsonrpc_cache],
+                         [['planets', ['jupiter']], ['planets', ['m*']]])
+
+        results = yield self._portal_client.send_batch(
+            requests, timeout_sec=0.1, return_exceptions=True)
+        self.assertEqual(results[0], 1)
+        self.assertIsInstance(results[1], RequestTimeoutError)
+        self.assertEqual(results[2], 1)
+
+    @gen_test
+    def test_pending_requests_removed(self):
+        yield self._portal_client.connect()
+        result = yield self._portal_client.add(1, 2)
+        self.assertEqual(result, 3)
+        self.assertEqual(self._portal_client.num_pending_requests, 0)
+
+    @gen_test
+    def test_pending_request_timeout(self):
+        yield self._portal_client.connect()
+        # drop the request, so that no reply arrives
+        self._portal_client._ws.write_message = mock.MagicMock()
+        with self.assertRaises(RequestTimeoutError):
+            yield self._portal_client.send_batch(
+                [JSONRPCRequest('add', [1, 2])], timeout_sec=0.01)
+        self.assertEqual(self._portal_client.num_pending_requests, 0)
+
+    @gen_test
+    def test_pending_requests_failed_on_disconnect(self):
+        yield self._portal_client.connect()
+        self._portal_client._ws.write_message = mock.MagicMock()
+        future = self._portal_client.add(1, 2)
+        self.assertEqual(self._portal_client.num_pending_requests, 1)
+        self._portal_client.disconnect()
+        with self.assertRaises(ConnectionClosedError):
+            yield future
+        self.assertEqual(self._portal_client.num_pending_requests, 0)
+
+    @gen_test
+    def test_set_sampling_strategy_batch(self):
+        yield self._portal_client.connect()
+        result = yield self._portal_client.set_sampling_strategy_batch(
+            'ants', {'mode': 'period 1', 'sensors_ok': 'event',
+                     'invalid_sensor': 'event'})
+        self.assertEqual(result, {
+            'mode': {'success': True, 'info': 'period 1'},
+            'sensors_ok': {'success': True, 'info': 'event'},
+            'invalid_sensor': {'code': -32000, 'message': 'Unknown sensor'}})
+        self.assertEqual(len(self._portal_client._ws_jsonrpc_cache), 3)
+
     @gen_test
     def test_on_update_callback(self):
         yield self._portal_client.connect()
@@ -474,6 +801,36 @@ class TestKATPortalClient(WebSocketBaseTestCase):
         yield gen.sleep(0.2)  # Give pubsub message chance to be received
         self.assertEqual(self.on_update_callback_call_count, 1)
 
+    @gen_test
+    def test_on_update_callback_batched(self):
+        batches = []
+        test_client = KATPortalClient(self.websocket_url, batches.append,
+                                      update_batch_interval_sec=0.1,
+                                      update_batch_size=2)
+        for value in range(5):
+            test_client._process_redis_message(
+                {'result': {'value': value}}, 'redis-pubsub')
+        self.assertEqual(batches, [])
+        yield gen.sleep(0.01)
+        self.assertEqual(batches, [[{'value': 0}, {'value': 1}],
+                                   [{'value': 2}, {'value': 3}]])
+        yield gen.sleep(0.2)
+        self.assertEqual(batches[2:], [[{'value': 4}]])
+
+    def test_sensor_values_tracked(self):
+        test_client = KATPortalClient(self.websocket_url, None,
+                                      track_sensor_values=True)
+        msg_data = {'name': 'anc_mean_wind_speed', 'timestamp': 1486050057.07,
+                    'value': 4.9882065556, 'status': 'nominal',
+                    'received_timestamp': 1486050057.13}
+        test_client._process_redis_message(
+            {'result': {'msg_pattern': 'namespace:*',
+                        'msg_channel': 'namespace:anc_mean_wind_speed',
+                        'msg_data': msg_data}}, 'redis-pubsub')
+        self.assertEqual(test_client.sensor_values['anc_mean_wind_speed'].value,
+                         4.9882065556)
+        self.assertIsNone(self._portal_client.sensor_values)
+
     @gen_test
     def test_init_with_websocket_url(self):
         """Test backwards compatibility initialising directly with a websocket URL."""
@@ -481,6 +838,73 @@ class TestKATPortalClient(WebSocketBaseTestCase):
         yield test_client.connect()
         self.assertTrue(test_client.is_connected)
 
+    @gen_test
+    def test_load_sitemap(self):
+        mock_fetch = self.mock_http_async_client().fetch
+        sitemap_fetch = mock_fetch.side_effect
+        pending = []
+
+        def slow_fetch(url):
+            pending.append((url, concurrent.Future()))
+            return pending[-1][1]
+
+        mock_fetch.side_effect = slow_fetch
+        with self.assertRaises(gen.TimeoutError):
+            yield self._portal_client.load_sitemap(timeout_sec=0.01)
+        # the request carries on, and concurrent loads wait for it
+        first = self._portal_client.load_sitemap()
+        second = self._portal_client.load_sitemap()
+        self.assertEqual(len(pending), 1)
+        url, future = pending[0]
+        future.set_result(sitemap_fetch(url).result())
+        sitemap = yield first
+        self.assertEqual(sitemap['sub_nr'], '3')
+        self.assertIs((yield second), sitemap)
+        self.assertIs(self._portal_client.sitemap, sitemap)
+        self.mock_http_sync_client().fetch.assert_not_called()
+
+        refreshed = self._portal_client.load_sitemap(refresh=True)
+        self.assertEqual(len(pending), 2)
+        pending[1][1].set_result(sitemap_fetch(url).result())
+        self.assertIsNot((yield refreshed), sitemap)
+
+    @gen_test
+    def test_sitemap_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        sitemap_url = 'http://dummy.for.sitemap/api/client/3'
+        mock_fetch = self.mock_http_async_client().fetch
+        sitemap_fetch = mock_fetch.side_effect
+        first = KATPortalClient(sitemap_url, None, sitemap_cache_dir=cache_dir)
+        sitemap = yield first.load_sitemap()
+        self.assertEqual(mock_fetch.call_count, 1)
+
+        # a new client starts with the cached sitemap, without a request
+        second = KATPortalClient(sitemap_url, None, sitemap_cache_dir=cache_dir)
+        self.assertEqual((yield second.load_sitemap()), sitemap)
+        self.assertEqual(mock_fetch.call_count, 1)
+        # ... unless it is stale, when it is revalidated in the background
+        stale = KATPortalClient(sitemap_url, None, sitemap_cache_dir=cache_dir,
+                                sitemap_cache_ttl_sec=0)
+        self.assertEqual((yield stale.load_sitemap()), sitemap)
+        yield gen.moment
+        self.assertEqual(mock_fetch.call_count, 2)
+
+        # an endpoint that is not found invalidates the cached sitemap
+        def fetch_not_found(url):
+            if url == sitemap_url:
+                return sitemap_fetch(url)
+            future = concurrent.Future()
+            future.set_exception(HTTPError(404))
+            return future
+
+        mock_fetch.side_effect = fetch_not_found
+        with self.assertRaises(HTTPError):
+            yield second.sensor_detail('anc_mean_wind_speed')
+        yield gen.moment
+        self.assertEqual(mock_fetch.call_count, 4)
+        self.assertFalse(second._sitemap_from_cache)
+
     @gen_test
     def test_sitemap_includes_expected_endpoints(self):
         sitemap = self._portal_client.sitemap
@@ -615,7 +1039,7 @@ class TestKATPortalClient(WebSocketBaseTestCase):
                                              sensor_json['anc_weather_device_status']),
             invalid_response='[]',
             starts_with=history_base_url,
-            contains=sensor_name_filter)
+            contains=urllib.quote(sensor_name_filter, safe=''))
 
         sensors = yield self._portal_client.sensor_names(sensor_name_filter)
 
@@ -659,6 +1083,79 @@ class TestKATPortalClient(WebSocketBaseTestCase):
 
         self.assertTrue(len(sensors) == 0, "Expect exactly 0 sensors")
 
+    @gen_test
+    def test_sensor_names_concurrent_and_merged(self):
+        in_flight = []
+        max_in_flight = [0]
+        urls = []
+
+        def fetch(url):
+            urls.append(url)
+            future = concurrent.Future()
+            in_flight.append(future)
+            max_in_flight[0] = max(max_in_flight[0], len(in_flight))
+
+            def reply():
+                in_flight.remove(future)
+                body = '[{}]'.format(sensor_json['anc_mean_wind_speed'])
+                future.set_result(HTTPResponse(
+                    HTTPRequest(url), 200, buffer=StringIO.StringIO(body)))
+
+            self.io_loop.call_later(0.01, reply)
+            return future
+
+        self._portal_client.sitemap
+        self.mock_http_async_client().fetch.side_effect = fetch
+        filters = ['anc_{}'.format(index) for index in range(10)]
+        sensors = yield self._portal_client.sensor_names(filters, max_concurrent=3)
+        self.assertEqual(sensors, ['anc_mean_wind_speed'])
+        self.assertEqual(len(urls), 10)
+        self.assertEqual(max_in_flight[0], 3)
+
+        del urls[:]
+        sensors = yield self._portal_client.sensor_names(
+            filters + [r'anc_\w+'], merge_filters=True)
+        self.assertEqual(sensors, ['anc_mean_wind_speed'])
+        self.assertEqual(len(urls), 2)
+        self.assertTrue(urls[0].endswith('sensors=anc_%5Cw%2B'))
+
+    @gen_test
+    def test_sensor_names_quotes_filters(self):
+        self.mock_http_async_client().fetch.side_effect = mock_async_fetcher(
+            valid_response='[]', invalid_response='[]',
+            starts_with=self._portal_client.sitemap['historic_sensor_values'])
+        sensor_name_filter = 'm063_rx+(x|y)&#'
+        for merge_filters in [False, True]:
+            sensors = yield self._portal_client.sensor_names(
+                sensor_name_filter, merge_filters=merge_filters)
+            self.assertEqual(sensors, [])
+            url = self.mock_http_async_client().fetch.call_args[0][0]
+            self.assertIn(urllib.quote(sensor_name_filter, safe=''), url)
+            self.assertNotIn('&', url)
+            self.assertNotIn('#', url)
+
+    @gen_test
+    def test_sensor_names_with_sensor_index(self):
+        history_base_url = self._portal_client.sitemap[
+            'historic_sensor_values']
+        self.mock_http_async_client().fetch.side_effect = mock_async_fetcher(
+            valid_response='[{}, {}]'.format(sensor_json['anc_mean_wind_speed'],
+                                             sensor_json['anc_gust_wind_speed']),
+            invalid_response='[]',
+            starts_with=history_base_url,
+            ends_with='?sensors=.*')
+        test_client = KATPortalClient(
+            'http://dummy.for.sitemap/api/client/3', None,
+            sensor_index=SensorIndex())
+        test_client._sitemap = self._portal_client.sitemap
+        sensors = yield test_client.sensor_names(['mean', '^anc_gust'])
+        self.assertEqual(sensors, ['anc_gust_wind_speed', 'anc_mean_wind_speed'])
+        sensors = yield test_client.sensor_names('speed$')
+        self.assertEqual(len(sensors), 2)
+        self.assertEqual(self.mock_http_async_client().fetch.call_count, 1)
+        with self.assertRaises(SensorNotFoundError):
+            yield test_client.sensor_names('*bad')
+
     @gen_test
     def test_sensor_names_exception_for_invalid_regex(self):
         """Test that invalid regex raises exception."""
@@ -699,6 +1196,8 @@ class TestKATPortalClient(WebSocketBaseTestCase):
         self.assertTrue(sensor_detail['component'] == "anc")
         self.assertTrue(sensor_detail['katcp_name']
                         == "anc.weather.wind-speed")
+        self.assertEqual(
+            self._portal_client.http_latency['sensor_detail']['count'], 2)
 
     @gen_test
     def test_sensor_detail_for_multiple_sensors_but_exact_match(self):
@@ -740,6 +1239,84 @@ class TestKATPortalClient(WebSocketBaseTestCase):
         with self.assertRaises(SensorNotFoundError):
             yield self._portal_client.sensor_detail(sensor_name_filter)
 
+    @gen_test
+    def test_sensor_detail_and_names_cached(self):
+        history_base_url = self._portal_client.sitemap[
+            'historic_sensor_values']
+        self.mock_http_async_client().fetch.side_effect = mock_async_fetcher(
+            valid_response='[{}, {}]'.format(sensor_json['anc_mean_wind_speed'],
+                                             sensor_json['anc_gust_wind_speed']),
+            invalid_response='[]',
+            starts_with=history_base_url)
+        mock_fetch = self.mock_http_async_client().fetch
+        mock_fetch.reset_mock()
+        test_client = KATPortalClient(
+            'http://dummy.for.sitemap/api/client/3', None,
+            sensor_metadata_cache=SensorMetadataCache())
+        test_client._sitemap = self._portal_client.sitemap
+
+        # a single request loads all the sensors
+        details = yield [test_client.sensor_detail('anc_mean_wind_speed'),
+                         test_client.sensor_detail('anc.gust-wind-speed')]
+        self.assertEqual([detail['name'] for detail in details],
+                         ['anc_mean_wind_speed', 'anc_gust_wind_speed'])
+        self.assertEqual(mock_fetch.call_count, 1)
+        self.assertTrue(mock_fetch.call_args[0][0].endswith('?sensors=.*'))
+        # the complete cache shows that other sensors do not exist
+        with self.assertRaises(SensorNotFoundError):
+            yield test_client.sensor_detail('anc_no_such_sensor')
+        self.assertEqual(mock_fetch.call_count, 1)
+
+        names = yield test_client.sensor_names(['anc_.*_wind_speed'])
+        names = yield test_client.sensor_names(['anc_.*_wind_speed'])
+        self.assertEqual(sorted(names),
+                         ['anc_gust_wind_speed', 'anc_mean_wind_speed'])
+        self.assertEqual(mock_fetch.call_count, 2)
+
+    @gen_test
+    def test_sensor_details(self):
+        history_base_url = self._portal_client.sitemap[
+            'historic_sensor_values']
+        self.mock_http_async_client().fetch.side_effect = mock_async_fetcher(
+            valid_response='[{}, {}]'.format(sensor_json['anc_mean_wind_speed'],
+                                             sensor_json['anc_gust_wind_speed']),
+            invalid_response='[]',
+            starts_with=history_base_url,
+            contains='%5E%28anc_gust_wind_speed%7Canc_mean_wind_speed%7C')
+        details = yield self._portal_client.sensor_details(
+            ['anc_mean_wind_speed', 'anc.gust-wind-speed', 'anc_no_such_sensor'])
+        self.assertEqual(details['anc_mean_wind_speed']['description'],
+                         'Mean wind speed')
+        self.assertEqual(details['anc.gust-wind-speed']['name'],
+                         'anc_gust_wind_speed')
+        self.assertIsNone(details['anc_no_such_sensor'])
+        self.assertEqual(self.mock_http_async_client().fetch.call_count, 1)
+
+    @gen_test
+    def test_sensor_details_escapes_names(self):
+        self.mock_http_async_client().fetch.side_effect = mock_async_fetcher(
+            valid_response='[]', invalid_response='[]',
+            starts_with=self._portal_client.sitemap['historic_sensor_values'])
+        details = yield self._portal_client.sensor_details(['m063_rx+(x)'])
+        self.assertEqual(details, {'m063_rx+(x)': None})
+        url = self.mock_http_async_client().fetch.call_args[0][0]
+        self.assertTrue(url.endswith(urllib.quote(r'^(m063_rx\+\(x\))$', safe='')))
+
+    def test_combined_sensor_queries(self):
+        names = ['sensor_{}'.format(index) for index in range(100)]
+        base_url = 'http://0.0.0.0/history/sensors?sensors='
+        queries = KATPortalClient._combined_sensor_queries(
+            base_url, names + names, max_url_length=200)
+        self.assertGreater(len(queries), 1)
+        self.assertTrue(all(len(query) <= 200 for _, query in queries))
+        patterns = [urllib.unquote(query[len(base_url):]) for _, query in queries]
+        self.assertEqual(patterns, [pattern for pattern, _ in queries])
+        self.assertTrue(all(re.match(r'\^\(.*\)\$$', pattern)
+                            for pattern in patterns))
+        matched = [name for name in names
+                   if any(re.match(pattern, name) for pattern in patterns)]
+        self.assertEqual(matched, names)
+
     @gen_test
     def test_sensor_history_single_sensor_with_value_ts(self):
         """Test that time ordered data with value_timestamp is received for a single sensor request."""
@@ -785,6 +1362,205 @@ class TestKATPortalClient(WebSocketBaseTestCase):
             # Ensure value_timestamp
             self.assertGreater(sample.timestamp, sample.value_timestamp)
 
+    @gen_test
+    def test_sensor_history_single_sensor_as_arrays(self):
+        """Test that time ordered columnar data is received for a single sensor request."""
+        history_base_url = self._portal_client.sitemap[
+            'historic_sensor_values']
+        sensor_name = 'anc_mean_wind_speed'
+        publish_messages = [sensor_history_pub_messages_json['init']]
+        publish_messages.extend(sensor_history_pub_messages_json[sensor_name])
+
+        self.mock_http_async_client().fetch.side_effect = mock_async_fetcher(
+            valid_response='{"result":"success"}',
+            invalid_response='error',
+            starts_with=history_base_url,
+            contains=sensor_name,
+            publish_raw_messages=publish_messages,
+            client_states=self._portal_client._sensor_history_states)
+
+        samples = yield self._portal_client.sensor_history(
+            sensor_name, start_time_sec=0, end_time_sec=time.time(),
+            include_value_ts=True, as_arrays=True)
+        # expect exactly 4 samples
+        self.assertEqual(len(samples), 4)
+        # ensure time order is increasing
+        self.assertTrue((samples.timestamp[1:] > samples.timestamp[:-1]).all())
+        self.assertTrue((samples.timestamp > samples.value_timestamp).all())
+        self.assertEqual(samples.value.dtype.kind, 'f')
+        self.assertAlmostEqual(samples.value[1], 5.07574851017)
+        self.assertEqual(list(samples.status), ['nominal'] * 4)
+
+    @gen_test
+    def test_sensor_history_stream(self):
+        """Test that blocks of samples are streamed to the callback for a single sensor request."""
+        history_base_url = self._portal_client.sitemap[
+            'historic_sensor_values']
+        sensor_name = 'anc_mean_wind_speed'
+        publish_messages = [sensor_history_pub_messages_json['init']]
+        publish_messages.extend(sensor_history_pub_messages_json[sensor_name])
+
+        self.mock_http_async_client().fetch.side_effect = mock_async_fetcher(
+            valid_response='{"result":"success"}',
+            invalid_response='error',
+            starts_with=history_base_url,
+            contains=sensor_name,
+            publish_raw_messages=publish_messages,
+            client_states=self._portal_client._sensor_history_states)
+
+        chunks = []
+
+        @gen.coroutine
+        def on_chunk(samples):
+            yield gen.moment
+            chunks.append(samples)
+
+        num_samples = yield self._portal_client.sensor_history_stream(
+            sensor_name, start_time_sec=0, end_time_sec=time.time(),
+            chunk_callback=on_chunk)
+        self.assertEqual(num_samples, 4)
+        # one callback per published data message, in order of arrival
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1, 1])
+        self.assertEqual(chunks[1][0].value, "5.0883800412")
+        self.assertEqual(self._portal_client._sensor_history_states, {})
+
+    @gen_test
+    def test_sensor_history_stream_callback_error(self):
+        """Test that the download stops as soon as the chunk callback fails."""
+        downloads = []
+
+        @gen.coroutine
+        def fake_download(sensor_name, start_time_sec, end_time_sec, samples,
+                          timeout_sec, done_event):
+            samples.add_samples([[1000, 1000, 1000000, '1', sensor_name, 'nominal']])
+            yield done_event.wait(timeout=timedelta(seconds=timeout_sec))
+            downloads.append(done_event.is_set())
+
+        def on_chunk(samples):
+            raise ValueError('Disk full')
+
+        self._portal_client._download_sensor_history = fake_download
+        with self.assertRaises(ValueError):
+            yield self._portal_client.sensor_history_stream(
+                'anc_mean_wind_speed', 0, 10, chunk_callback=on_chunk,
+                timeout_sec=3)
+        self.assertEqual(downloads, [True])
+
+    @gen_test
+    def test_sensor_history_split_windows(self):
+        """Test that a query over the sample limit is split into complete windows."""
+        # one sample every second, for 20 seconds
+        archive = [[t * 1000, t * 1000, t * 1000000, str(t), 'anc_mean_wind_speed',
+                    'nominal'] for t in range(1000, 1020)]
+        windows = []
+
+        def fake_download(sensor_name, start_time_sec, end_time_sec, samples,
+                          timeout_sec):
+            windows.append((start_time_sec, end_time_sec))
+            # katportal includes both ends of the window, and truncates
+            raw_samples = [sample for sample in archive
+                           if start_time_sec * 1000 <= sample[0] <= end_time_sec * 1000]
+            samples.add_samples(raw_samples[:5])
+            future = gen.Future()
+            future.set_result(None)
+            return future
+
+        self._portal_client._download_sensor_history = fake_download
+        with mock.patch('katportalclient.client.MAX_SAMPLES_PER_HISTORY_QUERY', 5):
+            samples = yield self._portal_client.sensor_history(
+                'anc_mean_wind_speed', 1000, 1019, split_windows=True,
+                max_concurrent=3)
+            self.assertEqual([sample.timestamp for sample in samples],
+                             [float(t) for t in range(1000, 1020)])
+            self.assertGreater(len(windows), 2)
+
+            arrays = yield self._portal_client.sensor_history(
+                'anc_mean_wind_speed', 1000, 1019, split_windows=True,
+                as_arrays=True)
+            self.assertEqual(arrays.timestamp.tolist(),
+                             [float(t) for t in range(1000, 1020)])
+            self.assertEqual(list(arrays.status), ['nominal'] * 20)
+
+    @gen_test
+    def test_sensor_history_bucketed(self):
+        """Test that history samples are summarised in time buckets."""
+        archive = [[t * 1000, t * 1000, t * 1000000, str(t % 10),
+                    'anc_mean_wind_speed', 'nominal'] for t in range(1000, 1020)]
+
+        def fake_download(sensor_name, start_time_sec, end_time_sec, samples,
+                          timeout_sec):
+            samples.add_samples([sample for sample in archive
+                                 if start_time_sec * 1000 <= sample[0] <= end_time_sec * 1000])
+            future = gen.Future()
+            future.set_result(None)
+            return future
+
+        self._portal_client._download_sensor_history = fake_download
+        buckets = yield self._portal_client.sensor_history(
+            'anc_mean_wind_speed', 1000, 1019, bucket_sec=10)
+        self.assertEqual([bucket.timestamp for bucket in buckets], [1000, 1010])
+        self.assertEqual([bucket.count for bucket in buckets], [10, 10])
+        self.assertEqual([bucket.mean for bucket in buckets], [4.5, 4.5])
+        self.assertEqual([bucket.last for bucket in buckets], ['9', '9'])
+
+        with mock.patch('katportalclient.client.MAX_SAMPLES_PER_HISTORY_QUERY', 5):
+            split_buckets = yield self._portal_client.sensor_history(
+                'anc_mean_wind_speed', 1000, 1019, bucket_sec=10,
+                split_windows=True)
+        self.assertEqual(split_buckets, buckets)
+
+        with self.assertRaises(ValueError):
+            yield self._portal_client.sensor_history(
+                'anc_mean_wind_speed', 1000, 1019, bucket_sec=10,
+                as_arrays=True)
+
+    @gen_test
+    def test_sensor_history_with_cache(self):
+        """Test that repeated queries are served from the history cache."""
+        archive = [[t * 1000, t * 1000 - 500, t * 1000000, str(t),
+                    'anc_mean_wind_speed', 'nominal'] for t in range(1000, 1020)]
+        windows = []
+
+        def fake_download(sensor_name, start_time_sec, end_time_sec, samples,
+                          timeout_sec):
+            windows.append((start_time_sec, end_time_sec))
+            samples.add_samples([sample for sample in archive
+                                 if start_time_sec * 1000 <= sample[0] <= end_time_sec * 1000])
+            future = gen.Future()
+            future.set_result(None)
+            return future
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        test_client = KATPortalClient(self.websocket_url, None,
+                                      history_cache_dir=cache_dir)
+        test_client._download_sensor_history = fake_download
+
+        samples = yield test_client.sensor_history(
+            'anc_mean_wind_speed', 1005, 1010)
+        self.assertEqual([sample.timestamp for sample in samples],
+                         [float(t) for t in range(1005, 1011)])
+        self.assertEqual(windows, [(1005, 1010)])
+        # only the uncovered parts are requested, and nothing is duplicated
+        samples = yield test_client.sensor_history(
+            'anc_mean_wind_speed', 1000, 1015, include_value_ts=True)
+        self.assertEqual(windows, [(1005, 1010), (1000, 1005), (1010, 1015)])
+        self.assertEqual([sample.timestamp for sample in samples],
+                         [float(t) for t in range(1000, 1016)])
+        self.assertEqual(samples[0].value_timestamp, 999.5)
+        # fully covered query is served locally
+        samples = yield test_client.sensor_history(
+            'anc_mean_wind_speed', 1002, 1012, as_arrays=True)
+        self.assertEqual(len(windows), 3)
+        self.assertEqual(samples.timestamp.tolist(),
+                         [float(t) for t in range(1002, 1013)])
+        buckets = yield test_client.sensor_history(
+            'anc.mean.wind-speed', 1000, 1019, bucket_sec=10)
+        self.assertEqual(windows[3:], [(1015, 1019)])
+        self.assertEqual([(bucket.timestamp, bucket.count) for bucket in buckets],
+                         [(1000.0, 10), (1010.0, 10)])
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
     @gen_test
     def test_sensor_history_single_sensor_valid_times(self):
         """Test that time ordered data is received for a single sensor request."""
@@ -889,7 +1665,7 @@ class TestKATPortalClient(WebSocketBaseTestCase):
             invalid_responses=['1error', '2error', '3error'],
             starts_withs=history_base_url,
             containses=[
-                sensor_name_filter,
+                urllib.quote(sensor_name_filter, safe=''),
                 sensor_names[0],
                 sensor_names[1]],
             publish_raw_messageses=[
@@ -919,6 +1695,66 @@ class TestKATPortalClient(WebSocketBaseTestCase):
                 self.assertGreater(sample[0], time_sec)
                 time_sec = sample[0]
 
+    @gen_test
+    def test_sensor_history_multiple_sensors_concurrent(self):
+        """Test that time ordered data is received for concurrent sensor requests."""
+        history_base_url = self._portal_client.sitemap[
+            'historic_sensor_values']
+        sensor_name_filter = 'anc_.*_wind_speed'
+        sensor_names = ['anc_mean_wind_speed', 'anc_gust_wind_speed']
+        publish_messages = [
+            [sensor_history_pub_messages_json['init']],
+            [sensor_history_pub_messages_json['init']]
+        ]
+        publish_messages[0].extend(
+            sensor_history_pub_messages_json[sensor_names[0]])
+        publish_messages[1].extend(
+            sensor_history_pub_messages_json[sensor_names[1]])
+
+        # complicated way to define the behaviour for the 3 expected HTTP requests
+        #  - 1st call gives sensor list
+        #  - 2nd call provides the sample history for sensor 0
+        #  - 3rd call provides the sample history for sensor 1
+        self.mock_http_async_client().fetch.side_effect = mock_async_fetchers(
+            valid_responses=[
+                '[{}, {}]'.format(sensor_json[sensor_names[0]],
+                                  sensor_json[sensor_names[1]]),
+                '{"result":"success"}',
+                '{"result":"success"}'],
+            invalid_responses=['1error', '2error', '3error'],
+            starts_withs=history_base_url,
+            containses=[
+                urllib.quote(sensor_name_filter, safe=''),
+                sensor_names[0],
+                sensor_names[1]],
+            publish_raw_messageses=[
+                None,
+                publish_messages[0],
+                publish_messages[1]],
+            client_stateses=[
+                None,
+                self._portal_client._sensor_history_states,
+                self._portal_client._sensor_history_states])
+
+        histories = yield self._portal_client.sensors_histories(
+            sensor_name_filter, start_time_sec=0, end_time_sec=time.time(),
+            max_concurrent=2)
+        # expect exactly 2 lists of samples
+        self.assertTrue(len(histories) == 2)
+        # expect keys to match the 2 sensor names
+        self.assertIn(sensor_names[0], histories.keys())
+        self.assertIn(sensor_names[1], histories.keys())
+        # expect 4 samples for 1st, and 3 samples for 2nd
+        self.assertTrue(len(histories[sensor_names[0]]) == 4)
+        self.assertTrue(len(histories[sensor_names[1]]) == 3)
+
+        # ensure time order is increasing, per sensor
+        for sensor in histories:
+            time_sec = 0
+            for sample in histories[sensor]:
+                self.assertGreater(sample[0], time_sec)
+                time_sec = sample[0]
+
     @gen_test
     def test_sensor_history_multiple_sensor_futures(self):
         """Test multiple sensor requests in list of futures."""
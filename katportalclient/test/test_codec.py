@@ -0,0 +1,42 @@
+###############################################################################
+# SKA South Africa (http://ska.ac.za/)                                        #
+# Author: cam@ska.ac.za                                                       #
+# Copyright @ 2013 SKA SA. All rights reserved.                               #
+#                                                                             #
+# THIS SOFTWARE MAY NOT BE COPIED OR DISTRIBUTED IN ANY FORM WITHOUT THE      #
+# WRITTEN PERMISSION OF SKA SA.                                               #
+###############################################################################
+"""Tests for the katportalclient JSON codec."""
+
+
+import unittest2 as unittest
+
+from katportalclient.codec import JSONCodec, JSONError, default_codec
+from katportalclient.request import JSONRPCRequest
+
+
+class TestJSONCodec(unittest.TestCase):
+
+    def test_backend_preference(self):
+        codec = JSONCodec(['no_such_json_library', 'json'])
+        self.assertEqual(codec.backend, 'json')
+        with self.assertRaises(ValueError):
+            JSONCodec(['no_such_json_library'])
+
+    def test_round_trip(self):
+        message = {'id': 'redis-pubsub', 'result': [1476164224429, 5.07571614843]}
+        for codec in [default_codec, JSONCodec(['json'])]:
+            self.assertEqual(codec.loads(codec.dumps(message)), message)
+            self.assertEqual(codec.loads(b'{"value": 5.0883800412}'),
+                             {'value': 5.0883800412})
+
+    def test_invalid_json(self):
+        for codec in [default_codec, JSONCodec(['json'])]:
+            with self.assertRaises(JSONError):
+                codec.loads('{"unterminated": ')
+
+    def test_request_encoding(self):
+        req = JSONRPCRequest('subscribe', ['namespace', ['sensor*']])
+        self.assertEqual(JSONCodec(['json']).loads(req()),
+                         {'jsonrpc': '2.0', 'id': req.id, 'method': 'subscribe',
+                          'params': ['namespace', ['sensor*']]})
@@ -0,0 +1,60 @@
+###############################################################################
+# SKA South Africa (http://ska.ac.za/)                                        #
+# Author: cam@ska.ac.za                                                       #
+# Copyright @ 2013 SKA SA. All rights reserved.                               #
+#                                                                             #
+# THIS SOFTWARE MAY NOT BE COPIED OR DISTRIBUTED IN ANY FORM WITHOUT THE      #
+# WRITTEN PERMISSION OF SKA SA.                                               #
+###############################################################################
+"""Tests for katportalclient websocket connection handling."""
+
+
+import unittest2 as unittest
+
+from katportalclient.connection import HeartbeatMonitor, ReconnectPolicy
+
+
+class TestReconnectPolicy(unittest.TestCase):
+
+    def test_exponential_backoff(self):
+        policy = ReconnectPolicy(initial_delay_sec=1, max_delay_sec=10,
+                                 multiplier=2, jitter=0)
+        self.assertEqual([policy.delay(failures) for failures in range(7)],
+                         [0, 1, 2, 4, 8, 10, 10])
+        self.assertEqual(policy.delay(100000), 10)
+
+    def test_jitter(self):
+        policy = ReconnectPolicy(initial_delay_sec=4, jitter=0.5)
+        delays = [policy.delay(1) for _ in range(100)]
+        self.assertTrue(all(2 <= delay <= 4 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
+
+    def test_invalid_jitter(self):
+        with self.assertRaises(ValueError):
+            ReconnectPolicy(jitter=2)
+
+
+class TestHeartbeatMonitor(unittest.TestCase):
+
+    def test_round_trip_times(self):
+        monitor = HeartbeatMonitor()
+        for _ in range(3):
+            payload = monitor.ping()
+            self.assertGreaterEqual(monitor.pong(payload), 0)
+        stats = monitor.latency_stats()
+        self.assertEqual(stats['count'], 3)
+        self.assertEqual(stats['missed'], 0)
+        self.assertLessEqual(stats['min'], stats['p50'])
+        self.assertLessEqual(stats['p99'], stats['max'])
+
+    def test_missed_pings(self):
+        monitor = HeartbeatMonitor(max_missed=2)
+        stale_payload = monitor.ping()
+        monitor.ping()
+        self.assertEqual(monitor.num_missed, 1)
+        self.assertIsNone(monitor.pong(stale_payload))
+        monitor.ping()
+        self.assertTrue(monitor.dead)
+        monitor.reset()
+        self.assertFalse(monitor.dead)
+        self.assertEqual(monitor.latency_stats(), {'count': 0, 'missed': 0})
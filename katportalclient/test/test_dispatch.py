@@ -0,0 +1,95 @@
+###############################################################################
+# SKA South Africa (http://ska.ac.za/)                                        #
+# Author: cam@ska.ac.za                                                       #
+# Copyright @ 2013 SKA SA. All rights reserved.                               #
+#                                                                             #
+# THIS SOFTWARE MAY NOT BE COPIED OR DISTRIBUTED IN ANY FORM WITHOUT THE      #
+# WRITTEN PERMISSION OF SKA SA.                                               #
+###############################################################################
+"""Tests for katportalclient update dispatch."""
+
+
+import unittest2 as unittest
+
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+
+from katportalclient.dispatch import MessageRouter, UpdateBatcher, glob_to_regex
+
+
+class TestUpdateBatcher(AsyncTestCase):
+
+    @gen_test
+    def test_interval(self):
+        batches = []
+        batcher = UpdateBatcher(batches.append, self.io_loop, 0.05, 100)
+        batcher.add(1)
+        batcher.add(2)
+        self.assertEqual(len(batcher), 2)
+        yield gen.sleep(0.1)
+        self.assertEqual(batches, [[1, 2]])
+        self.assertEqual(len(batcher), 0)
+
+    @gen_test
+    def test_flush(self):
+        batches = []
+        batcher = UpdateBatcher(batches.append, self.io_loop, 10, 100)
+        batcher.add(1)
+        batcher.flush()
+        batcher.flush()
+        yield gen.moment
+        self.assertEqual(batches, [[1]])
+
+    def test_invalid_size(self):
+        with self.assertRaises(ValueError):
+            UpdateBatcher(None, self.io_loop, 0.1, 0)
+
+
+class TestMessageRouter(unittest.TestCase):
+
+    def test_glob_to_regex(self):
+        for pattern, channel, matches in [('h?llo', 'hello', True),
+                                          ('h*llo', 'hllo', True),
+                                          ('h[ae]llo', 'hillo', False),
+                                          ('h[^e]llo', 'hallo', True),
+                                          ('h[a-c]llo', 'hbllo', True),
+                                          ('h\\*llo', 'h*llo', True),
+                                          ('h\\*llo', 'hello', False),
+                                          ('ns:*', 'ns:mon:sensor', True)]:
+            self.assertEqual(bool(glob_to_regex(pattern).match(channel)), matches,
+                             (pattern, channel))
+
+    def test_route(self):
+        router = MessageRouter()
+        router.add('ns:exact', 'exact')
+        router.add('ns:e*', 'pattern')
+        router.add('ns:e*', 'pattern')
+        self.assertEqual(len(router), 2)
+        self.assertEqual(router.route('ns:exact'), ['exact'])
+        self.assertEqual(router.route('ns:exact', 'ns:e*'), ['pattern'])
+        # a copy delivered for a pattern without handlers is not routed
+        self.assertEqual(router.route('ns:else', 'ns:*'), [])
+        self.assertEqual(router.route('ns:else'), ['pattern'])
+        self.assertEqual(router.route('ns:other'), [])
+        router.remove('ns:e*')
+        self.assertEqual(router.route('ns:else'), [])
+
+    def test_route_general_namespace(self):
+        router = MessageRouter()
+        router.add('*:m063*', 'general')
+        router.add('ns:m063*', 'namespaced')
+        self.assertEqual(router.route('planets:m063_ap_mode', 'planets:m063*'),
+                         ['general'])
+        self.assertEqual(router.route('ns:m063_ap_mode', 'ns:m063*'),
+                         ['namespaced'])
+        self.assertEqual(router.route('planets:m062_ap_mode', 'planets:m062*'),
+                         [])
+
+    def test_remove_handler(self):
+        router = MessageRouter()
+        router.add('ns:e*', 'first')
+        router.add('ns:e*', 'second')
+        router.remove('ns:e*', 'first')
+        self.assertEqual(router.route('ns:else'), ['second'])
+        router.remove('ns:e*', 'second')
+        self.assertEqual(len(router), 0)
@@ -0,0 +1,244 @@
+###############################################################################
+# SKA South Africa (http://ska.ac.za/)                                        #
+# Author: cam@ska.ac.za                                                       #
+# Copyright @ 2013 SKA SA. All rights reserved.                               #
+#                                                                             #
+# THIS SOFTWARE MAY NOT BE COPIED OR DISTRIBUTED IN ANY FORM WITHOUT THE      #
+# WRITTEN PERMISSION OF SKA SA.                                               #
+###############################################################################
+"""Tests for katportalclient sample history accumulators."""
+
+
+import unittest2 as unittest
+
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+
+from katportalclient.history import (
+    SensorSample, SensorSampleValueTs, SampleListAccumulator,
+    SampleArrayAccumulator, SampleBucketAggregator, SampleChunkQueue,
+    SampleColumnAccumulator, SampleColumns, SensorSampleArrays)
+
+
+# Raw samples as published by katportal, deliberately out of order
+raw_samples = [
+    [1476164228142, 1476164227102, 1476164228142342, "5.0883800412",
+     "anc_mean_wind_speed", "nominal"],
+    [1476164224429, 1476164223101, 1476164224429354, "5.07571614843",
+     "anc_mean_wind_speed", "warn"],
+    [1476164226128, 1476164225103, 1476164226128442, "5.0753700255",
+     "anc_mean_wind_speed", "nominal"],
+]
+
+
+class TestSampleListAccumulator(unittest.TestCase):
+
+    def test_samples_sorted(self):
+        accumulator = SampleListAccumulator()
+        self.assertEqual(accumulator.add_samples(raw_samples[:2]), 2)
+        self.assertEqual(accumulator.add_samples(raw_samples[2:]), 1)
+        samples = accumulator.result()
+        self.assertEqual(len(samples), 3)
+        self.assertIsInstance(samples[0], SensorSample)
+        self.assertEqual([sample.timestamp for sample in samples],
+                         [1476164224.429, 1476164226.128, 1476164228.142])
+
+    def test_runs_merged(self):
+        accumulator = SampleListAccumulator()
+        accumulator.add_samples(sorted(raw_samples)[1:])
+        self.assertEqual(accumulator.num_runs, 1)
+        self.assertEqual(len(accumulator.result()), 2)
+        accumulator.add_samples(sorted(raw_samples)[:1])
+        self.assertEqual(accumulator.num_runs, 2)
+        self.assertEqual([sample.timestamp for sample in accumulator.result()],
+                         [1476164224.429, 1476164226.128, 1476164228.142])
+
+    def test_many_runs_sorted(self):
+        accumulator = SampleListAccumulator()
+        raw = [[t, t, t, "1.0", "sensor", "nominal"] for t in range(1000, 0, -1)]
+        accumulator.add_samples(raw)
+        self.assertEqual(accumulator.num_runs, 1000)
+        self.assertEqual([sample.timestamp for sample in accumulator.result()],
+                         [t / 1000.0 for t in range(1, 1001)])
+
+    def test_invalid_samples_ignored(self):
+        accumulator = SampleListAccumulator(include_value_ts=True)
+        self.assertEqual(accumulator.add_samples([[1, 2, 3]] + raw_samples), 3)
+        self.assertIsInstance(accumulator.result()[0], SensorSampleValueTs)
+
+
+class TestSampleArrayAccumulator(unittest.TestCase):
+
+    def test_samples_sorted(self):
+        accumulator = SampleArrayAccumulator(include_value_ts=True)
+        accumulator.add_samples(raw_samples[:1])
+        accumulator.add_samples(raw_samples[1:])
+        samples = accumulator.result()
+        self.assertEqual(len(samples), 3)
+        self.assertEqual(samples.timestamp.tolist(),
+                         [1476164224.429, 1476164226.128, 1476164228.142])
+        self.assertEqual(samples.value_timestamp.tolist(),
+                         [1476164223.101, 1476164225.103, 1476164227.102])
+        self.assertEqual(samples.value.tolist(),
+                         [5.07571614843, 5.0753700255, 5.0883800412])
+        self.assertEqual(samples.status.tolist(), ['warn', 'nominal', 'nominal'])
+        self.assertEqual(samples.status_names, ('nominal', 'warn'))
+
+    def test_in_order_samples_not_sorted(self):
+        accumulator = SampleArrayAccumulator()
+        accumulator.add_samples(sorted(raw_samples))
+        self.assertEqual(accumulator.num_runs, 1)
+        samples = accumulator.result()
+        accumulator.add_samples(sorted(raw_samples))
+        self.assertEqual(len(samples), 3)
+        self.assertEqual(samples.value.tolist(),
+                         [5.07571614843, 5.0753700255, 5.0883800412])
+
+    def test_object_values(self):
+        accumulator = SampleArrayAccumulator()
+        accumulator.add_samples([
+            [1000, 1000, 1000, "ok", "anc_wind_device_status", "nominal"],
+            [2000, 2000, 2000, "fail", "anc_wind_device_status", "error"]])
+        samples = accumulator.result()
+        self.assertIsNone(samples.value_timestamp)
+        self.assertEqual(samples.value.dtype, object)
+        self.assertEqual(samples.to_samples(), [
+            SensorSample(1.0, "ok", "nominal"),
+            SensorSample(2.0, "fail", "error")])
+
+    def test_values_stored_as_floats_until_not_numeric(self):
+        accumulator = SampleArrayAccumulator()
+        accumulator.add_samples(raw_samples[:2])
+        self.assertEqual(accumulator._values.typecode, 'd')
+        accumulator.add_samples([
+            [1476164229000, 0, 0, "off", "anc_mean_wind_speed", "nominal"]])
+        samples = accumulator.result()
+        self.assertEqual(samples.value.dtype, object)
+        self.assertEqual(samples.value.tolist(),
+                         [5.07571614843, 5.0883800412, "off"])
+
+    def test_concatenate_remaps_status(self):
+        first = SampleArrayAccumulator()
+        first.add_samples(raw_samples[1:2])
+        second = SampleArrayAccumulator()
+        second.add_samples([raw_samples[2], raw_samples[0]])
+        samples = SensorSampleArrays.concatenate([first.result(), second.result()])
+        self.assertEqual(samples.timestamp.tolist(),
+                         [1476164224.429, 1476164226.128, 1476164228.142])
+        self.assertEqual(samples.status.tolist(), ['warn', 'nominal', 'nominal'])
+        self.assertEqual(samples.status_names, ('warn', 'nominal'))
+
+    def test_empty(self):
+        samples = SampleArrayAccumulator().result()
+        self.assertEqual(len(samples), 0)
+        self.assertEqual(samples.to_samples(), [])
+
+
+class TestSampleColumnAccumulator(unittest.TestCase):
+
+    def test_samples_sorted(self):
+        accumulator = SampleColumnAccumulator()
+        self.assertEqual(accumulator.add_samples([[1, 2, 3]] + raw_samples), 3)
+        samples = accumulator.result()
+        self.assertEqual(list(samples.timestamp),
+                         [1476164224.429, 1476164226.128, 1476164228.142])
+        self.assertEqual(samples.samples(True)[0], SensorSampleValueTs(
+            1476164224.429, 1476164223.101, "5.07571614843", "warn"))
+        arrays = SensorSampleArrays.from_columns(samples)
+        self.assertEqual(arrays.value.tolist(),
+                         [5.07571614843, 5.0753700255, 5.0883800412])
+
+    def test_insert(self):
+        accumulator = SampleColumnAccumulator()
+        accumulator.add_samples([raw_samples[1], raw_samples[0]])
+        samples = accumulator.result()
+        gap = SampleColumnAccumulator()
+        gap.add_samples(raw_samples[2:])
+        # spliced into the gap between the two samples
+        samples.insert(gap.result())
+        self.assertEqual(samples.status, ['warn', 'nominal', 'nominal'])
+        self.assertEqual(list(samples.timestamp),
+                         [1476164224.429, 1476164226.128, 1476164228.142])
+        # interleaved samples are reordered
+        samples.insert(SampleColumns.concatenate([
+            samples.slice(0, 1), samples.slice(2, 3)]))
+        self.assertEqual(list(samples.timestamp),
+                         [1476164224.429, 1476164224.429, 1476164226.128,
+                          1476164228.142, 1476164228.142])
+
+
+class TestSampleBucketAggregator(unittest.TestCase):
+
+    def test_buckets(self):
+        aggregator = SampleBucketAggregator(2.0, 1476164224.0)
+        aggregator.add_samples(raw_samples)
+        self.assertEqual(len(aggregator), 3)
+        self.assertEqual(aggregator.last_timestamp, 1476164228.142)
+        buckets = aggregator.result()
+        self.assertEqual([bucket.timestamp for bucket in buckets],
+                         [1476164224.0, 1476164226.0, 1476164228.0])
+        self.assertEqual([bucket.count for bucket in buckets], [1, 1, 1])
+        self.assertEqual(buckets[0].min, 5.07571614843)
+        self.assertEqual(buckets[0].status, 'warn')
+        self.assertEqual(buckets[2].last, '5.0883800412')
+
+    def test_non_numeric_values(self):
+        aggregator = SampleBucketAggregator(10)
+        aggregator.add_sample(1.0, 'on', 'nominal')
+        aggregator.add_sample(2.0, 'off', 'warn')
+        bucket, = aggregator.result()
+        self.assertEqual(bucket, (0.0, 2, None, None, None, 'off', 'warn', 0))
+
+    def test_combine_merges_boundary_bucket(self):
+        first = SampleBucketAggregator(10)
+        first.add_sample(1.0, 1.0, 'nominal')
+        first.add_sample(2.0, 3.0, 'nominal')
+        second = SampleBucketAggregator(10)
+        second.add_sample(5.0, 8.0, 'warn')
+        second.add_sample(15.0, 4.0, 'nominal')
+        combined = SampleBucketAggregator.combine(
+            [first.result(), second.result()])
+        self.assertEqual(combined[0], (0.0, 3, 1.0, 8.0, 4.0, 8.0, 'warn', 3))
+        self.assertEqual(combined[1].timestamp, 10.0)
+
+    def test_combine_weights_mean_by_numeric_samples(self):
+        first = SampleBucketAggregator(10)
+        first.add_sample(1.0, '1', 'nominal')
+        first.add_sample(2.0, 'x', 'nominal')
+        second = SampleBucketAggregator(10)
+        second.add_sample(5.0, '3', 'nominal')
+        combined, = SampleBucketAggregator.combine(
+            [first.result(), second.result()])
+        self.assertEqual(combined.count, 3)
+        self.assertEqual(combined.numeric_count, 2)
+        self.assertEqual(combined.mean, 2.0)
+
+    def test_invalid_bucket_width(self):
+        with self.assertRaises(ValueError):
+            SampleBucketAggregator(0)
+
+
+class TestSampleChunkQueue(AsyncTestCase):
+
+    @gen_test
+    def test_deliver_waits_for_callback(self):
+        chunk_queue = SampleChunkQueue()
+        delivered = []
+
+        @gen.coroutine
+        def on_chunk(samples):
+            # nothing else may be delivered while we are busy
+            delivered.append(None)
+            yield gen.sleep(0.01)
+            delivered[-1] = [sample.timestamp for sample in samples]
+
+        delivery = chunk_queue.deliver(on_chunk)
+        chunk_queue.add_samples(raw_samples[:2])
+        chunk_queue.add_samples([])
+        chunk_queue.add_samples(raw_samples[2:])
+        chunk_queue.close()
+        num_samples = yield delivery
+        self.assertEqual(num_samples, 3)
+        self.assertEqual(len(chunk_queue), 3)
+        self.assertEqual(delivered, [[1476164228.142, 1476164224.429],
+                                     [1476164226.128]])
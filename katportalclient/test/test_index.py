@@ -0,0 +1,62 @@
+###############################################################################
+# SKA South Africa (http://ska.ac.za/)                                        #
+# Author: cam@ska.ac.za                                                       #
+# Copyright @ 2013 SKA SA. All rights reserved.                               #
+#                                                                             #
+# THIS SOFTWARE MAY NOT BE COPIED OR DISTRIBUTED IN ANY FORM WITHOUT THE      #
+# WRITTEN PERMISSION OF SKA SA.                                               #
+###############################################################################
+"""Tests for katportalclient sensor index."""
+
+
+import unittest2 as unittest
+
+from katportalclient.index import SensorIndex
+
+
+SENSOR_NAMES = ['anc_gust_wind_speed', 'anc_mean_wind_speed',
+                'anc_weather_wind_speed', 'm062_ap_mode', 'm063_ap_mode',
+                'm063_rsc_rxl_state']
+
+
+class TestSensorIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = SensorIndex(SENSOR_NAMES)
+
+    def test_search(self):
+        self.assertEqual(self.index.search('ap_mode'),
+                         ['m062_ap_mode', 'm063_ap_mode'])
+        self.assertEqual(self.index.search('^m063'),
+                         ['m063_ap_mode', 'm063_rsc_rxl_state'])
+        self.assertEqual(self.index.search('^m0633?_ap'),
+                         ['m063_ap_mode'])
+        self.assertEqual(self.index.search('^m062|^anc_g'),
+                         ['anc_gust_wind_speed', 'm062_ap_mode'])
+        self.assertEqual(self.index.search_all(['^m062', 'gust', '^m062']),
+                         ['anc_gust_wind_speed', 'm062_ap_mode'])
+
+    def test_glob(self):
+        self.assertEqual(self.index.glob('anc_*_wind_speed'), SENSOR_NAMES[:3])
+        self.assertEqual(self.index.glob('m06[2]_*'), ['m062_ap_mode'])
+        self.assertEqual(self.index.glob('m063_ap'), [])
+
+    def test_prefixed_and_next_parts(self):
+        self.assertEqual(self.index.prefixed('m06'), SENSOR_NAMES[3:])
+        self.assertEqual(self.index.prefixed('z'), [])
+        self.assertEqual(self.index.next_parts('anc_'), ['gust', 'mean', 'weather'])
+        self.assertEqual(self.index.next_parts('m063_'), ['ap', 'rsc'])
+        self.assertEqual(self.index.next_parts('m06'), ['m062', 'm063'])
+        self.assertEqual(self.index.next_parts('x_'), [])
+
+    def test_incremental_update(self):
+        added, removed = self.index.update(
+            SENSOR_NAMES[1:] + ['anc_gust_wind_speed2'])
+        self.assertEqual(added, ['anc_gust_wind_speed2'])
+        self.assertEqual(removed, ['anc_gust_wind_speed'])
+        self.assertNotIn('anc_gust_wind_speed', self.index)
+        self.assertEqual(self.index.next_parts('anc_gust_wind_'), ['speed2'])
+        self.index.remove('m063_rsc_rxl_state')
+        self.assertEqual(self.index.next_parts('m063_'), ['ap'])
+        self.assertEqual(len(self.index), 5)
+        self.assertFalse(self.index.stale)
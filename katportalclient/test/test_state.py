@@ -0,0 +1,61 @@
+###############################################################################
+# SKA South Africa (http://ska.ac.za/)                                        #
+# Author: cam@ska.ac.za                                                       #
+# Copyright @ 2013 SKA SA. All rights reserved.                               #
+#                                                                             #
+# THIS SOFTWARE MAY NOT BE COPIED OR DISTRIBUTED IN ANY FORM WITHOUT THE      #
+# WRITTEN PERMISSION OF SKA SA.                                               #
+###############################################################################
+"""Tests for the katportalclient sensor value table."""
+
+
+import unittest2 as unittest
+
+from katportalclient.history import SensorSample
+from katportalclient.state import SensorValueTable
+
+
+def sensor_update(name, timestamp, value, status='nominal'):
+    return {'name': name, 'timestamp': timestamp, 'value': value,
+            'status': status, 'received_timestamp': timestamp + 0.1}
+
+
+class TestSensorValueTable(unittest.TestCase):
+
+    def setUp(self):
+        self.table = SensorValueTable()
+
+    def test_update(self):
+        self.assertTrue(self.table.update(sensor_update('anc_mean_wind_speed', 10.0, 4.5)))
+        record = self.table['anc_mean_wind_speed']
+        self.assertTrue(self.table.update(
+            sensor_update('anc_mean_wind_speed', 11.0, 5.5, 'warn')))
+        self.assertIs(self.table['anc_mean_wind_speed'], record)
+        self.assertEqual(record.sample(), SensorSample(11.0, 5.5, 'warn'))
+        self.assertEqual(record.received_timestamp, 11.1)
+        self.assertEqual(len(self.table), 1)
+        self.assertIn('anc_mean_wind_speed', self.table)
+
+    def test_older_update_ignored(self):
+        self.table.update(sensor_update('anc_mean_wind_speed', 10.0, 4.5))
+        self.assertFalse(self.table.update(sensor_update('anc_mean_wind_speed', 9.0, 3.5)))
+        self.assertEqual(self.table.get('anc_mean_wind_speed').value, 4.5)
+
+    def test_invalid_update_ignored(self):
+        self.assertFalse(self.table.update(None))
+        self.assertFalse(self.table.update({'name': 'anc_mean_wind_speed'}))
+        self.assertIsNone(self.table.get('anc_mean_wind_speed'))
+
+    def test_snapshot(self):
+        self.table.update(sensor_update('anc_mean_wind_speed', 10.0, 4.5))
+        self.table.update(sensor_update('anc_gust_wind_speed', 10.0, 7.5))
+        snapshot = self.table.snapshot()
+        self.table.update(sensor_update('anc_mean_wind_speed', 11.0, 5.5))
+        self.assertEqual(snapshot, {
+            'anc_mean_wind_speed': SensorSample(10.0, 4.5, 'nominal'),
+            'anc_gust_wind_speed': SensorSample(10.0, 7.5, 'nominal')})
+        self.assertEqual(
+            self.table.snapshot(['anc_mean_wind_speed', 'anc_unknown']),
+            {'anc_mean_wind_speed': SensorSample(11.0, 5.5, 'nominal')})
+        self.table.clear()
+        self.assertEqual(self.table.snapshot(), {})
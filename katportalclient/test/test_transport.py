@@ -0,0 +1,66 @@
+###############################################################################
+# SKA South Africa (http://ska.ac.za/)                                        #
+# Author: cam@ska.ac.za                                                       #
+# Copyright @ 2013 SKA SA. All rights reserved.                               #
+#                                                                             #
+# THIS SOFTWARE MAY NOT BE COPIED OR DISTRIBUTED IN ANY FORM WITHOUT THE      #
+# WRITTEN PERMISSION OF SKA SA.                                               #
+###############################################################################
+"""Tests for katportalclient HTTP transport."""
+
+
+import mock
+from tornado import concurrent
+from tornado.testing import AsyncTestCase, gen_test
+
+from katportalclient.transport import HTTPTransport
+
+
+class TestHTTPTransport(AsyncTestCase):
+
+    def setUp(self):
+        super(TestHTTPTransport, self).setUp()
+        patcher = mock.patch('tornado.httpclient.AsyncHTTPClient')
+        self.addCleanup(patcher.stop)
+        self.mock_http_async_client = patcher.start()
+
+    def test_client_configuration(self):
+        transport = HTTPTransport(max_clients=5, connect_timeout_sec=2,
+                                  request_timeout_sec=3, use_curl=False)
+        self.assertEqual(transport.backend, 'simple')
+        client = transport.client(self.io_loop)
+        self.assertIs(transport.client(), client)
+        self.mock_http_async_client.assert_called_once_with(
+            io_loop=self.io_loop, force_instance=True, max_clients=5,
+            defaults={'connect_timeout': 2, 'request_timeout': 3,
+                      'decompress_response': True})
+
+    def test_shared_client(self):
+        transport = HTTPTransport(max_clients=5, force_instance=False)
+        self.assertEqual(transport.backend, 'shared')
+        transport.client(self.io_loop)
+        self.mock_http_async_client.assert_called_once_with(io_loop=self.io_loop)
+        transport.close()
+        self.mock_http_async_client().close.assert_not_called()
+
+    @gen_test
+    def test_latency_stats(self):
+        def fetch(url):
+            future = concurrent.Future()
+            if url == 'bad':
+                future.set_exception(ValueError(url))
+            else:
+                future.set_result(url)
+            return future
+
+        self.mock_http_async_client().fetch.side_effect = fetch
+        transport = HTTPTransport(use_curl=False)
+        response = yield transport.fetch('first', 'good')
+        self.assertEqual(response, 'good')
+        yield transport.fetch('first', 'good')
+        with self.assertRaises(ValueError):
+            yield transport.fetch('second', 'bad')
+        stats = transport.latency_stats()
+        self.assertEqual(stats['first']['count'], 2)
+        self.assertEqual(stats['second']['count'], 1)
+        self.assertLessEqual(stats['first']['min'], stats['first']['max'])
@@ -0,0 +1,170 @@
+###############################################################################
+# SKA South Africa (http://ska.ac.za/)                                        #
+# Author: cam@ska.ac.za                                                       #
+# Copyright @ 2013 SKA SA. All rights reserved.                               #
+#                                                                             #
+# THIS SOFTWARE MAY NOT BE COPIED OR DISTRIBUTED IN ANY FORM WITHOUT THE      #
+# WRITTEN PERMISSION OF SKA SA.                                               #
+###############################################################################
+"""Module defining the HTTP transport used for katportal's REST endpoints."""
+
+import time
+from collections import deque
+
+import tornado.gen
+import tornado.httpclient
+
+from connection import latency_stats
+
+
+# Default maximum number of simultaneous HTTP requests
+HTTP_MAX_CLIENTS = 20
+# Default timeouts for HTTP requests, in seconds
+HTTP_CONNECT_TIMEOUT = 20
+HTTP_REQUEST_TIMEOUT = 60
+
+
+def _curl_client_class():
+    try:
+        import tornado.curl_httpclient
+    except ImportError:
+        return None
+    return tornado.curl_httpclient.CurlAsyncHTTPClient
+
+
+class HTTPTransport(object):
+    """The HTTP client for katportal's REST endpoints, and its latencies.
+
+    The client is created the first time it is used, as a separate
+    instance with its own connections, rather than tornado's shared
+    AsyncHTTPClient.  With the curl backend, connections (and TLS sessions)
+    are kept alive and reused between requests, which saves the connection
+    setup for each of the many requests of a bulk metadata scan.  tornado's
+    own backend opens a new connection for each request.  The client holds
+    resources on its IOLoop until :meth:`close` is called.
+
+    With `force_instance` False, tornado's shared AsyncHTTPClient of the
+    current IOLoop is used instead, as configured with
+    `AsyncHTTPClient.configure`, and only the latencies are recorded.  This
+    is what a :class:`.KATPortalClient` uses if it is not given a transport.
+
+    Parameters
+    ----------
+    max_clients: int
+        Maximum number of simultaneous requests, further requests are
+        queued (default=HTTP_MAX_CLIENTS).
+    connect_timeout_sec: float
+        Default time to wait for a connection, in seconds
+        (default=HTTP_CONNECT_TIMEOUT).
+    request_timeout_sec: float
+        Default time to wait for a whole request, in seconds
+        (default=HTTP_REQUEST_TIMEOUT).
+    use_gzip: bool
+        Ask for compressed responses (default=True).
+    use_curl: bool
+        Use the curl backend (default=None, use it if pycurl is installed).
+    latency_history_size: int
+        Number of recent request latencies kept per endpoint for
+        :meth:`latency_stats` (default=100).
+    force_instance: bool
+        Create a separate HTTP client, with the above settings (default=True).
+        Otherwise use tornado's shared AsyncHTTPClient, and its settings.
+
+    Raises
+    ------
+    ValueError:
+        If `use_curl` is True, but pycurl is not installed.
+    """
+
+    def __init__(self, max_clients=HTTP_MAX_CLIENTS,
+                 connect_timeout_sec=HTTP_CONNECT_TIMEOUT,
+                 request_timeout_sec=HTTP_REQUEST_TIMEOUT,
+                 use_gzip=True, use_curl=None, latency_history_size=100,
+                 force_instance=True):
+        self.force_instance = force_instance
+        self._curl_class = None
+        if force_instance and use_curl is not False:
+            self._curl_class = _curl_client_class()
+        if use_curl and self._curl_class is None:
+            raise ValueError("The curl HTTP backend needs pycurl to be installed")
+        self.max_clients = max_clients
+        self.defaults = dict(connect_timeout=connect_timeout_sec,
+                             request_timeout=request_timeout_sec,
+                             decompress_response=use_gzip)
+        self._latency_history_size = latency_history_size
+        # endpoint -> recent latencies
+        self._latencies = {}
+        self._client = None
+
+    def __repr__(self):
+        return "<{} backend={} max_clients={}>".format(
+            self.__class__.__name__, self.backend, self.max_clients)
+
+    @property
+    def backend(self):
+        """Name of the HTTP backend, 'curl', 'simple' or 'shared'."""
+        if not self.force_instance:
+            return 'shared'
+        return 'curl' if self._curl_class is not None else 'simple'
+
+    def client(self, io_loop=None):
+        """Return the HTTP client, creating it on the given IOLoop if needed."""
+        if not self.force_instance:
+            return tornado.httpclient.AsyncHTTPClient(io_loop=io_loop)
+        if self._client is None:
+            client_class = self._curl_class or tornado.httpclient.AsyncHTTPClient
+            self._client = client_class(
+                io_loop=io_loop, force_instance=True,
+                max_clients=self.max_clients, defaults=self.defaults)
+        return self._client
+
+    @tornado.gen.coroutine
+    def fetch(self, endpoint, request, io_loop=None, **kwargs):
+        """Fetch a URL or request, and record its latency.
+
+        Parameters
+        ----------
+        endpoint: str
+            Name of the endpoint the latency is recorded for, e.g.
+            'sensor_detail'.
+        request: str or tornado.httpclient.HTTPRequest
+            The URL or request to fetch.
+        io_loop: tornado.ioloop.IOLoop
+            IOLoop to create the HTTP client on, if it does not exist yet.
+        kwargs:
+            Other keyword arguments for `AsyncHTTPClient.fetch`.
+
+        Returns
+        -------
+        tornado.httpclient.HTTPResponse
+        """
+        client = self.client(io_loop)
+        start_time = time.time()
+        try:
+            response = yield client.fetch(request, **kwargs)
+        finally:
+            latencies = self._latencies.get(endpoint)
+            if latencies is None:
+                latencies = self._latencies[endpoint] = deque(
+                    maxlen=self._latency_history_size)
+            latencies.append(time.time() - start_time)
+        raise tornado.gen.Return(response)
+
+    def latency_stats(self):
+        """Summarise the recent request latencies of each endpoint, in seconds.
+
+        Returns
+        -------
+        dict:
+            Endpoint name -> dict with the 'count', 'min', 'mean', 'p50',
+            'p90', 'p99' and 'max' of its recent latencies, including
+            requests that failed.
+        """
+        return {endpoint: latency_stats(latencies)
+                for endpoint, latencies in self._latencies.iteritems()}
+
+    def close(self):
+        """Close the HTTP client, and its connections, unless it is shared."""
+        if self._client is not None:
+            self._client.close()
+            self._client = None
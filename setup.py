@@ -41,6 +41,7 @@ setup(
         "unittest2",
         "nose",
         "mock",
+        "numpy",
     ],
     # install extras by running pip install .[doc,<another_extra>]
     extras_require={
@@ -48,7 +49,11 @@ setup(
             "sphinx>=1.2.3, <2.0",
             "docutils>=0.12, <1.0",
             "sphinx_rtd_theme>=0.1.5, <1.0",
-            "numpydoc>=0.5, <1.0"]
+            "numpydoc>=0.5, <1.0"],
+        "arrays": [
+            "numpy"],
+        "curl": [
+            "pycurl"]
     },
     zip_safe=False,
     test_suite="nose.collector",